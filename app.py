@@ -2,18 +2,39 @@ from auth import AuthError, requires_auth
 from authlib.integrations.flask_client import OAuth
 from flask import (
     Flask,
+    Response,
     request,
     abort,
     jsonify,
     redirect,
     session,
     render_template,
+    send_file,
+    stream_with_context,
     url_for
 )
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from models import setup_db, Actor, Movie
+from models import db, setup_db, Actor, Movie, link, unlink
+from pagination import Page, PaginationError
+from filters import FilterError, actor_filters, movie_filters
+from etag import conditional
+from idempotency import idempotent
+from fieldsets import Fieldset, FieldsetError
+import serializer
+import graph
+import similar
+from db_pool import pool_status
+import metrics
+import profiling
+import ratelimit
+import replicas
+from replicas import replica_reads
+from seed import seed_command
+import stats
+import querycount  # noqa: F401, counts the queries of each request
 from six.moves.urllib.parse import urlencode
+from sqlalchemy import select
 import os
 import sys
 import json
@@ -24,6 +45,11 @@ def create_app(test_config=None):
     app.secret_key = os.getenv("FLASK_SECRET_KEY")
     setup_db(app)
     CORS(app)
+    metrics.init_app(app)
+    replicas.init_app(app)
+    ratelimit.init_app(app)
+    app.cli.add_command(seed_command)
+    app.cli.add_command(stats.rebuild_stats_command)
     return app
 
 
@@ -45,13 +71,20 @@ auth0 = oauth.register(
 )
 
 
+CORS_HEADERS = [
+    ('Access-Control-Allow-Headers',
+     'Content-Type, Authorization, X-Profile, Idempotency-Key'),
+    ('Access-Control-Expose-Headers',
+     'X-Profile-Id, Idempotent-Replayed, Retry-After'),
+    ('Access-Control-Allow-Methods', 'GET,PATCH,POST,PUT,DELETE,OPTIONS'),
+    ('Access-Control-Allow-Origin', '*'),
+]
+
+
 @APP.after_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Headers',
-                         'Content-Type, Authorization')
-    response.headers.add('Access-Control-Allow-Methods',
-                         'GET,PATCH,POST,PUT,DELETE,OPTIONS')
-    response.headers.add('Access-Control-Allow-Origin', '*')
+    for name, value in CORS_HEADERS:
+        response.headers.add(name, value)
     return response
 
 
@@ -60,16 +93,103 @@ def home():
     return render_template('home.html')
 
 
+ACTOR_SORTS = {
+    'id': Actor.__table__.c.id,
+    'name': Actor.__table__.c.name,
+    'age': Actor.__table__.c.age,
+}
+
+MOVIE_SORTS = {
+    'id': Movie.__table__.c.id,
+    'title': Movie.__table__.c.title,
+    'release_date': Movie.__table__.c.release_date,
+}
+
+
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 1000))
+NDJSON = 'application/x-ndjson'
+
+
+@ratelimit.stream_check
+def wants_stream():
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON])
+    return best == NDJSON
+
+
+''' Streams every row of the collection matching the `filters` as newline
+    delimited JSON
+
+    Rows are read in chunks of STREAM_CHUNK_SIZE, each one a keyset query
+    on the primary key, and encoded as they are read, so the memory used
+    does not depend on the size of the table.
+'''
+
+
+def stream_rows(resource, fieldset, filters):
+    rows = serializer.iter_ndjson(resource, fieldset, filters,
+                                  STREAM_CHUNK_SIZE)
+    return Response(stream_with_context(rows), mimetype=NDJSON)
+
+
+''' The list endpoints read column tuples and encode them with the fast
+    serializer, unless FAST_SERIALIZER=0 or the JSON is pretty printed
+'''
+FAST_SERIALIZER = os.getenv('FAST_SERIALIZER', '1') != '0'
+
+
+def use_fast_serializer():
+    pretty = APP.config['JSONIFY_PRETTYPRINT_REGULAR'] or APP.debug
+    return FAST_SERIALIZER and not pretty
+
+
+def get_fieldset(model, relationship):
+    try:
+        return Fieldset(request.args, model, relationship)
+    except FieldsetError:
+        abort(400)
+
+
+def get_page(id_column, sorts):
+    try:
+        return Page(request.args, id_column, sorts)
+    except PaginationError:
+        abort(400)
+
+
+def get_filters(filters):
+    try:
+        return filters(request.args)
+    except FilterError:
+        abort(400)
+
+
 @APP.route('/actors')
 @requires_auth('read:actor')
+@replica_reads
+@conditional('actors')
 def get_actors():
+    fieldset = get_fieldset(Actor, 'movies')
+    filters = get_filters(actor_filters)
+    if wants_stream():
+        return stream_rows(serializer.ACTORS, fieldset, filters)
+    page = get_page(Actor.__table__.c.id, ACTOR_SORTS)
     try:
-        actors = Actor.query.all()
-        actors = list(map(lambda e: e.json(), actors))
-        return jsonify({
-            'success': True,
-            'actors': actors
-        }), 200
+        if use_fast_serializer():
+            return Response(serializer.list_body(
+                serializer.ACTORS, fieldset, page, filters),
+                mimetype='application/json')
+        query = Actor.query.options(*fieldset.options(page.column.key)) \
+            .filter(*filters)
+        actors, next_cursor = page.split(page.apply(query))
+        with metrics.serializing():
+            actors = list(map(fieldset.json, actors))
+            return jsonify({
+                'success': True,
+                'actors': actors,
+                'next_cursor': next_cursor
+            }), 200
     except BaseException:
         print(sys.exc_info())
         abort(422)
@@ -77,21 +197,175 @@ def get_actors():
 
 @APP.route('/movies')
 @requires_auth('read:movie')
+@replica_reads
+@conditional('movies')
 def get_movies():
+    fieldset = get_fieldset(Movie, 'actors')
+    filters = get_filters(movie_filters)
+    if wants_stream():
+        return stream_rows(serializer.MOVIES, fieldset, filters)
+    page = get_page(Movie.__table__.c.id, MOVIE_SORTS)
     try:
-        movies = Movie.query.all()
-        movies = list(map(lambda e: e.json(), movies))
-        return jsonify({
-            'success': True,
-            'movies': movies
-        }), 200
+        if use_fast_serializer():
+            return Response(serializer.list_body(
+                serializer.MOVIES, fieldset, page, filters),
+                mimetype='application/json')
+        query = Movie.query.options(*fieldset.options(page.column.key)) \
+            .filter(*filters)
+        movies, next_cursor = page.split(page.apply(query))
+        with metrics.serializing():
+            movies = list(map(fieldset.json, movies))
+            return jsonify({
+                'success': True,
+                'movies': movies,
+                'next_cursor': next_cursor
+            }), 200
     except BaseException:
         print(sys.exc_info())
         abort(422)
 
 
+@APP.route('/stats/actors')
+@requires_auth('read:actor')
+@replica_reads
+def get_actor_stats():
+    return jsonify({
+        'success': True,
+        'actors': stats.actor_stats()
+    }), 200
+
+
+@APP.route('/stats/movies')
+@requires_auth('read:movie')
+@replica_reads
+def get_movie_stats():
+    return jsonify({
+        'success': True,
+        'movies': stats.movie_stats()
+    }), 200
+
+
+def column_values(column, ids):
+    table = column.table
+    return dict(db.session.execute(select([table.c.id, column]).where(
+        table.c.id.in_(list(ids)))).fetchall())
+
+
+def rows_exist(model, *ids):
+    table = model.__table__
+    found = db.session.execute(select([table.c.id]).where(
+        table.c.id.in_(ids))).fetchall()
+    return len(found) == len(set(ids))
+
+
+def get_limit(default=100, maximum=1000):
+    limit = request.args.get('limit', default, type=int)
+    if not 1 <= limit <= maximum:
+        abort(400)
+    return limit
+
+
+''' Actors sharing a movie with the actor, most shared movies first, read
+    from the co-star graph (see graph.py)
+'''
+
+
+@APP.route('/actors/<int:id>/costars')
+@requires_auth('read:actor')
+@replica_reads
+def get_costars(id):
+    limit = get_limit()
+    if not rows_exist(Actor, id):
+        abort(404)
+    with graph.current_graph() as costar_graph:
+        costars = costar_graph.costars(id)
+    names = column_values(Actor.__table__.c.name,
+                          [costar for costar, _ in costars[:limit]])
+    return jsonify({
+        'success': True,
+        'count': len(costars),
+        'costars': [{'id': costar, 'name': names.get(costar),
+                     'movies': shared}
+                    for costar, shared in costars[:limit]]
+    }), 200
+
+
+''' Shortest chain of co-stars between two actors, with at most max_depth
+    movies
+'''
+
+
+@APP.route('/actors/<int:id>/path/<int:other_id>')
+@requires_auth('read:actor')
+@replica_reads
+def get_costar_path(id, other_id):
+    max_depth = request.args.get('max_depth', 6, type=int)
+    if not 1 <= max_depth <= graph.GRAPH_MAX_DEPTH:
+        abort(400)
+    if not rows_exist(Actor, id, other_id):
+        abort(404)
+    with graph.current_graph() as costar_graph:
+        path = costar_graph.path(id, other_id, max_depth)
+    if path is None:
+        return jsonify({
+            'success': True,
+            'degrees': None,
+            'path': None
+        }), 200
+    names = column_values(Actor.__table__.c.name, path[0::2])
+    titles = column_values(Movie.__table__.c.title, path[1::2])
+    return jsonify({
+        'success': True,
+        'degrees': len(path) // 2,
+        'path': [{'id': node, 'name': names.get(node)} if index % 2 == 0
+                 else {'id': node, 'title': titles.get(node)}
+                 for index, node in enumerate(path)]
+    }), 200
+
+
+''' Movies sharing the most actors with the movie (side=similar.MOVIES),
+    or actors sharing the most movies with the actor, scored by the
+    `metric` query parameter, jaccard or cosine (see similar.py)
+'''
+
+
+def similar_response(model, side, id, label):
+    limit = get_limit(10, similar.SIMILAR_MAX_RESULTS)
+    metric = request.args.get('metric', 'jaccard')
+    if metric not in similar.METRICS:
+        abort(400)
+    if not rows_exist(model, id):
+        abort(404)
+    with graph.current_graph() as costar_graph:
+        results = similar.cache.similar(costar_graph, side, id, metric)
+    column = getattr(model.__table__.c, label)
+    values = column_values(column, [other for other, _, _ in results[:limit]])
+    return jsonify({
+        'success': True,
+        'count': len(results),
+        'similar': [{'id': other, label: values.get(other),
+                     'shared': shared, 'score': round(score, 4)}
+                    for other, shared, score in results[:limit]]
+    }), 200
+
+
+@APP.route('/movies/<int:id>/similar')
+@requires_auth('read:movie')
+@replica_reads
+def get_similar_movies(id):
+    return similar_response(Movie, similar.MOVIES, id, 'title')
+
+
+@APP.route('/actors/<int:id>/similar')
+@requires_auth('read:actor')
+@replica_reads
+def get_similar_actors(id):
+    return similar_response(Actor, similar.ACTORS, id, 'name')
+
+
 @APP.route('/actors', methods=['POST'])
 @requires_auth('add:actor')
+@idempotent
 def create_actor():
     data = request.get_json()
     if data is None:
@@ -110,6 +384,7 @@ def create_actor():
 
 @APP.route('/movies', methods=['POST'])
 @requires_auth('add:movie')
+@idempotent
 def create_movie():
     data = request.get_json()
     if data is None:
@@ -126,86 +401,370 @@ def create_movie():
         abort(422)
 
 
-@APP.route('/actors', methods=['PATCH'])
-@requires_auth('modify:actor')
-def patch_actor():
+BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', 10000))
+
+''' Creates every valid item of the request body in one transaction
+
+    The body is a list of objects, or an object holding that list under
+    `key`. Items are validated before anything is written; the ids of the
+    created items are returned in request order, along with the index and
+    reason of every rejected item.
+'''
+
+
+def bulk_create(model, key):
     data = request.get_json()
-    id = data.get('id', None)
-    if id is None or data is None:
+    if isinstance(data, dict):
+        data = data.get(key)
+    if not isinstance(data, list) or not data or len(data) > BULK_MAX_ITEMS:
         abort(400)
+    rows = []
+    errors = []
+    for index, item in enumerate(data):
+        try:
+            rows.append(model.validate(item))
+        except ValueError as error:
+            errors.append({'index': index, 'message': str(error)})
+    if not rows:
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': errors
+        }), 422
     try:
-        actor = Actor.query.get(id)
-        if data.get('name'):
-            actor.name = data.get('name')
-        if data.get('age'):
-            actor.age = data.get('age')
-        if data.get('gender'):
-            actor.gender = data.get('gender')
-        actor.patch()
+        created = model.bulk_create(rows)
+    except BaseException:
+        db.session.rollback()
+        print(sys.exc_info())
+        abort(422)
+    return jsonify({
+        'success': True,
+        'created': created,
+        'errors': errors
+    }), 201
+
+
+@APP.route('/actors/bulk', methods=['POST'])
+@requires_auth('add:actor')
+@idempotent
+def bulk_create_actors():
+    return bulk_create(Actor, 'actors')
+
+
+@APP.route('/movies/bulk', methods=['POST'])
+@requires_auth('add:movie')
+@idempotent
+def bulk_create_movies():
+    return bulk_create(Movie, 'movies')
+
+
+LINK_MAX_PAIRS = int(os.getenv('LINK_MAX_PAIRS', 100000))
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) \
+        and value > 0
+
+
+''' Reads the (movie_id, actor_id) pairs of a link request
+
+    The body is a list, or an object holding that list under `key`, of
+    either [movie_id, actor_id] pairs or {"movie_id", "actor_id"} objects.
+    When `movie_id` is given the list holds actor ids instead.
+'''
+
+
+def get_pairs(key, movie_id=None):
+    data = request.get_json()
+    if isinstance(data, dict):
+        data = data.get(key)
+    if not isinstance(data, list) or not data or len(data) > LINK_MAX_PAIRS:
+        abort(400)
+    pairs = []
+    for item in data:
+        if movie_id is not None:
+            pair = (movie_id, item)
+        elif isinstance(item, dict):
+            pair = (item.get('movie_id'), item.get('actor_id'))
+        elif isinstance(item, list) and len(item) == 2:
+            pair = tuple(item)
+        else:
+            abort(400)
+        if not is_id(pair[0]) or not is_id(pair[1]):
+            abort(400)
+        pairs.append(pair)
+    return pairs
+
+
+def change_links(change, pairs, key):
+    try:
+        count = change(pairs)
         return jsonify({
             'success': True,
-            'patched': actor.json()
+            key: count
         }), 200
     except BaseException:
+        db.session.rollback()
         print(sys.exc_info())
         abort(422)
 
 
-@APP.route('/movies', methods=['PATCH'])
+@APP.route('/movies/<int:id>/actors', methods=['POST'])
 @requires_auth('modify:movie')
-def patch_movie():
+@idempotent
+def link_movie_actors(id):
+    return change_links(link, get_pairs('actors', id), 'linked')
+
+
+@APP.route('/movies/<int:id>/actors', methods=['DELETE'])
+@requires_auth('modify:movie')
+def unlink_movie_actors(id):
+    return change_links(unlink, get_pairs('actors', id), 'unlinked')
+
+
+@APP.route('/associations', methods=['POST'])
+@requires_auth('modify:movie')
+@idempotent
+def link_associations():
+    return change_links(link, get_pairs('associations'), 'linked')
+
+
+@APP.route('/associations', methods=['DELETE'])
+@requires_auth('modify:movie')
+def unlink_associations():
+    return change_links(unlink, get_pairs('associations'), 'unlinked')
+
+
+''' (id, values) of one item of a PATCH body, the fields left out or empty
+    being unchanged; raises ValueError with the reason when invalid
+'''
+
+
+def get_changes(model, item):
+    if not isinstance(item, dict) or not is_id(item.get('id')):
+        raise ValueError('id must be a positive integer')
+    return item['id'], model.validate(item, partial=True)
+
+
+''' Changes the rows of a PATCH with one UPDATE (see models.update_rows)
+
+    The body is an object with the id of the row and the fields to
+    change, answered with the changed row under `key`, or a list of such
+    objects. A list is applied in one transaction: the changed rows are
+    returned in request order under "patched", along with the index and
+    reason of every item rejected or not found.
+'''
+
+
+def patch_rows(model, resource, key):
+    data = request.get_json()
+    if isinstance(data, list):
+        return patch_batch(model, resource, data)
+    if not isinstance(data, dict) or data.get('id') is None:
+        abort(400)
     try:
-        data = request.get_json()
-        id = data.get('id', None)
-        if id is None:
-            abort(400)
-        movie = Movie.query.get(id)
-        if data.get('title'):
-            movie.title = data.get('title')
-        if data.get('release_date'):
-            movie.release_date = data.get('release_date')
-        movie.patch()
+        rows = model.bulk_patch([get_changes(model, data)])
+        if not rows:
+            abort(422)
         return jsonify({
             'success': True,
-            'movie': movie.json()
+            key: resource.rows_json(
+                rows, resource.linked_json([rows[0]['id']]))[0]
         }), 200
     except BaseException:
+        db.session.rollback()
         print(sys.exc_info())
         abort(422)
 
 
-@APP.route('/actors/<int:id>', methods=['DELETE'])
-@requires_auth('delete:actor')
-def delete_actor(id):
+def patch_batch(model, resource, data):
+    if not data or len(data) > BULK_MAX_ITEMS:
+        abort(400)
+    changes = []
+    errors = []
+    seen = set()
+    for index, item in enumerate(data):
+        try:
+            id, values = get_changes(model, item)
+            if id in seen:
+                raise ValueError('duplicate id')
+        except ValueError as error:
+            errors.append({'index': index, 'message': str(error)})
+            continue
+        seen.add(id)
+        changes.append((index, id, values))
     try:
-        actor = Actor.query.get(id)
-        actor.delete()
-        return jsonify({
-            'success': True,
-            'deleted': actor.json()
-        })
+        rows = model.bulk_patch([(id, values) for _, id, values in changes])
     except BaseException:
-        if actor is None:
-            abort(404)
+        db.session.rollback()
         print(sys.exc_info())
         abort(422)
+    found = {row['id']: row for row in rows}
+    errors.extend({'index': index, 'message': 'not found'}
+                  for index, id, _ in changes if id not in found)
+    if not found:
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': sorted(errors, key=lambda error: error['index'])
+        }), 422
+    rows = [found[id] for _, id, _ in changes if id in found]
+    return jsonify({
+        'success': True,
+        'patched': resource.rows_json(
+            rows, resource.linked_json(list(found))),
+        'errors': sorted(errors, key=lambda error: error['index'])
+    }), 200
 
 
-@APP.route('/movies/<int:id>', methods=['DELETE'])
-@requires_auth('delete:movie')
-def delete_movie(id):
+@APP.route('/actors', methods=['PATCH'])
+@requires_auth('modify:actor')
+def patch_actor():
+    return patch_rows(Actor, serializer.ACTORS, 'patched')
+
+
+@APP.route('/movies', methods=['PATCH'])
+@requires_auth('modify:movie')
+def patch_movie():
+    return patch_rows(Movie, serializer.MOVIES, 'movie')
+
+
+''' Deletes the rows and their links with a few set-based statements (see
+    models.delete_rows), returning their json() in the order of `ids`,
+    with the links removed in the same transaction
+'''
+
+
+def delete_rows(model, resource, ids):
     try:
-        movie = Movie.query.get(id)
-        movie.delete()
-        return jsonify({
-            'success': True,
-            'deleted': movie.json()
-        })
+        rows, unlinked = model.bulk_delete(ids)
     except BaseException:
-        if movie is None:
-            abort(404)
+        db.session.rollback()
         print(sys.exc_info())
         abort(422)
+    position = {id: index for index, id in enumerate(ids)}
+    rows.sort(key=lambda row: position[row['id']])
+    return resource.rows_json(rows, resource.unlinked_json(unlinked))
+
+
+def delete_one(model, resource, id):
+    deleted = delete_rows(model, resource, [id])
+    if not deleted:
+        abort(404)
+    return jsonify({
+        'success': True,
+        'deleted': deleted[0]
+    })
+
+
+''' DELETE of the rows listed in ?ids=, answered like a PATCH list: the
+    deleted rows under "deleted", and the index in `ids` of every id not
+    found under "errors"
+'''
+
+
+def delete_batch(model, resource):
+    ids = get_ids()
+    deleted = delete_rows(model, resource, list(dict.fromkeys(ids)))
+    found = {row['id'] for row in deleted}
+    errors = [{'index': index, 'message': 'not found'}
+              for index, id in enumerate(ids) if id not in found]
+    if not deleted:
+        return jsonify({
+            'success': False,
+            'error': 404,
+            'message': 'resource not found',
+            'errors': errors
+        }), 404
+    return jsonify({
+        'success': True,
+        'deleted': deleted,
+        'errors': errors
+    })
+
+
+def get_ids():
+    try:
+        ids = [int(id) for id in request.args.get('ids', '').split(',')]
+    except ValueError:
+        abort(400)
+    if len(ids) > BULK_MAX_ITEMS or not all(id > 0 for id in ids):
+        abort(400)
+    return ids
+
+
+@APP.route('/actors/<int:id>', methods=['DELETE'])
+@requires_auth('delete:actor')
+def delete_actor(id):
+    return delete_one(Actor, serializer.ACTORS, id)
+
+
+@APP.route('/actors', methods=['DELETE'])
+@requires_auth('delete:actor')
+def delete_actors():
+    return delete_batch(Actor, serializer.ACTORS)
+
+
+@APP.route('/movies/<int:id>', methods=['DELETE'])
+@requires_auth('delete:movie')
+def delete_movie(id):
+    return delete_one(Movie, serializer.MOVIES, id)
+
+
+@APP.route('/movies', methods=['DELETE'])
+@requires_auth('delete:movie')
+def delete_movies():
+    return delete_batch(Movie, serializer.MOVIES)
+
+
+@APP.route('/metrics')
+@requires_auth('read:metrics')
+def get_metrics():
+    return Response(metrics.render(pool_status(db.engine)),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@APP.route('/metrics/pool')
+@requires_auth('read:metrics')
+def get_pool_metrics():
+    return jsonify({
+        'success': True,
+        'pool': pool_status(db.engine)
+    }), 200
+
+
+''' Profiles saved by requests sent with the X-Profile header '''
+
+
+def get_profile_path(id, extension):
+    if not profiling.is_profile_id(id):
+        abort(404)
+    path = profiling.profile_path(id, extension)
+    if not os.path.exists(path):
+        abort(404)
+    return path
+
+
+@APP.route('/profiles/<id>')
+@requires_auth(profiling.PROFILE_PERMISSION)
+def get_profile(id):
+    return send_file(get_profile_path(id, 'pstats'),
+                     mimetype='application/octet-stream',
+                     as_attachment=True,
+                     attachment_filename=id + '.pstats')
+
+
+@APP.route('/profiles/<id>/sql')
+@requires_auth(profiling.PROFILE_PERMISSION)
+def get_profile_sql(id):
+    with open(get_profile_path(id, 'sql.json')) as sql:
+        statements = json.load(sql)
+    return jsonify({
+        'success': True,
+        'statements': statements
+    }), 200
 
 
 @APP.route('/login')
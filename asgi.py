@@ -0,0 +1,278 @@
+import asyncio
+import itertools
+import json
+import os
+import time
+import httpx
+from databases import Database
+from jose import jwt
+from sqlalchemy import select
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+import app as flask_app
+import metrics
+import ratelimit
+import replicas
+import serializer
+from auth import (
+    AuthError, check_permissions, jwks_store, parse_authorization,
+    token_cache, verify_decode_jwt
+)
+from etag import etag_for, response_cache, versions
+from fieldsets import Fieldset, FieldsetError
+from filters import FilterError, actor_filters, movie_filters
+from jwks import JWKSError
+from models import CollectionVersion, database_path
+from pagination import Page, PaginationError
+from profiling import PROFILE_HEADER
+
+'''
+Asynchronous serving mode
+
+    pip install -r requirements-async.txt
+    uvicorn asgi:app --workers 4
+
+GET /actors and GET /movies, which carry most of the traffic, are served
+by coroutines: the database is read through `databases` (asyncpg on
+Postgres, aiosqlite on SQLite) and the signing keys are downloaded with
+httpx, so a request waiting on either does not hold a thread. They build
+the same statements, ETags and bytes as the Flask handlers, with the same
+response and token caches. With DATABASE_REPLICA_URLS they read from the
+replicas in turn, and leave the requests of the subjects pinned to the
+primary (see replicas.py) to Flask. They take their cost from the rate
+limit of the subject and hold a place of the admission control like any
+other request (see ratelimit.py).
+
+Every other route, and every list request the coroutines do not answer
+themselves (an invalid token or parameter, X-Profile, streaming, an
+error), is passed to the Flask application mounted behind them, which
+runs in a thread pool. Routes, authentication and response bodies are
+therefore the same in both modes.
+'''
+
+ASYNC_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+ASYNC_MAX_POOL_SIZE = ASYNC_POOL_SIZE + int(os.getenv('DB_MAX_OVERFLOW', 10))
+
+
+def database_options(url):
+    if url.startswith('sqlite'):
+        return {}
+    return {'min_size': ASYNC_POOL_SIZE, 'max_size': ASYNC_MAX_POOL_SIZE}
+
+
+database = Database(database_path, **database_options(database_path))
+read_databases = [Database(url, **database_options(url))
+                  for url in replicas.REPLICA_URLS] or [database]
+_next_database = itertools.cycle(read_databases)
+http_client = httpx.AsyncClient()
+wsgi = WSGIMiddleware(flask_app.APP)
+_keys_lock = []
+
+
+def keys_lock():
+    if not _keys_lock:
+        _keys_lock.append(asyncio.Lock())
+    return _keys_lock[0]
+
+
+''' Downloads the signing keys without blocking when verifying `token`
+    would need them. The JWKSStore keeps its caching and rate limiting
+    rules; on failure JWKSError is raised when no usable key is left.
+'''
+
+
+async def refresh_keys(token):
+    try:
+        kid = jwt.get_unverified_header(token).get('kid')
+    except jwt.JWTError:
+        return
+    if not jwks_store.needs_refresh(kid):
+        return
+    async with keys_lock():
+        if not jwks_store.needs_refresh(kid):
+            return
+        if not jwks_store.url.startswith(('http://', 'https://')):
+            await run_in_threadpool(jwks_store.refresh)
+            return
+        try:
+            response = await http_client.get(
+                jwks_store.url, timeout=jwks_store.timeout)
+            response.raise_for_status()
+            document = response.json()
+        except Exception as error:
+            jwks_store.failed(error)
+            return
+        jwks_store.load(document, response.headers.get('Cache-Control'))
+
+
+''' Version of the collection `name` read from `database`, which the body
+    is then read from as well (see etag.VersionCache)
+'''
+
+
+async def collection_version(name, database):
+    version = versions.cached(name, database)
+    if version is None:
+        table = CollectionVersion.__table__
+        version = await database.fetch_val(
+            select([table.c.version]).where(table.c.name == name)) or 0
+        versions.put(name, version, database)
+    return version
+
+
+def wants_stream(request, accept):
+    if request.query_params.get('stream') in ('1', 'true'):
+        return True
+    best = accept.best_match(['application/json', flask_app.NDJSON])
+    return best == flask_app.NDJSON
+
+
+""" GET handler of a collection, falling back to the Flask one for any
+    request it does not answer itself
+"""
+
+
+def error_response(error):
+    return Response(
+        json.dumps(ratelimit.error_body(error)),
+        status_code=error.status_code, media_type='application/json',
+        headers={'Retry-After': ratelimit.retry_after_header(
+            error.retry_after)})
+
+
+class ListEndpoint:
+    def __init__(self, resource, permission, sorts, filters):
+        self.resource = resource
+        self.permission = permission
+        self.sorts = sorts
+        self.filters = filters
+        self.route = '/' + resource.name
+
+    async def __call__(self, scope, receive, send):
+        start = time.perf_counter()
+        admission_token = None
+        if ratelimit.admission.limit > 0:
+            admission_token = ratelimit.admission.acquire()
+        try:
+            if ratelimit.admission.limit > 0 and admission_token is None:
+                response = error_response(ratelimit.RateLimitError(
+                    ratelimit.ADMISSION_RETRY_AFTER, status_code=503))
+            else:
+                response = await self.respond(Request(scope, receive))
+        except ratelimit.RateLimitError as error:
+            response = error_response(error)
+        except Exception:
+            response = None
+        if response is None:
+            # Flask takes its own place
+            if admission_token is not None:
+                ratelimit.admission.release(admission_token)
+            await wsgi(scope, receive, send)
+            return
+        try:
+            await self.finish(response, scope, receive, send, start)
+        finally:
+            if admission_token is not None:
+                ratelimit.admission.release(admission_token)
+
+    async def finish(self, response, scope, receive, send, start):
+        for name, value in flask_app.CORS_HEADERS:
+            response.headers.append(name, value)
+        await response(scope, receive, send)
+        labels = (scope['method'], self.route)
+        metrics.request_seconds.observe(
+            time.perf_counter() - start,
+            labels + (str(response.status_code),))
+        metrics.response_bytes.observe(len(response.body), labels)
+
+    async def respond(self, request):
+        accept = parse_accept_header(request.headers.get('Accept'),
+                                     MIMEAccept)
+        if PROFILE_HEADER in request.headers or \
+                wants_stream(request, accept) or \
+                not flask_app.use_fast_serializer():
+            return None
+        resource = self.resource
+        try:
+            token = parse_authorization(request.headers.get('Authorization'))
+            await refresh_keys(token)
+            payload, permissions = token_cache.verify(
+                token, verify_decode_jwt)
+            check_permissions(self.permission, permissions)
+            if replicas.engines and replicas.is_pinned(payload.get('sub')):
+                return None
+            args = request.query_params
+            fieldset = Fieldset(args, resource.model, resource.relationship)
+            page = Page(args, resource.table.c.id, self.sorts)
+            filters = self.filters(args)
+        except (AuthError, JWKSError, FieldsetError, PaginationError,
+                FilterError):
+            return None
+        # only once the request is answered here, Flask charges the others
+        ratelimit.limiter.charge(
+            payload.get('sub'), ratelimit.route_cost('get_' + resource.name))
+
+        database = next(_next_database)
+        etag = etag_for(
+            resource.name, await collection_version(resource.name, database),
+            request.query_params.multi_items(), accept.to_header())
+        headers = {'ETag': quote_etag(etag)}
+        if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+            return Response(status_code=304, headers=headers)
+        body = response_cache.get(etag)
+        if body is None:
+            body = await self.list_body(database, fieldset, page, filters)
+            response_cache.set(etag, body)
+        return Response(body, media_type='application/json', headers=headers)
+
+    async def list_body(self, database, fieldset, page, filters):
+        resource = self.resource
+        names, query = serializer.list_query(
+            resource, fieldset, page, filters)
+        rows, next_cursor = serializer.split_page(
+            page, names, await database.fetch_all(query))
+        linked = None
+        if fieldset.expand:
+            ids = [row[0] for row in rows]
+            linked = {}
+            if ids:
+                linked = resource.group_linked(
+                    await database.fetch_all(resource.linked_query(ids)))
+        items = resource.encode_rows(rows, fieldset, names, linked)
+        return serializer.encode_list(resource, items, next_cursor)
+
+
+async def startup():
+    await database.connect()
+    for read_database in read_databases:
+        if read_database is not database:
+            await read_database.connect()
+
+
+async def shutdown():
+    for read_database in read_databases:
+        if read_database is not database:
+            await read_database.disconnect()
+    await database.disconnect()
+    await http_client.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route('/actors', ListEndpoint(
+            serializer.ACTORS, 'read:actor', flask_app.ACTOR_SORTS,
+            actor_filters), methods=['GET']),
+        Route('/movies', ListEndpoint(
+            serializer.MOVIES, 'read:movie', flask_app.MOVIE_SORTS,
+            movie_filters), methods=['GET']),
+        Mount('/', app=wsgi),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
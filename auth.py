@@ -1,29 +1,59 @@
-import json
 import os
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from jwks import JWKSStore, JWKSError
+from metrics import jwt_verify_seconds, timed
+import profiling
+import ratelimit
+from token_cache import TokenCache
 
 
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.getenv('API_AUDIENCE')
+JWKS_URL = os.getenv(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+'''
+Signing keys are shared by every request handled by this process,
+see jwks.JWKSStore for the caching rules
+'''
+jwks_store = JWKSStore(
+    JWKS_URL,
+    ttl=int(os.getenv('JWKS_TTL', 600)),
+    min_refresh_interval=int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', 30)),
+    stale_if_error=int(os.getenv('JWKS_STALE_IF_ERROR', 86400)),
+    timeout=float(os.getenv('JWKS_TIMEOUT', 5)))
+
+'''
+Verified tokens, see token_cache.TokenCache
+'''
+token_cache = TokenCache(
+    maxsize=int(os.getenv('TOKEN_CACHE_SIZE', 4096)),
+    negative_maxsize=int(os.getenv('TOKEN_NEGATIVE_CACHE_SIZE', 256)),
+    negative_ttl=int(os.getenv('TOKEN_NEGATIVE_CACHE_TTL', 30)))
 
 '''
 AuthError Exception
-A standardized way to communicate auth failure modes
+A standardized way to communicate auth failure modes. An error raised
+with cacheable=False is not remembered by the token cache, see
+token_cache.py.
 '''
 
 
 class AuthError(Exception):
-    def __init__(self, error, status_code):
+    def __init__(self, error, status_code, cacheable=True):
         self.error = error
         self.status_code = status_code
+        self.cacheable = cacheable
 
 
 def get_token_auth_header():
-    auth = request.headers.get('Authorization')
+    return parse_authorization(request.headers.get('Authorization'))
+
+
+def parse_authorization(auth):
     if auth is None:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -43,8 +73,8 @@ def get_token_auth_header():
     return auth_parts[1]
 
 
-def check_permissions(permission, payload):
-    if permission not in payload.get('permissions', []):
+def check_permissions(permission, permissions):
+    if permission not in permissions:
         raise AuthError({
             'code': 'permission_missing',
             'description':
@@ -53,20 +83,31 @@ def check_permissions(permission, payload):
     return True
 
 
+@timed(jwt_verify_seconds)
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+    try:
+        key = jwks_store.get_key(unverified_header.get('kid'))
+    except JWKSError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
     rsa_key = {}
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    if key:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -96,11 +137,14 @@ def verify_decode_jwt(token):
     raise AuthError({
         'code': 'invalid_header',
                 'description': 'Unable to find the appropriate key.'
-    }, 400)
+    }, 400, cacheable=False)
 
 
 """ Custom decorator that requires Auth0 authentication and checks
-for required permissions """
+for required permissions, then charges the request to the rate limit
+of the subject, see ratelimit.py. Requests sent with the X-Profile
+header also need the profiling permission and are profiled, see
+profiling.py """
 
 
 def requires_auth(permission=''):
@@ -108,8 +152,14 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload, permissions = token_cache.verify(
+                token, verify_decode_jwt)
+            check_permissions(permission, permissions)
+            _request_ctx_stack.top.current_user = payload
+            ratelimit.charge(payload.get('sub'))
+            if profiling.PROFILE_HEADER in request.headers:
+                check_permissions(profiling.PROFILE_PERMISSION, permissions)
+                return profiling.profile(f, *args, **kwargs)
             return f(*args, **kwargs)
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,123 @@
+import argparse
+import json
+import random
+import time
+from sqlalchemy import (
+    Column, ForeignKey, Index, Integer, MetaData, PrimaryKeyConstraint,
+    String, Table, create_engine, select
+)
+
+'''
+Relationship-load time on the Association table, before and after the
+keys added by migration 7c1baa795ec5
+
+Two copies of the table are filled with the same links: one with the
+original schema (nullable columns, no keys) and one with the composite
+primary key on (movie_id, actor_id) and the (actor_id, movie_id) index.
+The benchmark then times the queries the ORM sends to load Actor.movies
+and Movie.actors.
+
+    python -m benchmarks.association_load --links 1000000
+    python -m benchmarks.association_load --database-url postgresql://...
+
+The tables are created with a "bench_" prefix and dropped at the end.
+'''
+
+metadata = MetaData()
+
+actor = Table('bench_actor', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('name', String(200), nullable=False))
+
+movie = Table('bench_movie', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('title', String, nullable=False))
+
+legacy = Table('bench_association_legacy', metadata,
+               Column('movie_id', Integer, ForeignKey('bench_movie.id')),
+               Column('actor_id', Integer, ForeignKey('bench_actor.id')))
+
+keyed = Table('bench_association_keyed', metadata,
+              Column('movie_id', Integer,
+                     ForeignKey('bench_movie.id', ondelete='CASCADE'),
+                     nullable=False),
+              Column('actor_id', Integer,
+                     ForeignKey('bench_actor.id', ondelete='CASCADE'),
+                     nullable=False),
+              PrimaryKeyConstraint('movie_id', 'actor_id'),
+              Index('ix_bench_association_actor_id_movie_id',
+                    'actor_id', 'movie_id'))
+
+
+def fill(connection, actors, movies, links, rng, chunk_size=10000):
+    connection.execute(actor.insert(), [
+        {'id': i, 'name': 'actor %d' % i} for i in range(1, actors + 1)])
+    connection.execute(movie.insert(), [
+        {'id': i, 'title': 'movie %d' % i} for i in range(1, movies + 1)])
+    pairs = set()
+    while len(pairs) < links:
+        pairs.add((rng.randint(1, movies), rng.randint(1, actors)))
+    pairs = [{'movie_id': m, 'actor_id': a} for m, a in pairs]
+    for table in (legacy, keyed):
+        for start in range(0, len(pairs), chunk_size):
+            connection.execute(table.insert(),
+                               pairs[start:start + chunk_size])
+
+
+def time_loads(connection, association, lookups):
+    movies_of = select([movie]).where(
+        movie.c.id == association.c.movie_id)
+    actors_of = select([actor]).where(
+        actor.c.id == association.c.actor_id)
+    timings = {}
+    for name, query, column, ids in (
+            ('actor.movies', movies_of, association.c.actor_id,
+             lookups['actors']),
+            ('movie.actors', actors_of, association.c.movie_id,
+             lookups['movies'])):
+        start = time.perf_counter()
+        for id in ids:
+            connection.execute(query.where(column == id)).fetchall()
+        elapsed = time.perf_counter() - start
+        timings[name] = round(elapsed / len(ids) * 1000, 3)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Association relationship-load benchmark')
+    parser.add_argument('--database-url', default='sqlite://')
+    parser.add_argument('--links', type=int, default=1000000)
+    parser.add_argument('--actors', type=int, default=100000)
+    parser.add_argument('--movies', type=int, default=50000)
+    parser.add_argument('--lookups', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    engine = create_engine(args.database_url)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    try:
+        with engine.begin() as connection:
+            fill(connection, args.actors, args.movies, args.links, rng)
+        lookups = {
+            'actors': [rng.randint(1, args.actors)
+                       for _ in range(args.lookups)],
+            'movies': [rng.randint(1, args.movies)
+                       for _ in range(args.lookups)],
+        }
+        with engine.connect() as connection:
+            report = {
+                'links': args.links,
+                'unit': 'ms per relationship load',
+                'legacy': time_loads(connection, legacy, lookups),
+                'keyed': time_loads(connection, keyed, lookups),
+            }
+        print(json.dumps(report, indent=2))
+    finally:
+        metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import json
+import random
+import time
+
+'''
+Co-star graph at scale, without a database
+
+Generates the links of a synthetic catalog with the power laws of flask
+seed, builds the graph from them, and times co-star lookups, shortest
+path queries between random actors, and similar movies and actors
+computed without the cache. The report gives the build time, the size of
+the arrays and the latency percentiles as JSON.
+
+    python -m benchmarks.graph --actors 1000000 --movies 200000 \\
+        --links 3000000
+'''
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+
+    def at(fraction):
+        index = max(int(round(fraction * len(latencies))) - 1, 0)
+        return round(latencies[index] * 1000, 3)
+    return {'p50_ms': at(0.5), 'p95_ms': at(0.95), 'p99_ms': at(0.99),
+            'max_ms': round(latencies[-1] * 1000, 3)}
+
+
+def timed(function, arguments):
+    latencies = []
+    results = []
+    for args in arguments:
+        start = time.perf_counter()
+        results.append(function(*args))
+        latencies.append(time.perf_counter() - start)
+    return results, percentiles(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Co-star graph benchmark')
+    parser.add_argument('--actors', type=int, default=1000000)
+    parser.add_argument('--movies', type=int, default=200000)
+    parser.add_argument('--links', type=int, default=3000000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--max-depth', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from graph import Graph
+    from seed import link_rows
+    import similar
+
+    rng = random.Random(args.seed)
+    actor_ids = range(1, args.actors + 1)
+    start = time.perf_counter()
+    pairs = [(row['movie_id'], row['actor_id']) for row in link_rows(
+        rng, range(1, args.movies + 1), actor_ids, args.links)]
+    generate_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    graph = Graph.from_links(pairs)
+    build_seconds = time.perf_counter() - start
+    linked = list(graph.actors.ids)
+    cast = list(graph.movies.ids)
+
+    sources = [(rng.choice(linked),) for _ in range(args.queries)]
+    costars, costar_latency = timed(graph.costars, sources)
+    routes = [(rng.choice(linked), rng.choice(linked), args.max_depth)
+              for _ in range(args.queries)]
+    paths, path_latency = timed(graph.path, routes)
+    similar_movies, similar_movie_latency = timed(similar.similar, [
+        (graph, similar.MOVIES, rng.choice(cast))
+        for _ in range(args.queries)])
+    similar_actors, similar_actor_latency = timed(similar.similar, [
+        (graph, similar.ACTORS, rng.choice(linked))
+        for _ in range(args.queries)])
+    degrees = {}
+    for path in paths:
+        key = 'none' if path is None else str(len(path) // 2)
+        degrees[key] = degrees.get(key, 0) + 1
+
+    print(json.dumps({
+        'actors': args.actors,
+        'movies': args.movies,
+        'links': len(pairs),
+        'generate_seconds': round(generate_seconds, 2),
+        'build_seconds': round(build_seconds, 2),
+        'graph_megabytes': round(graph.nbytes() / 2 ** 20, 1),
+        'costars': dict(costar_latency, mean_results=round(
+            sum(map(len, costars)) / len(costars), 1)),
+        'path': dict(path_latency, degrees=degrees),
+        'similar_movies': dict(similar_movie_latency, mean_results=round(
+            sum(map(len, similar_movies)) / len(similar_movies), 1)),
+        'similar_actors': dict(similar_actor_latency, mean_results=round(
+            sum(map(len, similar_actors)) / len(similar_actors), 1)),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+'''
+Load test of every route of the API, without Auth0
+
+Tokens are minted by the local issuer of benchmarks.tokens. By default the
+application runs in this process, behind a threaded werkzeug server, on a
+temporary SQLite database (or on --database); the catalog is seeded
+through the bulk endpoints at the requested scale. Each endpoint then gets
+--requests requests from --concurrency keep-alive connections, one
+endpoint after the other, and the report gives the throughput and the
+latency percentiles of each one as JSON.
+
+    python -m benchmarks.load --scale 10000 --concurrency 8
+
+To load a separately started server, e.g. under gunicorn, share the key
+pair of the issuer and point the server at its JWKS:
+
+    BENCHMARK_KEY_FILE=bench.pem python -m benchmarks.tokens --port 8765
+    (start the server with the variables printed above)
+    BENCHMARK_KEY_FILE=bench.pem python -m benchmarks.load \\
+        --url http://127.0.0.1:8000
+'''
+
+SEED_CHUNK = 10000
+NAMES = ['Ana', 'Bruno', 'Carla', 'Diego', 'Elena', 'Fábio', 'Grace',
+         'Hiro', 'Ines', 'José']
+
+
+def start_server(database):
+    os.environ['DATABASE_URL'] = database
+    os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark')
+    from werkzeug.serving import make_server
+    import app
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    from models import db
+    with app.APP.app_context():
+        db.create_all()
+    server = make_server('127.0.0.1', 0, app.APP, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+class Client:
+    def __init__(self, url, token):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.headers = {'Authorization': 'Bearer ' + token,
+                        'Content-Type': 'application/json'}
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=60)
+        if body is not None:
+            body = json.dumps(body)
+        try:
+            self.connection.request(
+                method, path, body, dict(self.headers, **(headers or {})))
+            response = self.connection.getresponse()
+            return response.status, response.getheaders(), response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+
+    def json(self, method, path, body=None):
+        status, _, data = self.request(method, path, body)
+        if status >= 400:
+            raise SystemExit('{} {} failed with {}'.format(
+                method, path, status))
+        return json.loads(data)
+
+
+def actor(rng, index):
+    return {'name': '{} {}'.format(rng.choice(NAMES), index),
+            'age': rng.randint(1, 99),
+            'gender': rng.choice(['F', 'M', 'X'])}
+
+
+def movie(rng, index):
+    release = datetime(1920, 1, 1) + timedelta(
+        seconds=rng.randint(0, 3 * 10 ** 9))
+    return {'title': 'Movie {} {}'.format(rng.choice(NAMES), index),
+            'release_date': release.isoformat(' ')}
+
+
+def stream_ids(client, collection):
+    _, _, data = client.request(
+        'GET', '/{}?fields=id&stream=1'.format(collection))
+    return [json.loads(line)['id'] for line in data.splitlines()]
+
+
+''' Seeds the catalog through the bulk endpoints and returns the actor and
+    movie ids. With 0 rows of a kind, the ids already there are used.
+'''
+
+
+def seed(client, args, rng):
+    ids = {}
+    for collection, count, make in (('actors', args.actors, actor),
+                                    ('movies', args.movies, movie)):
+        ids[collection] = []
+        for start in range(0, count, SEED_CHUNK):
+            rows = [make(rng, index) for index in
+                    range(start, min(start + SEED_CHUNK, count))]
+            ids[collection].extend(client.json(
+                'POST', '/{}/bulk'.format(collection), rows)['created'])
+        if not ids[collection]:
+            ids[collection] = stream_ids(client, collection)
+        if not ids[collection]:
+            raise SystemExit('No {} to load'.format(collection))
+    for start in range(0, args.links, SEED_CHUNK):
+        pairs = [[rng.choice(ids['movies']), rng.choice(ids['actors'])]
+                 for _ in range(min(SEED_CHUNK, args.links - start))]
+        client.json('POST', '/associations', pairs)
+    return ids['actors'], ids['movies']
+
+
+""" One endpoint under load
+
+    `request(i)` returns the (method, path, body, headers) of the i-th
+    request and `check(i, status, data)`, when given, sees its response.
+"""
+
+
+class Scenario:
+    def __init__(self, name, request, check=None):
+        self.name = name
+        self.request = request
+        self.check = check
+
+
+def percentile(latencies, fraction):
+    index = max(int(round(fraction * len(latencies))) - 1, 0)
+    return round(latencies[index] * 1000, 3)
+
+
+def run(scenario, url, token, count, concurrency):
+    indexes = itertools.count()
+    latencies = []
+    errors = []
+
+    def worker():
+        client = Client(url, token)
+        while True:
+            i = next(indexes)
+            if i >= count:
+                return
+            method, path, body, headers = scenario.request(i)
+            start = time.perf_counter()
+            try:
+                status, _, data = client.request(method, path, body, headers)
+            except (OSError, http.client.HTTPException):
+                errors.append(i)
+                continue
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors.append(i)
+            elif scenario.check is not None:
+                scenario.check(i, status, data)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    result = {'requests': count, 'errors': len(errors),
+              'rps': round(count / elapsed, 1)}
+    if latencies:
+        result.update({'p50_ms': percentile(latencies, 0.5),
+                       'p95_ms': percentile(latencies, 0.95),
+                       'p99_ms': percentile(latencies, 0.99),
+                       'max_ms': round(latencies[-1] * 1000, 3)})
+    return result
+
+
+def scenarios(client, actor_ids, movie_ids, count, seed):
+    def rng(i):
+        return random.Random(seed * 1000003 + i)
+
+    def get(path, headers=None):
+        return lambda i: ('GET', path, None, headers)
+
+    _, headers, data = client.request('GET', '/movies')
+    etag = dict(headers).get('ETag')
+    cursor = json.loads(data)['next_cursor']
+    _, headers, _ = client.request('GET', '/movies?limit=1',
+                                   headers={'X-Profile': '1'})
+    profile_id = dict(headers).get('X-Profile-Id')
+
+    created = {'actors': [None] * count, 'movies': [None] * count}
+
+    def remember(collection):
+        def check(i, status, data):
+            created[collection][i] = json.loads(data)['created']
+        return check
+
+    def delete(collection):
+        def request(i):
+            id = created[collection][i] or 0
+            return 'DELETE', '/{}/{}'.format(collection, id), None, None
+        return request
+
+    def get_random(path, *ids):
+        def request(i):
+            r = rng(i)
+            args = [r.choice(choices) for choices in ids]
+            return 'GET', path.format(*args), None, None
+        return request
+
+    def pair(i):
+        r = rng(i)
+        return [r.choice(movie_ids), r.choice(actor_ids)]
+
+    def cast(i):
+        r = rng(i)
+        return r.choice(movie_ids), r.sample(actor_ids, min(5, len(actor_ids)))
+
+    def post_cast(method):
+        def request(i):
+            movie_id, actors = cast(i)
+            return (method, '/movies/{}/actors'.format(movie_id),
+                    actors, None)
+        return request
+
+    return [
+        Scenario('GET /', get('/')),
+        Scenario('GET /actors', get('/actors')),
+        Scenario('GET /actors sort=name', get('/actors?sort=name')),
+        Scenario('GET /actors filtered', get(
+            '/actors?name=an&age_min=20&age_max=60')),
+        Scenario('GET /actors fields=id,name',
+                 get('/actors?fields=id,name')),
+        Scenario('GET /movies', get('/movies')),
+        Scenario('GET /movies next page', get(
+            '/movies?cursor={}'.format(cursor) if cursor else '/movies')),
+        Scenario('GET /movies sort=release_date',
+                 get('/movies?sort=release_date&order=desc')),
+        Scenario('GET /movies title_contains', get(
+            '/movies?title_contains=ana')),
+        Scenario('GET /movies If-None-Match', get(
+            '/movies', {'If-None-Match': etag} if etag else None)),
+        Scenario('GET /movies stream', get('/movies?stream=1&expand=')),
+        Scenario('GET /stats/actors', get('/stats/actors')),
+        Scenario('GET /stats/movies', get('/stats/movies')),
+        Scenario('GET /actors/<id>/costars', get_random(
+            '/actors/{}/costars', actor_ids)),
+        Scenario('GET /actors/<id>/path/<id>', get_random(
+            '/actors/{}/path/{}', actor_ids, actor_ids)),
+        Scenario('GET /movies/<id>/similar', get_random(
+            '/movies/{}/similar', movie_ids)),
+        Scenario('GET /actors/<id>/similar', get_random(
+            '/actors/{}/similar', actor_ids)),
+        Scenario('POST /actors', lambda i: (
+            'POST', '/actors', actor(rng(i), i), None), remember('actors')),
+        Scenario('POST /movies', lambda i: (
+            'POST', '/movies', movie(rng(i), i), None), remember('movies')),
+        Scenario('POST /actors/bulk', lambda i: (
+            'POST', '/actors/bulk',
+            [actor(rng(i), j) for j in range(100)], None)),
+        Scenario('POST /movies/bulk', lambda i: (
+            'POST', '/movies/bulk',
+            [movie(rng(i), j) for j in range(100)], None)),
+        Scenario('PATCH /actors', lambda i: (
+            'PATCH', '/actors', {'id': rng(i).choice(actor_ids),
+                                 'age': rng(i).randint(1, 99)}, None)),
+        Scenario('PATCH /movies', lambda i: (
+            'PATCH', '/movies', {'id': rng(i).choice(movie_ids),
+                                 'title': 'Patched {}'.format(i)}, None)),
+        Scenario('PATCH /actors batch of 20', lambda i: (
+            'PATCH', '/actors',
+            [{'id': id, 'age': rng(i).randint(1, 99)} for id in
+             rng(i).sample(actor_ids, min(20, len(actor_ids)))], None)),
+        Scenario('POST /movies/<id>/actors', post_cast('POST')),
+        Scenario('DELETE /movies/<id>/actors', post_cast('DELETE')),
+        Scenario('POST /associations', lambda i: (
+            'POST', '/associations', [pair(i)], None)),
+        Scenario('DELETE /associations', lambda i: (
+            'DELETE', '/associations', [pair(i)], None)),
+        Scenario('DELETE /actors/<id>', delete('actors')),
+        Scenario('DELETE /movies/<id>', delete('movies')),
+        Scenario('GET /metrics', get('/metrics')),
+        Scenario('GET /metrics/pool', get('/metrics/pool')),
+        Scenario('GET /profiles/<id>', get(
+            '/profiles/{}'.format(profile_id))),
+        Scenario('GET /profiles/<id>/sql', get(
+            '/profiles/{}/sql'.format(profile_id))),
+        Scenario('GET /login', get('/login')),
+        Scenario('GET /logout', get('/logout')),
+        Scenario('GET /callback', get('/callback')),
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='API load benchmark')
+    parser.add_argument('--url', help='server to load, instead of running '
+                        'the application in this process')
+    parser.add_argument('--database', help='database of the application '
+                        'run in this process, a temporary SQLite file by '
+                        'default')
+    parser.add_argument('--scale', type=int, default=1000,
+                        help='actors and movies to seed')
+    parser.add_argument('--actors', type=int)
+    parser.add_argument('--movies', type=int)
+    parser.add_argument('--links', type=int,
+                        help='associations to seed, 3 per movie by default')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--only', help='run the endpoints whose name '
+                        'contains this text')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the report to')
+    args = parser.parse_args()
+    for name in ('actors', 'movies'):
+        if getattr(args, name) is None:
+            setattr(args, name, args.scale)
+    if args.links is None:
+        args.links = 3 * args.movies
+
+    from benchmarks.tokens import issuer
+    token = issuer.mint()
+    database = None
+    url = args.url
+    if url is None:
+        if args.database is None:
+            database = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+            database.close()
+            args.database = 'sqlite:///' + database.name
+        url = start_server(args.database)
+
+    client = Client(url, token)
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    actor_ids, movie_ids = seed(client, args, rng)
+    report = {
+        'commit': git_commit(),
+        'url': args.url,
+        'database': None if args.url else args.database.split(':')[0],
+        'actors': args.actors,
+        'movies': args.movies,
+        'links': args.links,
+        'concurrency': args.concurrency,
+        'seed_seconds': round(time.perf_counter() - start, 1),
+        'endpoints': {},
+    }
+    for scenario in scenarios(client, actor_ids, movie_ids, args.requests,
+                              args.seed):
+        if args.only and args.only not in scenario.name:
+            continue
+        report['endpoints'][scenario.name] = run(
+            scenario, url, token, args.requests, args.concurrency)
+    if database is not None:
+        os.remove(database.name)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
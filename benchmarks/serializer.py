@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+'''
+Rows per second of the list endpoints' two read paths: ORM objects
+serialized with json() and jsonify(), and Core column tuples encoded by
+the fast serializer. Both bodies are compared byte for byte first.
+
+    python -m benchmarks.serializer --actors 20000 --movies 5000
+'''
+
+
+def seed(db, Actor, Movie, link, args, rng):
+    names = ['Ana', 'Bruno', 'Zoë', 'Łukasz', 'O"Neil', 'back\\slash',
+             'tab\there', 'José', '山田', 'Ünal']
+    actors = [{'name': '{} {}'.format(rng.choice(names), i),
+               'age': rng.choice([None, rng.randint(1, 99)]),
+               'gender': rng.choice([None, 'F', 'M', 'X'])}
+              for i in range(args.actors)]
+    start = datetime(1920, 1, 1)
+    movies = [{'title': 'Movie {} {}'.format(rng.choice(names), i),
+               'release_date': start + timedelta(
+                   seconds=rng.randint(0, 3 * 10 ** 9),
+                   microseconds=rng.choice([0, rng.randint(0, 999999)]))}
+              for i in range(args.movies)]
+    actor_ids = Actor.bulk_create(actors)
+    movie_ids = Movie.bulk_create(movies)
+    link((rng.choice(movie_ids), rng.choice(actor_ids))
+         for _ in range(args.links))
+
+
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return body, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List serializer benchmark')
+    parser.add_argument('--actors', type=int, default=20000)
+    parser.add_argument('--movies', type=int, default=5000)
+    parser.add_argument('--links', type=int, default=60000)
+    parser.add_argument('--page', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    database = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    database.close()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database.name
+    os.environ['MAX_PAGE_SIZE'] = str(max(args.page, 1000))
+    from benchmarks.tokens import issuer  # noqa: F401
+    import app
+    import serializer
+    from fieldsets import Fieldset
+    from flask import jsonify
+    from models import db, Actor, Movie, link
+    from pagination import Page
+
+    report = {'page': args.page, 'unit': 'rows per second'}
+    with app.APP.test_request_context():
+        db.create_all()
+        seed(db, Actor, Movie, link, args, random.Random(args.seed))
+        for resource, model, sorts in (
+                (serializer.ACTORS, Actor, app.ACTOR_SORTS),
+                (serializer.MOVIES, Movie, app.MOVIE_SORTS)):
+            for label, query_args in (
+                    ('full', {}),
+                    ('fields', {'fields': 'id,' + model.FIELDS[1]})):
+                query_args = dict(query_args, limit=args.page)
+                page = Page(query_args, model.__table__.c.id, sorts)
+                fieldset = Fieldset(
+                    query_args, model, resource.relationship)
+
+                def orm():
+                    query = model.query.options(*fieldset.options('id'))
+                    rows, next_cursor = page.split(page.apply(query))
+                    body = jsonify({
+                        'success': True,
+                        resource.name: list(map(fieldset.json, rows)),
+                        'next_cursor': next_cursor
+                    }).get_data()
+                    db.session.expunge_all()
+                    return body
+
+                def fast():
+                    return serializer.list_body(resource, fieldset, page, [])
+
+                orm_body, orm_time = measure(orm, args.repeat)
+                fast_body, fast_time = measure(fast, args.repeat)
+                if orm_body != fast_body:
+                    raise SystemExit(
+                        'Bodies differ for {} {}'.format(resource.name, label))
+                rows = len(json.loads(fast_body)[resource.name])
+                report['{} {}'.format(resource.name, label)] = {
+                    'orm': round(rows / orm_time),
+                    'fast': round(rows / fast_time),
+                    'speedup': round(orm_time / fast_time, 1),
+                }
+    os.remove(database.name)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
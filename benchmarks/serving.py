@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+import httpx
+
+'''
+Sync workers against the asynchronous serving mode
+
+Seeds a temporary SQLite database (or uses --database), then starts the
+API twice in turn: under gunicorn with sync workers (`gunicorn app:APP`)
+and under uvicorn (`uvicorn asgi:app`), with the same number of worker
+processes. Each server gets --concurrency clients, each one sending list
+requests in a loop for --duration seconds, and the report gives the
+throughput and latency percentiles of both as JSON.
+
+    python -m benchmarks.serving --workers 2 --concurrency 500
+
+Needs gunicorn and the packages of requirements-async.txt.
+'''
+
+URLS = ['/movies', '/actors', '/movies?sort=release_date&limit=20',
+        '/actors?fields=id,name&sort=name', '/movies?title_contains=river',
+        '/actors?age_min=30&age_max=40']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command(mode, port, workers):
+    bind = '127.0.0.1:{}'.format(port)
+    if mode == 'sync':
+        return ['gunicorn', 'app:APP', '--workers',
+                str(workers), '--bind', bind, '--backlog', '4096',
+                '--config', 'gunicorn.conf.py']
+    return ['uvicorn', 'asgi:app', '--workers',
+            str(workers), '--port', str(port), '--backlog', '4096',
+            '--no-access-log']
+
+
+def wait_until_up(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('The server exited with {}'.format(
+                process.returncode))
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit('The server did not start')
+
+
+''' Stops the server and its workers, which are in their own session, the
+    uvicorn supervisor not always exiting on SIGTERM
+'''
+
+
+def stop(process, timeout=10):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def percentile(latencies, fraction):
+    index = max(int(round(fraction * len(latencies))) - 1, 0)
+    return round(latencies[index] * 1000, 3)
+
+
+async def load(url, token, concurrency, duration):
+    latencies = []
+    errors = [0]
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    headers = {'Authorization': 'Bearer ' + token}
+    async with httpx.AsyncClient(base_url=url, headers=headers,
+                                 limits=limits, timeout=60) as client:
+        deadline = time.perf_counter() + duration
+
+        async def client_loop(index):
+            while time.perf_counter() < deadline:
+                path = URLS[index % len(URLS)]
+                index += 1
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                except httpx.HTTPError:
+                    errors[0] += 1
+                    continue
+                if response.status_code != 200:
+                    errors[0] += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    result = {'requests': len(latencies), 'errors': errors[0],
+              'rps': round(len(latencies) / elapsed, 1)}
+    if latencies:
+        result.update({'p50_ms': percentile(latencies, 0.5),
+                       'p95_ms': percentile(latencies, 0.95),
+                       'p99_ms': percentile(latencies, 0.99),
+                       'max_ms': round(latencies[-1] * 1000, 3)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Sync workers against the ASGI serving mode')
+    parser.add_argument('--database', help='database shared by both '
+                        'servers, a seeded temporary SQLite file by default')
+    parser.add_argument('--actors', type=int, default=20000)
+    parser.add_argument('--movies', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--modes', default='sync,async')
+    args = parser.parse_args()
+
+    from benchmarks.tokens import issuer
+    database = None
+    if args.database is None:
+        database = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        database.close()
+        args.database = 'sqlite:///' + database.name
+        os.environ['DATABASE_URL'] = args.database
+        import app
+        from models import db
+        from seed import seed_catalog
+        with app.APP.app_context():
+            db.create_all()
+            seed_catalog(args.actors, args.movies, 10 * args.movies)
+
+    environment = dict(os.environ, DATABASE_URL=args.database,
+                       JWKS_URL=issuer.serve_jwks(),
+                       FLASK_SECRET_KEY='benchmark')
+    token = issuer.mint()
+    report = {'workers': args.workers, 'concurrency': args.concurrency,
+              'duration': args.duration, 'modes': {}}
+    for mode in args.modes.split(','):
+        port = free_port()
+        url = 'http://127.0.0.1:{}'.format(port)
+        process = subprocess.Popen(
+            server_command(mode, port, args.workers), env=environment,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True)
+        try:
+            wait_until_up(port, process)
+            asyncio.run(load(url, token, 1, 1))
+            report['modes'][mode] = asyncio.run(load(
+                url, token, args.concurrency, args.duration))
+        finally:
+            stop(process)
+    if database is not None:
+        os.remove(database.name)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
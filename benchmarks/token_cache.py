@@ -0,0 +1,56 @@
+import argparse
+import json
+import time
+from benchmarks.tokens import issuer
+import auth
+
+'''
+Verification cost per request, with and without the verified-token cache
+
+    python -m benchmarks.token_cache --requests 2000
+'''
+
+
+def per_request(function, token, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        function(token)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Token verification microbenchmark')
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    token = issuer.mint()
+    auth.jwks_store.get_key(issuer.kid)
+    auth.token_cache.clear()
+
+    uncached = per_request(auth.verify_decode_jwt, token, args.requests)
+    cached = per_request(
+        lambda t: auth.token_cache.verify(t, auth.verify_decode_jwt),
+        token, args.requests)
+    garbage = 'not.a.token'
+
+    def reject(t):
+        try:
+            auth.token_cache.verify(t, auth.verify_decode_jwt)
+        except auth.AuthError:
+            pass
+    rejected = per_request(reject, garbage, args.requests)
+
+    print(json.dumps({
+        'requests': args.requests,
+        'uncached_us': round(uncached * 1e6, 2),
+        'cached_us': round(cached * 1e6, 2),
+        'rejected_us': round(rejected * 1e6, 2),
+        'saved_us_per_request': round((uncached - cached) * 1e6, 2),
+        'speedup': round(uncached / cached, 1),
+        'cache': auth.token_cache.stats(),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
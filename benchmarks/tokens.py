@@ -0,0 +1,155 @@
+import argparse
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+'''
+Local stand-in for Auth0
+Generates an RSA key pair, writes the matching JWKS document to a file and
+mints RS256 access tokens, so the API can be exercised without network
+access. Import this module before `auth` (or `app`): it points the
+AUTH0_DOMAIN, API_AUDIENCE and JWKS_URL variables at the local issuer.
+
+For a server running in another process, share the key pair through
+BENCHMARK_KEY_FILE and serve the JWKS over HTTP:
+
+    BENCHMARK_KEY_FILE=bench.pem python -m benchmarks.tokens --port 8765
+'''
+
+DOMAIN = 'benchmark.local'
+AUDIENCE = 'capstone-benchmark'
+KID = 'benchmark-key'
+
+ALL_PERMISSIONS = [
+    'read:metrics', 'profile:api',
+    'read:actor', 'read:movie',
+    'add:actor', 'add:movie',
+    'modify:actor', 'modify:movie',
+    'delete:actor', 'delete:movie',
+]
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def load_key(key_file):
+    if key_file and os.path.exists(key_file):
+        with open(key_file, 'rb') as pem:
+            return serialization.load_pem_private_key(
+                pem.read(), password=None, backend=default_backend())
+    key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend())
+    if key_file:
+        with open(key_file, 'wb') as pem:
+            pem.write(key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()))
+    return key
+
+
+class LocalIssuer:
+    def __init__(self, domain=DOMAIN, audience=AUDIENCE, kid=KID,
+                 key_file=None):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        key = load_key(key_file)
+        self.private_pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()).decode('ascii')
+        numbers = key.public_key().public_numbers()
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': _b64(numbers.n),
+            'e': _b64(numbers.e),
+        }]}
+        jwks_file = tempfile.NamedTemporaryFile(
+            'w', suffix='.json', prefix='jwks-', delete=False)
+        with jwks_file:
+            json.dump(self.jwks, jwks_file)
+        self.jwks_path = jwks_file.name
+
+    @property
+    def jwks_url(self):
+        return 'file://' + self.jwks_path
+
+    def configure_environment(self):
+        os.environ['AUTH0_DOMAIN'] = self.domain
+        os.environ['API_AUDIENCE'] = self.audience
+        os.environ['JWKS_URL'] = self.jwks_url
+
+    def mint(self, permissions=ALL_PERMISSIONS, subject='benchmark|1',
+             lifetime=3600):
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + self.domain + '/',
+            'sub': subject,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + lifetime,
+            'permissions': list(permissions),
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    """ Serves the JWKS document over HTTP from a daemon thread, for a
+        server running in another process
+    """
+
+    def serve_jwks(self, host='127.0.0.1', port=0):
+        body = json.dumps(self.jwks).encode('utf-8')
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return 'http://{}:{}/.well-known/jwks.json'.format(
+            host, server.server_port)
+
+
+''' BENCHMARK_KEY_FILE keeps the key pair across runs, so a server started
+    separately (see main) keeps accepting the tokens minted here
+'''
+issuer = LocalIssuer(key_file=os.getenv('BENCHMARK_KEY_FILE'))
+issuer.configure_environment()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve the JWKS of the benchmark issuer')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    url = issuer.serve_jwks(args.host, args.port)
+    print('AUTH0_DOMAIN={}'.format(issuer.domain))
+    print('API_AUDIENCE={}'.format(issuer.audience))
+    print('JWKS_URL={}'.format(url))
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import os
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+'''
+Connection pool configuration and metrics
+
+The pool is configured from the environment:
+
+    DB_POOL_SIZE            connections kept open, 5 by default
+    DB_MAX_OVERFLOW         extra connections opened under load, 10
+    DB_POOL_TIMEOUT         seconds to wait for a free connection, 30
+    DB_POOL_RECYCLE         seconds before a connection is replaced, 1800
+    DB_POOL_PRE_PING        test connections on checkout, on by default
+    DB_STATEMENT_TIMEOUT    milliseconds per statement on Postgres,
+                            0 (no limit) by default
+'''
+
+
+def getenv_bool(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+""" Counters updated on every checkout of the pool """
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+
+    def record_checkout(self, wait, overflow):
+        self.checkouts += 1
+        self.wait_seconds_total += wait
+        if wait > self.wait_seconds_max:
+            self.wait_seconds_max = wait
+        if overflow:
+            self.overflow_checkouts += 1
+
+
+stats = PoolStats()
+
+
+""" QueuePool that measures how long each checkout waits for a
+    connection, and counts the checkouts served by an overflow
+    connection and the ones that timed out
+"""
+
+
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            stats.timeouts += 1
+            raise
+        stats.record_checkout(time.perf_counter() - start,
+                              self.overflow() > 0)
+        return connection
+
+
+def engine_options(database_path):
+    if database_path.startswith('sqlite'):
+        return {}
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': getenv_bool('DB_POOL_PRE_PING', True),
+    }
+    statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+    if statement_timeout and database_path.startswith('postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(statement_timeout)
+        }
+    return options
+
+
+''' Connections must not cross a fork: a connection opened by the parent
+    process is discarded the first time a child checks it out, and the
+    gunicorn post_fork hook disposes of the whole pool.
+'''
+
+
+@event.listens_for(QueuePool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(QueuePool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid {}, attempting to check out '
+            'in pid {}'.format(connection_record.info['pid'], pid))
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {
+        'pool': type(pool).__name__,
+        'checkouts': stats.checkouts,
+        'checkout_wait_seconds_total': stats.wait_seconds_total,
+        'checkout_wait_seconds_max': stats.wait_seconds_max,
+        'overflow_checkouts': stats.overflow_checkouts,
+        'timeouts': stats.timeouts,
+    }
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    return status
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, g, make_response, request
+from models import get_versions, version_listeners
+
+VERSION_TTL = float(os.getenv('ETAG_VERSION_TTL', 1))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 128))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 1 << 20))
+
+'''
+VersionCache
+Keeps the collection versions read from the database for `ttl` seconds,
+so a conditional GET answered with 304 does not touch the database. A
+write made by this process puts its new versions in the cache as soon
+as it commits; writes made by other processes are seen within `ttl`
+seconds.
+
+Versions are kept per `source`, the database they were read from (None
+for the primary), and a body is read from the same database after its
+version. A body is therefore never older than the version in its ETag,
+even when the replicas lag behind one another.
+'''
+
+
+class VersionCache:
+    def __init__(self, ttl=VERSION_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._versions = {}
+
+    def get(self, name, source=None):
+        version = self.cached(name, source)
+        if version is None:
+            version = get_versions(name)[name]
+            self.put(name, version, source)
+        return version
+
+    def cached(self, name, source=None):
+        cached = self._versions.get((source, name))
+        if cached is not None and cached[0] > self.clock():
+            return cached[1]
+        return None
+
+    def put(self, name, version, source=None):
+        self._versions[(source, name)] = (self.clock() + self.ttl, version)
+
+    def invalidate(self, names):
+        for key in list(self._versions):
+            if key[1] in names:
+                self._versions.pop(key, None)
+
+    """ Takes the {name: version} bumped by a commit of this process: the
+        primary gets the new versions, unless it already has newer ones,
+        and the replicas read theirs again
+    """
+
+    def bumped(self, new_versions):
+        for key in list(self._versions):
+            if key[0] is not None and key[1] in new_versions:
+                self._versions.pop(key, None)
+        for name, version in new_versions.items():
+            cached = self._versions.get((None, name))
+            if cached is None or cached[1] < version:
+                self.put(name, version)
+
+
+'''
+ResponseCache
+Bounded LRU of serialized response bodies, keyed by ETag
+'''
+
+
+class ResponseCache:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag):
+        with self._lock:
+            body = self._bodies.get(etag)
+            if body is not None:
+                self._bodies.move_to_end(etag)
+            return body
+
+    def set(self, etag, body):
+        if self.maxsize <= 0 or len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._bodies[etag] = body
+            self._bodies.move_to_end(etag)
+            while len(self._bodies) > self.maxsize:
+                self._bodies.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._bodies.clear()
+
+
+versions = VersionCache()
+response_cache = ResponseCache()
+version_listeners.append(versions.bumped)
+
+
+''' Strong ETag of the current representation of a collection
+
+    It changes with the collection version and with anything in the
+    request that changes the body: the query parameters and the
+    negotiated media type.
+'''
+
+
+def make_etag(collection, version):
+    return etag_for(
+        collection, version,
+        [(key, value)
+         for key, values in request.args.lists() for value in values],
+        request.accept_mimetypes.to_header())
+
+
+''' Same as make_etag(), from the (key, value) pairs of the query string
+    and the normalized Accept header
+'''
+
+
+def etag_for(collection, version, args, accept):
+    variant = '&'.join(sorted(
+        '{}={}'.format(key, value) for key, value in args))
+    variant += '|' + accept
+    digest = hashlib.sha1(variant.encode('utf-8')).hexdigest()[:16]
+    return '{}-{}-{}'.format(collection, version, digest)
+
+
+''' Decorator for the GET handlers of a collection
+
+    Answers If-None-Match with 304 when the ETag still matches, serves the
+    cached body when there is one, and otherwise calls the handler, tags
+    its response and caches the body. The version is read from the
+    database the request reads from (see replicas.py). A request pinned
+    to the primary reads it without the version cache, so that it sees
+    its own writes made through other processes.
+'''
+
+
+def conditional(collection):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if g.get('pinned'):
+                version = get_versions(collection)[collection]
+            else:
+                version = versions.get(collection, g.get('read_engine'))
+            etag = make_etag(collection, version)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            body = response_cache.get(etag)
+            if body is not None:
+                response = Response(body, mimetype='application/json')
+                response.set_etag(etag)
+                return response
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                if not response.is_streamed:
+                    response_cache.set(etag, response.get_data())
+            return response
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,65 @@
+from sqlalchemy.orm import load_only, noload, selectinload
+
+'''
+FieldsetError Exception
+Raised for an unknown name in the fields or expand parameters
+'''
+
+
+class FieldsetError(Exception):
+    pass
+
+
+def split_names(value):
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+""" Parts of a representation asked for by a request
+
+    `fields` lists the columns to include and `expand` the relationship
+    to embed. Without either parameter the full representation is used,
+    linked objects included; as soon as one of them is given, only what
+    was asked for is loaded and returned.
+"""
+
+
+class Fieldset:
+    def __init__(self, args, model, relationship):
+        self.model = model
+        self.relationship = relationship
+        self.fields = None
+        self.expand = True
+        fields = args.get('fields')
+        expand = args.get('expand')
+        if fields is not None:
+            self.fields = split_names(fields)
+            if not self.fields:
+                raise FieldsetError('Empty fields')
+            for field in self.fields:
+                if field not in model.FIELDS:
+                    raise FieldsetError('Unknown field ' + field)
+            self.expand = False
+        if expand is not None:
+            names = split_names(expand)
+            for name in names:
+                if name != relationship:
+                    raise FieldsetError('Unknown expansion ' + name)
+            self.expand = relationship in names
+
+    """ Loader options for the query, `columns` being the names of the
+        columns needed on top of the requested ones, e.g. to paginate
+    """
+
+    def options(self, *columns):
+        options = []
+        if self.fields is not None:
+            options.append(load_only(*set(self.fields).union(columns)))
+        attribute = getattr(self.model, self.relationship)
+        if self.expand:
+            options.append(selectinload(attribute))
+        else:
+            options.append(noload(attribute))
+        return options
+
+    def json(self, row):
+        return row.json(self.fields, self.expand)
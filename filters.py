@@ -0,0 +1,98 @@
+from sqlalchemy import func
+from models import Actor, Movie, parse_datetime
+
+'''
+FilterError Exception
+Raised for a filter parameter that can't be parsed
+'''
+
+
+class FilterError(Exception):
+    pass
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+
+
+def starts_with(column, value):
+    return func.lower(column).like(escape_like(value.lower()) + '%',
+                                   escape='\\')
+
+
+def contains(column, value):
+    return column.ilike('%' + escape_like(value) + '%', escape='\\')
+
+
+def get_int(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise FilterError('Invalid ' + name)
+
+
+def get_datetime(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse_datetime(value)
+    except (ValueError, OverflowError):
+        raise FilterError('Invalid ' + name)
+
+
+''' SQL conditions for the filters of GET /actors
+
+    name           case-insensitive prefix of the name
+    name_contains  case-insensitive substring of the name
+    age_min        minimum age, inclusive
+    age_max        maximum age, inclusive
+    gender         exact gender
+'''
+
+
+def actor_filters(args):
+    columns = Actor.__table__.c
+    filters = []
+    if args.get('name'):
+        filters.append(starts_with(columns.name, args['name']))
+    if args.get('name_contains'):
+        filters.append(contains(columns.name, args['name_contains']))
+    age_min = get_int(args, 'age_min')
+    if age_min is not None:
+        filters.append(columns.age >= age_min)
+    age_max = get_int(args, 'age_max')
+    if age_max is not None:
+        filters.append(columns.age <= age_max)
+    if args.get('gender') is not None:
+        filters.append(columns.gender == args['gender'])
+    return filters
+
+
+''' SQL conditions for the filters of GET /movies
+
+    title            case-insensitive prefix of the title
+    title_contains   case-insensitive substring of the title
+    released_after   release date, inclusive
+    released_before  release date, exclusive
+'''
+
+
+def movie_filters(args):
+    columns = Movie.__table__.c
+    filters = []
+    if args.get('title'):
+        filters.append(starts_with(columns.title, args['title']))
+    if args.get('title_contains'):
+        filters.append(contains(columns.title, args['title_contains']))
+    released_after = get_datetime(args, 'released_after')
+    if released_after is not None:
+        filters.append(columns.release_date >= released_after)
+    released_before = get_datetime(args, 'released_before')
+    if released_before is not None:
+        filters.append(columns.release_date < released_before)
+    return filters
@@ -0,0 +1,353 @@
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import select
+from models import (
+    db, CollectionVersion, LinkChange, association_table, link_listeners
+)
+
+'''
+Co-star graph
+
+The Association table as an in-memory bipartite graph of actors and
+movies, for the co-star and degrees-of-separation queries. Each side is
+stored in compressed sparse row form: the sorted ids of the nodes, and
+the ids of all their neighbours in one array, the neighbours of the i-th
+node being neighbours[offsets[i]:offsets[i + 1]]. That takes about 8
+bytes per link and a dozen per node, so millions of links fit in a few
+tens of megabytes.
+
+Links changed since the arrays were built are kept in small overlay
+dicts. Each process follows the LinkChange log to see the changes made
+by the others (see GraphIndex), and builds the arrays again when the
+overlay grows past GRAPH_MAX_PENDING links or the log has a gap.
+'''
+
+GRAPH_CHECK_INTERVAL = float(os.getenv('GRAPH_CHECK_INTERVAL', 1))
+GRAPH_MAX_PENDING = int(os.getenv('GRAPH_MAX_PENDING', 100000))
+GRAPH_LOG_KEEP = int(os.getenv('GRAPH_LOG_KEEP', 100000))
+GRAPH_MAX_DEPTH = 10
+
+
+""" One side of the graph in compressed sparse row form, built from
+    (node, neighbour) pairs sorted by node then neighbour
+"""
+
+
+class CSR:
+    def __init__(self, pairs=()):
+        self.ids = array('i')
+        self.offsets = array('q', [0])
+        self.neighbours = array('i')
+        last = None
+        for node, neighbour in pairs:
+            if node != last:
+                if last is not None:
+                    self.offsets.append(len(self.neighbours))
+                self.ids.append(node)
+                last = node
+            self.neighbours.append(neighbour)
+        if last is not None:
+            self.offsets.append(len(self.neighbours))
+
+    def index(self, id):
+        index = bisect_left(self.ids, id)
+        if index < len(self.ids) and self.ids[index] == id:
+            return index
+        return None
+
+    def get(self, id):
+        index = self.index(id)
+        if index is None:
+            return ()
+        return self.neighbours[self.offsets[index]:self.offsets[index + 1]]
+
+    def contains(self, id, neighbour):
+        index = self.index(id)
+        if index is None:
+            return False
+        start, end = self.offsets[index], self.offsets[index + 1]
+        position = bisect_left(self.neighbours, neighbour, start, end)
+        return position < end and self.neighbours[position] == neighbour
+
+    def nbytes(self):
+        return sum(len(values) * values.itemsize for values in
+                   (self.ids, self.offsets, self.neighbours))
+
+
+""" Actors and movies linked by (movie_id, actor_id) pairs: the CSR arrays
+    of both sides, plus the links added and removed since they were built
+"""
+
+
+class Graph:
+    def __init__(self, actor_pairs=(), movie_pairs=()):
+        self.actors = CSR(actor_pairs)
+        self.movies = CSR(movie_pairs)
+        self.added = ({}, {})
+        self.removed = ({}, {})
+        self.pending = 0
+        self.changes = 0
+
+    @classmethod
+    def from_links(cls, pairs):
+        pairs = list(pairs)
+        return cls(sorted((actor, movie) for movie, actor in pairs),
+                   sorted(pairs))
+
+    def _neighbours(self, side, id):
+        base = (self.actors, self.movies)[side].get(id)
+        removed = self.removed[side].get(id)
+        added = self.added[side].get(id)
+        if not removed and not added:
+            return base
+        neighbours = [neighbour for neighbour in base
+                      if not removed or neighbour not in removed]
+        if added:
+            neighbours.extend(sorted(added))
+        return neighbours
+
+    def movies_of(self, actor):
+        return self._neighbours(0, actor)
+
+    def actors_of(self, movie):
+        return self._neighbours(1, movie)
+
+    def _set(self, changes, movie, actor, present):
+        if (movie in changes[0].get(actor, ())) == present:
+            return
+        self.pending += 1 if present else -1
+        self.changes += 1
+        for side, (id, neighbour) in enumerate(((actor, movie),
+                                                (movie, actor))):
+            if present:
+                changes[side].setdefault(id, set()).add(neighbour)
+            else:
+                neighbours = changes[side][id]
+                neighbours.discard(neighbour)
+                if not neighbours:
+                    del changes[side][id]
+
+    """ Adds (add=True) or removes a link; applying the same change twice
+        has no effect
+    """
+
+    def apply(self, movie, actor, add):
+        if self.actors.contains(actor, movie):
+            self._set(self.removed, movie, actor, not add)
+        else:
+            self._set(self.added, movie, actor, add)
+
+    """ Actors sharing a movie with `actor`, as (actor, shared movies)
+        pairs, most shared first
+    """
+
+    def costars(self, actor):
+        counts = Counter()
+        for movie in self.movies_of(actor):
+            counts.update(self.actors_of(movie))
+        counts.pop(actor, None)
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+    """ Shortest chain [actor, movie, actor, ..., actor] from `source` to
+        `target` with at most `max_depth` movies, or None
+
+        Breadth-first search from both ends at once, expanding one movie
+        deeper the side whose frontier has the fewest movies. A movie is
+        expanded once per side, however many of its actors are reached.
+        The first actor reached by both sides ends the search: any actor
+        reached earlier by the other side would have met this side's
+        frontier one level before, so they all give paths of the same
+        length.
+    """
+
+    def path(self, source, target, max_depth=6):
+        if source == target:
+            return [source]
+        parents = ({source: None}, {target: None})
+        expanded = (set(), set())
+        frontiers = ([source], [target])
+        for _ in range(max_depth):
+            costs = [sum(len(self.movies_of(actor)) for actor in frontier)
+                     for frontier in frontiers]
+            if not costs[0] or not costs[1]:
+                return None
+            side = 0 if costs[0] <= costs[1] else 1
+            frontier = []
+            for actor in frontiers[side]:
+                for movie in self.movies_of(actor):
+                    if movie in expanded[side]:
+                        continue
+                    expanded[side].add(movie)
+                    for costar in self.actors_of(movie):
+                        if costar in parents[side]:
+                            continue
+                        parents[side][costar] = (actor, movie)
+                        if costar in parents[1 - side]:
+                            return self._join(parents, costar)
+                        frontier.append(costar)
+            frontiers[side][:] = frontier
+        return None
+
+    def _join(self, parents, meeting):
+        path = [meeting]
+        node = meeting
+        while parents[0][node] is not None:
+            actor, movie = parents[0][node]
+            path[:0] = [actor, movie]
+            node = actor
+        node = meeting
+        while parents[1][node] is not None:
+            actor, movie = parents[1][node]
+            path.extend([movie, actor])
+            node = actor
+        return path
+
+    def nbytes(self):
+        return self.actors.nbytes() + self.movies.nbytes()
+
+
+def links_version(connection):
+    table = CollectionVersion.__table__
+    return connection.execute(select([table.c.version]).where(
+        table.c.name == 'links')).scalar() or 0
+
+
+''' The version of the links and the two sides of the graph are read in
+    the same transaction, and must see the same links: a link committed
+    between two of the statements would otherwise be in one side only,
+    and applied again from the log. Each statement of a READ COMMITTED
+    transaction takes its own snapshot on Postgres, so the graph is
+    loaded in REPEATABLE READ.
+'''
+
+
+def snapshot(connection):
+    if connection.dialect.name == 'postgresql':
+        return connection.execution_options(
+            isolation_level='REPEATABLE READ')
+    return connection
+
+
+def load_graph(connection):
+    movie_id = association_table.c.movie_id
+    actor_id = association_table.c.actor_id
+    connection = connection.execution_options(stream_results=True)
+    graph = Graph()
+    graph.actors = CSR(connection.execute(
+        select([actor_id, movie_id]).order_by(actor_id, movie_id)))
+    graph.movies = CSR(connection.execute(
+        select([movie_id, actor_id]).order_by(movie_id, actor_id)))
+    return graph
+
+
+""" The graph of this process, loaded on first use
+
+    At most every GRAPH_CHECK_INTERVAL seconds a request compares the
+    version of the links with the one of the graph, and applies the
+    LinkChange rows in between. When some are missing (not logged, or
+    pruned) or there are too many, the graph is loaded again in a
+    background thread while requests keep using the current one. The
+    links changed by this process are applied as soon as they are
+    committed. The graph is only read and changed under `lock`.
+"""
+
+
+class GraphIndex:
+    def __init__(self, check_interval=GRAPH_CHECK_INTERVAL,
+                 max_pending=GRAPH_MAX_PENDING, log_keep=GRAPH_LOG_KEEP,
+                 clock=time.monotonic):
+        self.check_interval = check_interval
+        self.max_pending = max_pending
+        self.log_keep = log_keep
+        self.clock = clock
+        self.graph = None
+        self.version = None
+        self.lock = threading.RLock()
+        self._checked_at = None
+        self._loading = False
+
+    def get(self, engine):
+        with self.lock:
+            if self.graph is None:
+                self._load(engine)
+            elif self.clock() - self._checked_at >= self.check_interval:
+                self._checked_at = self.clock()
+                self._follow(engine)
+            return self.graph
+
+    def _load(self, engine):
+        with engine.connect() as connection:
+            connection = snapshot(connection)
+            with connection.begin():
+                version = links_version(connection)
+                graph = load_graph(connection)
+        with self.lock:
+            self.graph, self.version = graph, version
+            self._checked_at = self.clock()
+            self._loading = False
+
+    def _load_in_background(self, engine):
+        if self._loading:
+            return
+        self._loading = True
+
+        def load():
+            try:
+                self._load(engine)
+            except Exception:
+                self._loading = False
+                raise
+        threading.Thread(target=load, daemon=True).start()
+
+    def _follow(self, engine):
+        if self._loading:
+            return
+        table = LinkChange.__table__
+        with engine.connect() as connection:
+            version = links_version(connection)
+            if version == self.version:
+                return
+            rows = connection.execute(
+                select([table.c.version, table.c.movie_id,
+                        table.c.actor_id, table.c.added])
+                .where(table.c.version > self.version)
+                .order_by(table.c.version, table.c.id)
+                .limit(self.max_pending + 1)).fetchall()
+            if self.log_keep:
+                connection.execute(table.delete().where(
+                    table.c.version <= version - self.log_keep))
+        versions = {row[0] for row in rows}
+        if len(rows) > self.max_pending or not versions or \
+                min(versions) != self.version + 1 or \
+                len(versions) != max(versions) - self.version:
+            self._load_in_background(engine)
+            return
+        for _, movie, actor, added in rows:
+            self.graph.apply(movie, actor, added)
+        self.version = max(versions)
+        if self.graph.pending > self.max_pending:
+            self._load_in_background(engine)
+
+    def links_changed(self, added, removed):
+        with self.lock:
+            if self.graph is None:
+                return
+            for movie, actor in added:
+                self.graph.apply(movie, actor, True)
+            for movie, actor in removed:
+                self.graph.apply(movie, actor, False)
+
+
+index = GraphIndex()
+link_listeners.append(index.links_changed)
+
+
+@contextmanager
+def current_graph():
+    with index.lock:
+        yield index.get(db.engine)
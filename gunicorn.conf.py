@@ -0,0 +1,27 @@
+import glob
+import os
+import sys
+
+'''
+Gunicorn settings read by `gunicorn app:APP`
+'''
+
+
+def on_starting(server):
+    # snapshots left by the workers of a previous run, see metrics.py
+    metrics_dir = os.getenv('METRICS_DIR')
+    if metrics_dir:
+        for path in glob.glob(os.path.join(metrics_dir, 'metrics-*.json')):
+            os.remove(path)
+
+
+def post_fork(server, worker):
+    # with --preload the application, and its connection pool, was
+    # created by the master process: every worker needs its own pool
+    app = sys.modules.get('app')
+    if app is not None:
+        from models import db
+        with app.APP.app_context():
+            db.engine.dispose()
+        import replicas
+        replicas.dispose()
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from functools import wraps
+from flask import Response, abort, jsonify, make_response, request
+from kvstore import KV_STORE_URL, from_url
+from replicas import current_subject
+
+'''
+Idempotency keys
+
+A client retrying a POST sends the same Idempotency-Key header with every
+attempt. The first request with a key runs; its response is kept in a
+key-value store of its own (see kvstore.py) for IDEMPOTENCY_TTL seconds,
+and the retries get that response back, with an Idempotent-Replayed
+header, without touching the database. In memory that store holds at
+most IDEMPOTENCY_MAX_BYTES of responses, dropping the oldest first, but
+never the claim of a request still running.
+
+A retry arriving while the first request is still running waits for it,
+up to IDEMPOTENCY_WAIT seconds, and then gets the same response: in the
+same process it is woken up as soon as the response is stored, in
+another one it polls the store. If the first request fails (an error
+status or an exception), nothing is kept and the next retry runs again.
+
+Keys are scoped to the subject of the token and to the route, and
+reusing a key with a different body is answered with 422.
+'''
+
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 10))
+IDEMPOTENCY_LOCK_TTL = float(os.getenv('IDEMPOTENCY_LOCK_TTL', 60))
+IDEMPOTENCY_MAX_BODY = int(os.getenv('IDEMPOTENCY_MAX_BODY', 1 << 20))
+IDEMPOTENCY_MAX_BYTES = int(os.getenv('IDEMPOTENCY_MAX_BYTES', 64 << 20))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv('IDEMPOTENCY_MAX_KEYS', 100000))
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+MAX_KEY_LENGTH = 255
+
+store = from_url(KV_STORE_URL, maxsize=IDEMPOTENCY_MAX_KEYS,
+                 max_bytes=IDEMPOTENCY_MAX_BYTES)
+_waiting = {}
+_waiting_lock = threading.Lock()
+
+
+def store_key(key):
+    scope = '\n'.join([current_subject() or '', request.method,
+                       request.path, key])
+    return 'idempotency:' + hashlib.sha256(scope.encode('utf-8')).hexdigest()
+
+
+def fingerprint():
+    return hashlib.sha256(request.get_data()).hexdigest()
+
+
+def replay(record):
+    response = Response(record['body'], status=record['status'],
+                        mimetype=record['mimetype'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def finished(key):
+    with _waiting_lock:
+        event = _waiting.pop(key, None)
+    if event is not None:
+        event.set()
+
+
+''' Waits for the request holding `key` to finish and returns its record:
+    None when it failed, still pending after IDEMPOTENCY_WAIT seconds,
+    and right away when it was sent with another body than `digest`
+'''
+
+
+def wait_for(key, digest):
+    with _waiting_lock:
+        event = _waiting.get(key)
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    while True:
+        value = store.get(key)
+        record = None if value is None else json.loads(value)
+        if record is None or record['state'] == 'done' or \
+                record['fingerprint'] != digest:
+            return record
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return record
+        if event is not None:
+            event.wait(remaining)
+            event = None
+        else:
+            time.sleep(min(IDEMPOTENCY_POLL_INTERVAL, remaining))
+
+
+def run_once(f, key, digest, args, kwargs):
+    with _waiting_lock:
+        _waiting[key] = threading.Event()
+    try:
+        response = make_response(f(*args, **kwargs))
+        body = response.get_data(as_text=True)
+        if response.status_code < 400 and not response.is_streamed and \
+                len(body) <= IDEMPOTENCY_MAX_BODY:
+            store.set(key, json.dumps({
+                'state': 'done',
+                'fingerprint': digest,
+                'status': response.status_code,
+                'mimetype': response.mimetype,
+                'body': body,
+            }), IDEMPOTENCY_TTL)
+        else:
+            store.delete(key)
+        return response
+    except BaseException:
+        store.delete(key)
+        raise
+    finally:
+        finished(key)
+
+
+''' Decorator for the POST handlers, to place after requires_auth '''
+
+
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(400)
+        key = store_key(key)
+        digest = fingerprint()
+        pending = json.dumps({'state': 'pending', 'fingerprint': digest})
+        while True:
+            if store.add(key, pending, IDEMPOTENCY_LOCK_TTL,
+                         evictable=False):
+                return run_once(f, key, digest, args, kwargs)
+            record = wait_for(key, digest)
+            if record is None:
+                continue
+            if record['fingerprint'] != digest:
+                abort(422)
+            if record['state'] == 'done':
+                return replay(record)
+            response = jsonify({
+                'success': False,
+                'error': 409,
+                'message': 'request with this Idempotency-Key in progress'
+            })
+            response.status_code = 409
+            response.headers['Retry-After'] = str(int(IDEMPOTENCY_WAIT))
+            return response
+    return wrapper
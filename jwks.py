@@ -0,0 +1,190 @@
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+'''
+JWKSError Exception
+Raised when the signing keys can not be fetched and there is no usable
+copy left in the cache
+'''
+
+
+class JWKSError(Exception):
+    pass
+
+
+'''
+parse_cache_control(value)
+    returns the Cache-Control directives as a dict, with the numeric
+    values (max-age, stale-if-error, ...) converted to int
+'''
+
+
+def parse_cache_control(value):
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(','):
+        name, _, arg = part.strip().partition('=')
+        name = name.strip().lower()
+        if not name:
+            continue
+        arg = arg.strip().strip('"')
+        try:
+            directives[name] = int(arg)
+        except ValueError:
+            directives[name] = arg or True
+    return directives
+
+
+""" Process-wide store for the JSON Web Key Set used to verify tokens
+
+    The document is fetched once and kept for `ttl` seconds, or for the
+    max-age sent by the server when it has a Cache-Control header. Once a
+    `refresh_ahead` fraction of that lifetime has passed, the next lookup
+    starts a refresh in a background thread, so requests keep using the
+    cached keys while the new document is downloaded.
+
+    A lookup for an unknown `kid` (for instance, after a key rotation)
+    forces a synchronous refresh, but at most once every
+    `min_refresh_interval` seconds.
+
+    When a refresh fails the stale keys are still served for up to
+    `stale_if_error` seconds after they expired.
+
+    `url` can be any address understood by urlopen, including file://
+    paths, and `fetch` can replace the download entirely in tests.
+"""
+
+
+class JWKSStore:
+    def __init__(self, url, ttl=600, min_refresh_interval=30,
+                 stale_if_error=86400, refresh_ahead=0.8, timeout=5,
+                 fetch=None, clock=time.monotonic):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.stale_if_error = stale_if_error
+        self.refresh_ahead = refresh_ahead
+        self.timeout = timeout
+        self.clock = clock
+        self._fetch = fetch or self._fetch_url
+        self._keys = None
+        self._fetched_at = None
+        self._expires_at = None
+        self._stale_until = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _fetch_url(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            cache_control = response.headers.get('Cache-Control')
+            return json.loads(response.read()), cache_control
+
+    def _store(self, document, cache_control):
+        directives = parse_cache_control(cache_control)
+        max_age = self.ttl
+        if isinstance(directives.get('max-age'), int):
+            max_age = max(directives['max-age'], self.min_refresh_interval)
+        stale_if_error = self.stale_if_error
+        if isinstance(directives.get('stale-if-error'), int):
+            stale_if_error = directives['stale-if-error']
+        now = self.clock()
+        self._keys = {key['kid']: key for key in document['keys']
+                      if 'kid' in key}
+        self._fetched_at = now
+        self._expires_at = now + max_age
+        self._stale_until = self._expires_at + stale_if_error
+
+    def refresh(self):
+        with self._lock:
+            return self._refresh_locked()
+
+    """ For callers downloading the document themselves (see asgi.py):
+        whether get_key(kid) would have to download it first, and the
+        outcome of their download
+    """
+
+    def needs_refresh(self, kid=None):
+        now = self.clock()
+        rate_limited = self._last_attempt is not None and \
+            now - self._last_attempt < self.min_refresh_interval
+        if self._keys is None:
+            return True
+        if now >= self._expires_at or (
+                kid is not None and kid not in self._keys):
+            return not rate_limited
+        return False
+
+    def load(self, document, cache_control=None):
+        with self._lock:
+            self._last_attempt = self.clock()
+            self._store(document, cache_control)
+
+    def failed(self, error):
+        with self._lock:
+            self._last_attempt = self.clock()
+            if self._keys is None or self.clock() > self._stale_until:
+                raise JWKSError(error) from error
+
+    def _refresh_locked(self):
+        self._last_attempt = self.clock()
+        try:
+            document, cache_control = self._fetch()
+            self._store(document, cache_control)
+            return True
+        except Exception as error:
+            if self._keys is None or self.clock() > self._stale_until:
+                raise JWKSError(error) from error
+            return False
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except JWKSError:
+            pass
+        finally:
+            self._refreshing = False
+
+    def _start_background_refresh(self):
+        if self._refreshing or (
+                self._last_attempt is not None and
+                self.clock() - self._last_attempt <
+                self.min_refresh_interval):
+            return
+        self._refreshing = True
+        thread = threading.Thread(
+            target=self._refresh_in_background, daemon=True)
+        thread.start()
+
+    def get_keys(self):
+        now = self.clock()
+        if self._keys is None or now >= self._expires_at:
+            with self._lock:
+                if self._keys is None or self.clock() >= self._expires_at:
+                    if (self._keys is not None and self._last_attempt
+                            and self.clock() - self._last_attempt <
+                            self.min_refresh_interval):
+                        if self.clock() > self._stale_until:
+                            raise JWKSError('Signing keys expired')
+                        return self._keys
+                    self._refresh_locked()
+            return self._keys
+        lifetime = self._expires_at - self._fetched_at
+        if now - self._fetched_at >= lifetime * self.refresh_ahead:
+            self._start_background_refresh()
+        return self._keys
+
+    def get_key(self, kid):
+        keys = self.get_keys()
+        if kid in keys:
+            return keys[kid]
+        with self._lock:
+            if kid not in self._keys and (
+                    self._last_attempt is None or
+                    self.clock() - self._last_attempt >=
+                    self.min_refresh_interval):
+                self._refresh_locked()
+            return self._keys.get(kid)
@@ -0,0 +1,265 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Small key-value store with expiring keys, for the state that every worker
+must agree on (see replicas.py, idempotency.py and ratelimit.py)
+
+    KV_STORE_URL=redis://localhost:6379/0
+
+keeps the keys in Redis, shared by every process. By
+default they live in the memory of each process, which is only enough for
+a single worker.
+'''
+
+KV_STORE_URL = os.getenv('KV_STORE_URL')
+KV_STORE_PREFIX = os.getenv('KV_STORE_PREFIX', 'capstone:')
+KV_STORE_MAX_KEYS = int(os.getenv('KV_STORE_MAX_KEYS', 100000))
+LIMITS_SWEEP_SIZE = 1024
+
+
+""" Keys kept in a dict of the current process, at most `maxsize` of
+    them and, when `max_bytes` is given, at most that many characters of
+    string values: the least recently set keys are dropped first. Keys
+    set with evictable=False are never dropped before they expire.
+
+    The token buckets and semaphores of take() and acquire() are kept
+    apart, and only dropped once expired, so that other keys never push
+    them out.
+"""
+
+
+class MemoryStore:
+    def __init__(self, clock=time.monotonic, maxsize=KV_STORE_MAX_KEYS,
+                 max_bytes=None):
+        self.clock = clock
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._limits = {}
+        self._sweep_at = LIMITS_SWEEP_SIZE
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= now:
+            self._remove(key)
+            return None
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, self.clock())
+        return None if entry is None else entry[1]
+
+    def _put(self, key, value, expires, evictable=True):
+        self._remove(key)
+        size = len(value) if isinstance(value, str) else 0
+        self._entries[key] = (expires, value, size, evictable)
+        self.nbytes += size
+        self._evict()
+
+    def _full(self):
+        return len(self._entries) > self.maxsize or (
+            self.max_bytes is not None and self.nbytes > self.max_bytes)
+
+    def _evict(self):
+        if not self._full():
+            return
+        now = self.clock()
+        for key, entry in list(self._entries.items()):
+            if entry[0] <= now or entry[3]:
+                self._remove(key)
+                if not self._full():
+                    return
+
+    def set(self, key, value, ttl, evictable=True):
+        with self._lock:
+            self._put(key, value, self.clock() + ttl, evictable)
+
+    """ Sets the key unless it already holds a value, returns whether it
+        was set
+    """
+
+    def add(self, key, value, ttl, evictable=True):
+        with self._lock:
+            now = self.clock()
+            if self._live(key, now) is not None:
+                return False
+            self._put(key, value, now + ttl, evictable)
+            return True
+
+    """ Token bucket holding up to `burst` tokens and refilled with `rate`
+        tokens per second: takes `cost` tokens when there are enough and
+        returns 0, otherwise returns the seconds to wait for them
+    """
+
+    def _limit(self, key, now):
+        entry = self._limits.get(key)
+        if entry is None or entry[0] <= now:
+            return None
+        return entry[1]
+
+    def _set_limit(self, key, value, expires, now):
+        self._limits[key] = (expires, value)
+        if len(self._limits) >= self._sweep_at:
+            for expired in [name for name, entry in self._limits.items()
+                            if entry[0] <= now]:
+                del self._limits[expired]
+            self._sweep_at = max(LIMITS_SWEEP_SIZE, 2 * len(self._limits))
+
+    def take(self, key, cost, rate, burst):
+        with self._lock:
+            now = self.clock()
+            bucket = self._limit(key, now)
+            tokens, updated = (burst, now) if bucket is None else bucket
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self._set_limit(key, (tokens, now), now + burst / rate, now)
+            return wait
+
+    """ Counting semaphore: holds `token` unless `limit` tokens are held
+        already, returns whether it was taken. A token not released after
+        `ttl` seconds is dropped.
+    """
+
+    def acquire(self, key, token, limit, ttl):
+        with self._lock:
+            now = self.clock()
+            holders = self._limit(key, now) or {}
+            for held, expires in list(holders.items()):
+                if expires <= now:
+                    del holders[held]
+            if len(holders) >= limit:
+                return False
+            holders[token] = now + ttl
+            self._set_limit(key, holders, now + ttl, now)
+            return True
+
+    def release(self, key, token):
+        with self._lock:
+            holders = self._limit(key, self.clock())
+            if holders is not None:
+                holders.pop(token, None)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+            self._limits.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._limits.clear()
+            self.nbytes = 0
+
+
+# MemoryStore.take() and acquire() as Lua scripts, so that they are
+# atomic in Redis; times come from the Redis server clock, which needs
+# effects replication before Redis 5
+TAKE_SCRIPT = '''
+if redis.replicate_commands then redis.replicate_commands() end
+local cost, rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2]),
+    tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens),
+           'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+'''
+
+ACQUIRE_SCRIPT = '''
+if redis.replicate_commands then redis.replicate_commands() end
+local limit, ttl = tonumber(ARGV[2]), tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+redis.call('PEXPIRE', KEYS[1], math.ceil(ttl * 1000))
+return 1
+'''
+
+
+""" Keys kept in Redis, as strings, under `prefix`. Their memory is bounded
+    by the maxmemory setting of the server, which should not evict keys
+    (noeviction) since the pins and the idempotency claims must stay.
+    `client`, when given, is used instead of connecting to `url`; it must
+    decode the responses.
+"""
+
+
+class RedisStore:
+    def __init__(self, url=None, prefix=KV_STORE_PREFIX, client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+        self.prefix = prefix
+        self._take = self.client.register_script(TAKE_SCRIPT)
+        self._acquire = self.client.register_script(ACQUIRE_SCRIPT)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl, evictable=True):
+        self.client.set(self.prefix + key, value,
+                        px=max(int(ttl * 1000), 1))
+
+    def add(self, key, value, ttl, evictable=True):
+        return bool(self.client.set(self.prefix + key, value,
+                                    px=max(int(ttl * 1000), 1), nx=True))
+
+    def take(self, key, cost, rate, burst):
+        return float(self._take(keys=[self.prefix + key],
+                                args=[cost, rate, burst]))
+
+    def acquire(self, key, token, limit, ttl):
+        return bool(self._acquire(keys=[self.prefix + key],
+                                  args=[token, limit, ttl]))
+
+    def release(self, key, token):
+        self.client.zrem(self.prefix + key, token)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+""" Redis store when `url` is set, otherwise a MemoryStore bounded by
+    `limits` (maxsize, max_bytes)
+"""
+
+
+def from_url(url, **limits):
+    if url:
+        return RedisStore(url)
+    return MemoryStore(**limits)
+
+
+store = from_url(KV_STORE_URL)
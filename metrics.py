@@ -0,0 +1,306 @@
+import atexit
+import glob
+import json
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, has_request_context, request
+from querycount import request_query_counter
+
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+
+'''
+Request metrics in the Prometheus text format
+
+Histograms keep one preallocated list of bucket counts per set of label
+values: recording a value is a bisect and two additions, without locks.
+
+With several worker processes (gunicorn), set METRICS_DIR to a directory
+shared by the workers: each one writes a snapshot of its metrics there at
+most every METRICS_FLUSH_INTERVAL seconds and when it exits, and GET
+/metrics adds up the snapshots of every worker. The directory is emptied
+when gunicorn starts, see gunicorn.conf.py.
+'''
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75,
+                   1.0, 2.5, 5.0, 7.5, 10.0)
+PHASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                 0.25, 0.5, 1.0, 2.5)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                 16777216)
+
+
+""" Histogram with one series per combination of label values """
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self.series = {}
+
+    """ `values` holds the label values, in the order of `labels` """
+
+    def observe(self, value, values=()):
+        counts = self.series.get(values)
+        if counts is None:
+            # one count per bucket, the +Inf bucket, then the sum
+            counts = self.series.setdefault(
+                values, [0] * (len(self.buckets) + 1) + [0.0])
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def snapshot(self):
+        return [[list(values), list(counts)]
+                for values, counts in list(self.series.items())]
+
+    def clear(self):
+        self.series.clear()
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)) + '}'
+
+
+def format_number(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def render_histogram(histogram, series):
+    lines = ['# HELP {} {}'.format(histogram.name, histogram.documentation),
+             '# TYPE {} histogram'.format(histogram.name)]
+    for values, counts in sorted(series.items()):
+        cumulative = 0
+        bounds = [format_number(bound) for bound in histogram.buckets]
+        for bound, count in zip(bounds + ['+Inf'], counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                histogram.name,
+                format_labels(histogram.labels + ('le',), values + (bound,)),
+                cumulative))
+        labels = format_labels(histogram.labels, values)
+        lines.append('{}_sum{} {}'.format(
+            histogram.name, labels, format_number(counts[-1])))
+        lines.append('{}_count{} {}'.format(
+            histogram.name, labels, cumulative))
+    return lines
+
+
+ROUTE_LABELS = ('method', 'route')
+
+request_seconds = Histogram(
+    'capstone_http_request_duration_seconds',
+    'Time to handle a request, until the last byte of the body',
+    LATENCY_BUCKETS, ROUTE_LABELS + ('status',))
+response_bytes = Histogram(
+    'capstone_http_response_size_bytes', 'Size of the response bodies',
+    BYTES_BUCKETS, ROUTE_LABELS)
+query_count = Histogram(
+    'capstone_db_queries_per_request', 'SQL statements run by a request',
+    QUERY_BUCKETS, ROUTE_LABELS)
+query_seconds = Histogram(
+    'capstone_db_query_duration_seconds',
+    'Time spent running the SQL statements of a request',
+    PHASE_BUCKETS, ROUTE_LABELS)
+serialization_seconds = Histogram(
+    'capstone_serialization_duration_seconds',
+    'Time spent encoding the JSON body of a request',
+    PHASE_BUCKETS, ROUTE_LABELS)
+jwt_verify_seconds = Histogram(
+    'capstone_jwt_verify_duration_seconds',
+    'Time spent in verify_decode_jwt, token cache misses only',
+    PHASE_BUCKETS)
+
+HISTOGRAMS = [request_seconds, response_bytes, query_count, query_seconds,
+              serialization_seconds, jwt_verify_seconds]
+
+
+''' Decorator recording the duration of every call in `histogram` '''
+
+
+def timed(histogram):
+    def timed_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return timed_decorator
+
+
+''' Adds the time spent in the block to the serialization time of the
+    current request
+'''
+
+
+@contextmanager
+def serializing():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            g.serialization_seconds = g.get('serialization_seconds', 0.0) \
+                + time.perf_counter() - start
+
+
+def start_request():
+    g.request_start = time.perf_counter()
+
+
+def route_labels():
+    rule = request.url_rule
+    return (request.method, rule.rule if rule is not None else 'unmatched')
+
+
+""" Records the metrics of a finished request. Streamed responses are
+    recorded once their body has been sent.
+"""
+
+
+def finish_request(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    labels = route_labels()
+    state = (start, labels, response.status_code, request_query_counter(),
+             g._get_current_object())
+    if response.is_streamed:
+        response.response = counted_body(response.response, state)
+    else:
+        record(state, response.calculate_content_length() or 0)
+    return response
+
+
+def counted_body(body, state):
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+        record(state, size)
+
+
+def record(state, size):
+    start, labels, status, queries, request_globals = state
+    request_seconds.observe(time.perf_counter() - start,
+                            labels + (str(status),))
+    response_bytes.observe(size, labels)
+    query_count.observe(queries.count, labels)
+    query_seconds.observe(queries.seconds, labels)
+    serialization = request_globals.get('serialization_seconds')
+    if serialization is not None:
+        serialization_seconds.observe(serialization, labels)
+    if METRICS_DIR:
+        flush()
+
+
+''' Snapshots of the worker processes, see METRICS_DIR '''
+
+_last_flush = [0.0]
+
+
+def snapshot_path(pid=None):
+    return os.path.join(METRICS_DIR, 'metrics-{}.json'.format(
+        pid or os.getpid()))
+
+
+def flush(force=False):
+    now = time.monotonic()
+    if not force and now - _last_flush[0] < METRICS_FLUSH_INTERVAL:
+        return
+    _last_flush[0] = now
+    data = {h.name: h.snapshot() for h in HISTOGRAMS}
+    descriptor, path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+    with os.fdopen(descriptor, 'w') as snapshot:
+        json.dump(data, snapshot)
+    os.replace(path, snapshot_path())
+
+
+def collect():
+    merged = {h.name: {} for h in HISTOGRAMS}
+    snapshots = [{h.name: h.snapshot() for h in HISTOGRAMS}]
+    if METRICS_DIR:
+        own = snapshot_path()
+        for path in glob.glob(os.path.join(METRICS_DIR, 'metrics-*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as snapshot:
+                    snapshots.append(json.load(snapshot))
+            except (OSError, ValueError):
+                continue
+    for snapshot in snapshots:
+        for name, series in snapshot.items():
+            if name not in merged:
+                continue
+            for values, counts in series:
+                total = merged[name].setdefault(
+                    tuple(values), [0] * len(counts))
+                for index, count in enumerate(counts):
+                    total[index] += count
+    return merged
+
+
+def pool_lines(status):
+    lines = []
+    labels = format_labels(('pid',), (os.getpid(),)) if METRICS_DIR else ''
+    for key, kind in (('size', 'gauge'), ('checked_out', 'gauge'),
+                      ('checked_in', 'gauge'), ('overflow', 'gauge'),
+                      ('checkouts', 'counter'),
+                      ('checkout_wait_seconds_total', 'counter'),
+                      ('overflow_checkouts', 'counter'),
+                      ('timeouts', 'counter')):
+        if key not in status:
+            continue
+        name = 'capstone_db_pool_' + key
+        if kind == 'counter' and not name.endswith('_total'):
+            name += '_total'
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('{}{} {}'.format(
+            name, labels, format_number(status[key])))
+    return lines
+
+
+''' Every metric in the Prometheus text format. The pool series describe
+    the process answering, labelled with its pid when METRICS_DIR is set.
+'''
+
+
+def render(pool_status=None):
+    merged = collect()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(render_histogram(histogram, merged[histogram.name]))
+    if pool_status is not None:
+        lines.extend(pool_lines(pool_status))
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    if METRICS_DIR:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        atexit.register(flush, True)
@@ -0,0 +1,64 @@
+"""add link counters and catalog_stat
+
+Revision ID: 3c5e8f2a9d41
+Revises: ee4944646789
+Create Date: 2026-10-18 23:12:40.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c5e8f2a9d41'
+down_revision = 'ee4944646789'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actor', sa.Column(
+        'movie_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('movie', sa.Column(
+        'actor_count', sa.Integer(), nullable=False, server_default='0'))
+    op.create_table(
+        'catalog_stat',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('value', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name', 'key')
+    )
+    op.execute(
+        'UPDATE actor SET movie_count = (SELECT count(*) '
+        'FROM "Association" WHERE "Association".actor_id = actor.id)')
+    op.execute(
+        'UPDATE movie SET actor_count = (SELECT count(*) '
+        'FROM "Association" WHERE "Association".movie_id = movie.id)')
+    # the same keys as models.actor_stat_keys and models.movie_stat_keys
+    op.execute(
+        'INSERT INTO catalog_stat (name, key, value) '
+        'SELECT name, key, value FROM ('
+        "SELECT 'actors' AS name, 'total' AS key, count(*) AS value "
+        'FROM actor '
+        "UNION ALL SELECT 'actor_age', CASE WHEN age IS NULL "
+        "THEN 'unknown' ELSE CAST(age / 10 * 10 AS TEXT) || '-' || "
+        'CAST(age / 10 * 10 + 9 AS TEXT) END, count(*) '
+        'FROM actor GROUP BY 2 '
+        "UNION ALL SELECT 'actor_gender', coalesce(gender, 'unknown'), "
+        'count(*) FROM actor GROUP BY 2 '
+        "UNION ALL SELECT 'actor_movies', CAST(movie_count AS TEXT), "
+        'count(*) FROM actor GROUP BY 2 '
+        "UNION ALL SELECT 'movies', 'total', count(*) FROM movie "
+        "UNION ALL SELECT 'movie_year', CAST(CAST(EXTRACT(YEAR FROM "
+        'release_date) AS INTEGER) AS TEXT), count(*) '
+        'FROM movie GROUP BY 2 '
+        "UNION ALL SELECT 'movie_actors', CAST(actor_count AS TEXT), "
+        'count(*) FROM movie GROUP BY 2 '
+        "UNION ALL SELECT 'links', 'total', count(*) FROM \"Association\""
+        ') AS stats WHERE value > 0')
+
+
+def downgrade():
+    op.drop_table('catalog_stat')
+    op.drop_column('movie', 'actor_count')
+    op.drop_column('actor', 'movie_count')
@@ -0,0 +1,36 @@
+"""add link_change log for the co-star graph
+
+Revision ID: 6d0b7e4c1f93
+Revises: 3c5e8f2a9d41
+Create Date: 2026-10-18 23:58:02.117436
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6d0b7e4c1f93'
+down_revision = '3c5e8f2a9d41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'link_change',
+        sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+                  nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('added', sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_link_change_version'), 'link_change',
+                    ['version'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_link_change_version'), table_name='link_change')
+    op.drop_table('link_change')
@@ -0,0 +1,59 @@
+"""add keys and indexes to Association
+
+Revision ID: 7c1baa795ec5
+Revises: b9c16beed672
+Create Date: 2026-10-18 21:02:47.120934
+
+The table is rebuilt rather than altered: its foreign keys were created
+without names, and copying the distinct non-null pairs into the new table
+is also what removes the duplicated rows.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1baa795ec5'
+down_revision = 'b9c16beed672'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Association_keyed',
+                    sa.Column('movie_id', sa.Integer(), nullable=False),
+                    sa.Column('actor_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ['movie_id'], ['movie.id'],
+                        name='fk_association_movie_id', ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(
+                        ['actor_id'], ['actor.id'],
+                        name='fk_association_actor_id', ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint(
+                        'movie_id', 'actor_id', name='pk_association')
+                    )
+    op.execute(
+        'INSERT INTO "Association_keyed" (movie_id, actor_id) '
+        'SELECT DISTINCT movie_id, actor_id FROM "Association" '
+        'WHERE movie_id IS NOT NULL AND actor_id IS NOT NULL')
+    op.drop_table('Association')
+    op.rename_table('Association_keyed', 'Association')
+    op.create_index('ix_association_actor_id_movie_id', 'Association',
+                    ['actor_id', 'movie_id'])
+
+
+def downgrade():
+    op.create_table('Association_unkeyed',
+                    sa.Column('movie_id', sa.Integer(), nullable=True),
+                    sa.Column('actor_id', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['actor_id'], ['actor.id'], ),
+                    sa.ForeignKeyConstraint(['movie_id'], ['movie.id'], )
+                    )
+    op.execute(
+        'INSERT INTO "Association_unkeyed" (movie_id, actor_id) '
+        'SELECT movie_id, actor_id FROM "Association"')
+    op.drop_index('ix_association_actor_id_movie_id',
+                  table_name='Association')
+    op.drop_table('Association')
+    op.rename_table('Association_unkeyed', 'Association')
@@ -0,0 +1,31 @@
+"""add sort indexes for keyset pagination
+
+Revision ID: b9c16beed672
+Revises: 9f2bf454d727
+Create Date: 2026-10-18 20:31:12.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b9c16beed672'
+down_revision = '9f2bf454d727'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actor_name_id', 'actor', ['name', 'id'])
+    op.create_index('ix_actor_age_id', 'actor', ['age', 'id'])
+    op.create_index('ix_movie_title_id', 'movie', ['title', 'id'])
+    op.create_index('ix_movie_release_date_id', 'movie',
+                    ['release_date', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_movie_release_date_id', table_name='movie')
+    op.drop_index('ix_movie_title_id', table_name='movie')
+    op.drop_index('ix_actor_age_id', table_name='actor')
+    op.drop_index('ix_actor_name_id', table_name='actor')
@@ -0,0 +1,33 @@
+"""add collection_version for ETags
+
+Revision ID: ee4944646789
+Revises: f76b9249625b
+Create Date: 2026-10-18 21:48:30.664271
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ee4944646789'
+down_revision = 'f76b9249625b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    collection_version = op.create_table(
+        'collection_version',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(collection_version, [
+        {'name': 'actors', 'version': 1},
+        {'name': 'movies', 'version': 1},
+    ])
+
+
+def downgrade():
+    op.drop_table('collection_version')
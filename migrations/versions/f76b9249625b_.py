@@ -0,0 +1,45 @@
+"""add search indexes for list filters
+
+Revision ID: f76b9249625b
+Revises: 7c1baa795ec5
+Create Date: 2026-10-18 21:24:05.337190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f76b9249625b'
+down_revision = '7c1baa795ec5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actor_gender_id', 'actor', ['gender', 'id'])
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE INDEX ix_actor_name_prefix ON actor '
+               '(lower(name) text_pattern_ops)')
+    op.execute('CREATE INDEX ix_movie_title_prefix ON movie '
+               '(lower(title) text_pattern_ops)')
+    # the trigram indexes need the pg_trgm extension on the server
+    if op.get_bind().execute(sa.text(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar() is None:
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX ix_actor_name_trgm ON actor '
+               'USING gin (name gin_trgm_ops)')
+    op.execute('CREATE INDEX ix_movie_title_trgm ON movie '
+               'USING gin (title gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_movie_title_trgm')
+        op.drop_index('ix_movie_title_prefix', table_name='movie')
+        op.execute('DROP INDEX IF EXISTS ix_actor_name_trgm')
+        op.drop_index('ix_actor_name_prefix', table_name='actor')
+    op.drop_index('ix_actor_gender_id', table_name='actor')
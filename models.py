@@ -1,7 +1,20 @@
 import os
-from sqlalchemy import Column, String, Integer, ForeignKey, Table
-from flask_sqlalchemy import SQLAlchemy
+import sqlite3
+import time
+from collections import Counter
+from datetime import datetime
+from dateutil import parser as date_parser
+from sqlalchemy import (
+    DDL, Column, String, Integer, ForeignKey, Index, Table, and_, column,
+    event, func, inspect, select, text, tuple_
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import attributes, sessionmaker
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
+from db_pool import engine_options
 import json
 
 database_name = "capstone"
@@ -14,7 +27,28 @@ local_db_path = "postgresql://{}:{}@{}/{}".format(
     database_name)
 database_path = os.getenv('DATABASE_URL', local_db_path)
 
-db = SQLAlchemy()
+'''
+RoutingSession
+Session that sends the statements of a request to `g.read_engine` when
+it is set, see replicas.py. Flushes always go to the primary.
+'''
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and not self._flushing:
+            engine = g.get('read_engine')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
@@ -25,50 +59,728 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
     Migrate(app, db)
 
 
+'''
+SQLite only enforces foreign keys, and so the ON DELETE CASCADE of the
+Association table, when asked to on every connection
+'''
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+'''
+parse_datetime(value)
+    accepts a datetime or a string such as "2020-09-19 19:09:33.774860"
+'''
+
+
+def parse_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return date_parser.parse(value)
+
+
+'''
+CollectionVersion
+Counter bumped by every write to a collection, in the same transaction,
+from which the ETags of GET /actors and GET /movies are derived. The
+representation of a movie embeds its actors and the other way round, so
+a change to either side of a link bumps both collections.
+'''
+
+
+class CollectionVersion(db.Model):
+    __tablename__ = 'collection_version'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+'''
+Functions called after a commit that bumped collection versions, with
+the {name: version} of the collections bumped, so in-process caches can
+take the new versions
+'''
+version_listeners = []
+
+
+''' Bumps the versions of the collections `names` and returns their new
+    {name: version}. The rows are locked until the transaction ends,
+    always in the order of their names, so that two writes bumping the
+    same collections cannot deadlock: a transaction bumps all its
+    collections in one call. The version_listeners get the new versions
+    once the transaction commits.
+'''
+
+
+def bump_versions(*names):
+    table = CollectionVersion.__table__
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    bumped = {}
+    for name in sorted(set(names)):
+        statement = table.update().where(table.c.name == name).values(
+            version=table.c.version + 1)
+        if postgres:
+            version = db.session.execute(
+                statement.returning(table.c.version)).scalar()
+        elif db.session.execute(statement).rowcount:
+            version = get_versions(name)[name]
+        else:
+            version = None
+        if version is None:
+            # start from the clock rather than 1, so a recreated table
+            # does not reuse the ETags of the dropped one
+            version = int(time.time() * 1000)
+            db.session.execute(table.insert().values(
+                name=name, version=version))
+        bumped[name] = version
+    db.session.info.setdefault('bumped_versions', {}).update(bumped)
+    return bumped
+
+
+def get_versions(*names):
+    table = CollectionVersion.__table__
+    versions = dict.fromkeys(names, 0)
+    versions.update(db.session.execute(
+        select([table.c.name, table.c.version]).where(
+            table.c.name.in_(names))).fetchall())
+    return versions
+
+
+'''
+LinkChange
+Log of the links added and removed, under the version of the `links`
+collection bumped by their transaction. That transaction holds the lock
+of the version row until it commits, so the log becomes visible in
+version order and a reader can follow it without missing any change
+(see graph.py). Writes that change links without logging them, such as
+flask seed, still bump the version.
+'''
+
+
+class LinkChange(db.Model):
+    __tablename__ = 'link_change'
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'),
+                   primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, index=True)
+    movie_id = db.Column(db.Integer, nullable=False)
+    actor_id = db.Column(db.Integer, nullable=False)
+    added = db.Column(db.Boolean, nullable=False)
+
+
+'''
+Functions called after a commit that changed links, with the lists of
+(movie_id, actor_id) pairs added and removed
+'''
+link_listeners = []
+
+
+''' Logs the links added and removed in the current transaction, bumping
+    the versions of the collections `names` together with the one of the
+    links. The link_listeners get the pairs once the transaction commits.
+'''
+
+
+def log_links(added, removed, *names):
+    if added or removed:
+        names += ('links',)
+    version = bump_versions(*names).get('links')
+    if added or removed:
+        rows = [{'version': version, 'movie_id': movie, 'actor_id': actor,
+                 'added': change}
+                for pairs, change in ((added, True), (removed, False))
+                for movie, actor in pairs]
+        for chunk in chunks(rows):
+            db.session.execute(LinkChange.__table__.insert(), chunk)
+        db.session.info.setdefault('links_changed', []).append(
+            (added, removed))
+
+
+''' Logs the links and commits. The actors and movies relationships of
+    the instances the session holds on either side of a link are expired
+    first, so they are read again with the new links.
+'''
+
+
+def commit_links(added, removed, *names):
+    log_links(added, removed, *names)
+    pairs = list(added) + list(removed)
+    for model, ids in ((Movie, {movie for movie, _ in pairs}),
+                       (Actor, {actor for _, actor in pairs})):
+        for id in held_ids(model, ids):
+            db.session.expire(db.session.identity_map[
+                db.session.identity_key(model, id)], [LINKS[model]])
+    db.session.commit()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def notify_commit(session):
+    bumped = session.info.pop('bumped_versions', None)
+    if bumped:
+        for listener in version_listeners:
+            listener(bumped)
+    for added, removed in session.info.pop('links_changed', ()):
+        for listener in link_listeners:
+            listener(added, removed)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_rollback(session):
+    session.info.pop('bumped_versions', None)
+    session.info.pop('links_changed', None)
+
+
+'''
+CatalogStat
+Aggregates behind GET /stats/actors and GET /stats/movies. Each row counts
+the actors or the movies with one value of a property: `name` is the
+property, such as actor_gender or movie_year, and `key` the value. Every
+write updates them in its own transaction (see add_stats), and `flask
+rebuild-stats` computes them again from the tables (see stats.py).
+'''
+
+
+class CatalogStat(db.Model):
+    __tablename__ = 'catalog_stat'
+    name = db.Column(db.String(50), primary_key=True)
+    key = db.Column(db.String, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+UNKNOWN = 'unknown'
+
+
+def age_bucket(age):
+    if age is None:
+        return UNKNOWN
+    start = age // 10 * 10
+    return '{}-{}'.format(start, start + 9)
+
+
+def actor_stat_keys(age, gender, movie_count=0):
+    return [('actors', 'total'),
+            ('actor_age', age_bucket(age)),
+            ('actor_gender', UNKNOWN if gender is None else gender),
+            ('actor_movies', str(movie_count))]
+
+
+def movie_stat_keys(year, actor_count=0):
+    return [('movies', 'total'),
+            ('movie_year', str(year)),
+            ('movie_actors', str(actor_count))]
+
+
+'''
+add_stats(deltas)
+    adds the {(name, key): delta} changes to the CatalogStat rows in the
+    current transaction. The rows are updated in key order, so concurrent
+    writers lock them in the same order.
+'''
+
+
+def add_stats(deltas):
+    table = CatalogStat.__table__
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    for (name, key), delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        if postgres:
+            statement = pg_insert(table).values(
+                name=name, key=key, value=delta)
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.name, table.c.key],
+                set_={'value': table.c.value + statement.excluded.value}))
+            continue
+        result = db.session.execute(table.update().where(and_(
+            table.c.name == name, table.c.key == key)).values(
+                value=table.c.value + delta))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(
+                name=name, key=key, value=delta))
+
+
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 1000))
+
+
+def chunks(rows, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+'''
+bulk_insert(table, rows)
+    inserts the rows in the current transaction and returns their ids, in
+    the same order. On Postgres the ids of each chunk of BULK_CHUNK_SIZE
+    rows are first taken from the sequence of the table, one nextval per
+    row, and the chunk is then a single multi-row INSERT of rows carrying
+    their id, so an id belongs to its row whatever order Postgres assigns
+    or returns them in. Other databases insert all the rows with one
+    executemany and read the ids back with one query: the highest ids of
+    the table, which are the new rows once the transaction holds the
+    write lock of the table, as on SQLite.
+'''
+
+
+def bulk_insert(table, rows):
+    ids = []
+    if db.session.get_bind().dialect.name == 'postgresql':
+        sequence = func.pg_get_serial_sequence(table.name, table.c.id.name)
+        for chunk in chunks(rows):
+            chunk_ids = [row[0] for row in db.session.execute(
+                select([func.nextval(sequence)]).select_from(
+                    func.generate_series(1, len(chunk))))]
+            db.session.execute(table.insert().values([
+                dict(row, id=id) for row, id in zip(chunk, chunk_ids)]))
+            ids.extend(chunk_ids)
+    elif rows:
+        db.session.execute(table.insert(), rows)
+        ids = [row[0] for row in db.session.execute(
+            select([table.c.id]).order_by(table.c.id.desc())
+            .limit(len(rows)))][::-1]
+    return ids
+
+
 association_table = Table('Association', db.Model.metadata,
-                          Column('movie_id', Integer, ForeignKey('movie.id')),
-                          Column('actor_id', Integer, ForeignKey('actor.id'))
+                          Column('movie_id', Integer,
+                                 ForeignKey('movie.id', ondelete='CASCADE'),
+                                 primary_key=True),
+                          Column('actor_id', Integer,
+                                 ForeignKey('actor.id', ondelete='CASCADE'),
+                                 primary_key=True),
+                          Index('ix_association_actor_id_movie_id',
+                                'actor_id', 'movie_id')
                           )
 
 
+'''
+add_link_counts(column, histogram, counts, deltas)
+    adds counts[id] to the link counter `column` (actor.movie_count or
+    movie.actor_count) of each id, and moves the ids between the keys of
+    the `histogram` stat accordingly in `deltas`. The counters are
+    incremented in place, one UPDATE per chunk of ids getting the same
+    increment, and the new values read back (with RETURNING on
+    Postgres), so concurrent writers do not lose each other's changes.
+'''
+
+
+def add_link_counts(column, histogram, counts, deltas):
+    table = column.table
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    increments = {}
+    for id, count in counts.items():
+        if count:
+            increments.setdefault(count, []).append(id)
+    for increment, ids in sorted(increments.items()):
+        for chunk in chunks(sorted(ids)):
+            statement = table.update().where(table.c.id.in_(chunk)).values(
+                {column.key: column + increment})
+            if postgres:
+                values = db.session.execute(statement.returning(column))
+            else:
+                db.session.execute(statement)
+                values = db.session.execute(
+                    select([column]).where(table.c.id.in_(chunk)))
+            for (value,) in values:
+                deltas[(histogram, str(value - increment))] -= 1
+                deltas[(histogram, str(value))] += 1
+
+
+''' Updates the link counters and the stats after `pairs` were linked
+    (sign 1) or unlinked (sign -1)
+'''
+
+
+def count_links(pairs, sign, deltas):
+    movie_counts = Counter()
+    actor_counts = Counter()
+    for movie, actor in pairs:
+        movie_counts[movie] += sign
+        actor_counts[actor] += sign
+    add_link_counts(Movie.__table__.c.actor_count, 'movie_actors',
+                    movie_counts, deltas)
+    add_link_counts(Actor.__table__.c.movie_count, 'actor_movies',
+                    actor_counts, deltas)
+    deltas[('links', 'total')] += sign * len(pairs)
+
+
+def existing_pairs(chunk):
+    movie_id = association_table.c.movie_id
+    actor_id = association_table.c.actor_id
+    return set(map(tuple, db.session.execute(
+        select([movie_id, actor_id]).where(
+            tuple_(movie_id, actor_id).in_(chunk)))))
+
+
+'''
+link(pairs)
+    adds the (movie_id, actor_id) pairs to the Association table in one
+    transaction, skipping the pairs that are already linked, and returns
+    the number of new links. On Postgres each chunk is a single INSERT
+    that lets the primary key discard the duplicates (ON CONFLICT DO
+    NOTHING) and returns the pairs it added; elsewhere the pairs already
+    linked are read first.
+'''
+
+
+def link(pairs):
+    movie_id = association_table.c.movie_id
+    actor_id = association_table.c.actor_id
+    linked = []
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    for chunk in chunks(sorted(set(pairs))):
+        if postgres:
+            rows = [{'movie_id': movie, 'actor_id': actor}
+                    for movie, actor in chunk]
+            linked.extend(db.session.execute(
+                pg_insert(association_table).values(rows)
+                .on_conflict_do_nothing().returning(movie_id, actor_id)))
+            continue
+        existing = existing_pairs(chunk)
+        rows = [{'movie_id': movie, 'actor_id': actor}
+                for movie, actor in chunk if (movie, actor) not in existing]
+        if rows:
+            db.session.execute(association_table.insert(), rows)
+        linked.extend((row['movie_id'], row['actor_id']) for row in rows)
+    deltas = Counter()
+    count_links(linked, 1, deltas)
+    add_stats(deltas)
+    commit_links(linked, [], 'actors', 'movies')
+    return len(linked)
+
+
+'''
+unlink(pairs)
+    removes the (movie_id, actor_id) pairs from the Association table in
+    one transaction and returns the number of removed links
+'''
+
+
+def unlink(pairs):
+    movie_id = association_table.c.movie_id
+    actor_id = association_table.c.actor_id
+    unlinked = []
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    for chunk in chunks(sorted(set(pairs))):
+        statement = association_table.delete().where(
+            tuple_(movie_id, actor_id).in_(chunk))
+        if postgres:
+            unlinked.extend(db.session.execute(
+                statement.returning(movie_id, actor_id)))
+            continue
+        existing = existing_pairs(chunk)
+        db.session.execute(statement)
+        unlinked.extend(existing)
+    deltas = Counter()
+    count_links(unlinked, -1, deltas)
+    add_stats(deltas)
+    commit_links([], unlinked, 'actors', 'movies')
+    return len(unlinked)
+
+
+def row_dicts(table, rows):
+    return [dict(zip(table.c.keys(), row)) for row in rows]
+
+
+'''
+held_ids(model, ids)
+    the ids of the rows for which the session holds an instance of
+    `model`. The set-based writes run Core statements that the identity
+    map does not see, so they refresh these instances themselves.
+'''
+
+
+def held_ids(model, ids):
+    identity_map = db.session.identity_map
+    return [id for id in ids
+            if db.session.identity_key(model, id) in identity_map]
+
+
+''' Reloads, with one SELECT, the instances of `model` the session holds
+    for these ids, once a Core UPDATE has changed their rows. A request
+    starts with an empty session, so this only costs a query to code that
+    loaded the objects first, like the tests and the instance methods.
+'''
+
+
+def refresh_instances(model, ids):
+    ids = held_ids(model, ids)
+    if ids:
+        model.query.filter(model.id.in_(ids)).populate_existing().all()
+
+
+''' Removes from the session the instances it holds for rows a Core
+    DELETE removed, before the commit expires them. They keep the values
+    they were loaded with, as an instance deleted by the ORM does.
+'''
+
+
+def forget_instances(model, ids):
+    for id in held_ids(model, ids):
+        db.session.expunge(db.session.identity_map[
+            db.session.identity_key(model, id)])
+
+
+''' The values of `names` assigned to the object since it was loaded '''
+
+
+def changed_values(obj, names):
+    attrs = inspect(obj).attrs
+    return {name: attrs[name].history.added[0] for name in names
+            if attrs[name].history.added}
+
+
+'''
+update_rows(table, names, changes, old_columns)
+    applies the (id, {column: value}) changes to the columns `names` of
+    the rows of `table` in the current transaction and returns, for every
+    row found, the values of `old_columns` before the change and the
+    whole row after it, as dicts. On Postgres each chunk is a single
+    UPDATE: the changes are joined from arrays with unnest(), the old
+    values are read by a subquery that locks the rows, and the new ones
+    come back with RETURNING. A column left out of the changes keeps its
+    value. Other databases read the old rows first and update row by row.
+'''
+
+
+def update_rows(table, names, changes, old_columns):
+    updated = []
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    for chunk in chunks(sorted(changes, key=lambda change: change[0])):
+        ids = [id for id, _ in chunk]
+        old = select([table.c.id] + [table.c[name] for name in old_columns])
+        old = old.where(table.c.id.in_(ids))
+        if postgres:
+            updated.extend(update_chunk(table, chunk, names, old_columns,
+                                        old.with_for_update().alias('old')))
+            continue
+        previous = {row[0]: row[1:] for row in db.session.execute(old)}
+        for id, values in chunk:
+            if id in previous and values:
+                db.session.execute(table.update().where(
+                    table.c.id == id).values(values))
+        rows = row_dicts(table, db.session.execute(
+            table.select().where(table.c.id.in_(ids))))
+        updated.extend((dict(zip(old_columns, previous[row['id']])), row)
+                       for row in rows)
+    return updated
+
+
+def update_chunk(table, chunk, names, old_columns, old):
+    dialect = db.session.get_bind().dialect
+    arrays = {}
+    casts = []
+    for index, name in enumerate(['id'] + names):
+        arrays['v{}'.format(index)] = [
+            id if name == 'id' else values.get(name) for id, values in chunk]
+        casts.append('CAST(:v{} AS {}[])'.format(
+            index, table.c[name].type.compile(dialect=dialect)))
+    change = text('SELECT * FROM unnest({}) AS change({})'.format(
+        ', '.join(casts), ', '.join(['id'] + names))).bindparams(**arrays)
+    change = change.columns(*[column(name, table.c[name].type)
+                              for name in ['id'] + names]).alias('change')
+    statement = table.update().where(and_(
+        table.c.id == change.c.id, table.c.id == old.c.id)).values({
+            name: func.coalesce(change.c[name], table.c[name])
+            for name in names})
+    rows = db.session.execute(statement.returning(
+        *[old.c[name] for name in old_columns] + list(table.c)))
+    count = len(old_columns)
+    return [(dict(zip(old_columns, row[:count])),
+             dict(zip(table.c.keys(), row[count:]))) for row in rows]
+
+
+'''
+delete_rows(table, link, ids)
+    deletes the rows of `table` with these ids, and their links, in the
+    current transaction, and returns the deleted rows as dicts and the
+    (movie_id, actor_id) pairs of the removed links. `link` is the
+    Association column pointing at `table`. On Postgres the rows are
+    locked first, so no link can be added to them meanwhile, then the
+    links and the rows are deleted with RETURNING; elsewhere they are
+    read before being deleted.
+'''
+
+
+def delete_rows(table, link, ids):
+    movie_id = association_table.c.movie_id
+    actor_id = association_table.c.actor_id
+    rows = []
+    unlinked = []
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    for chunk in chunks(sorted(set(ids))):
+        links = association_table.delete().where(link.in_(chunk))
+        statement = table.delete().where(table.c.id.in_(chunk))
+        if postgres:
+            db.session.execute(select([table.c.id]).where(
+                table.c.id.in_(chunk)).with_for_update())
+            unlinked.extend(map(tuple, db.session.execute(
+                links.returning(movie_id, actor_id))))
+            rows.extend(row_dicts(table, db.session.execute(
+                statement.returning(*table.c))))
+            continue
+        unlinked.extend(map(tuple, db.session.execute(
+            select([movie_id, actor_id]).where(link.in_(chunk)))))
+        rows.extend(row_dicts(table, db.session.execute(
+            table.select().where(table.c.id.in_(chunk)))))
+        db.session.execute(links)
+        db.session.execute(statement)
+    return rows, unlinked
+
+
 class Movie(db.Model):
+    __table_args__ = (
+        db.Index('ix_movie_title_id', 'title', 'id'),
+        db.Index('ix_movie_release_date_id', 'release_date', 'id'),
+    )
+
+    FIELDS = ('id', 'title', 'release_date')
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
     release_date = db.Column(db.DateTime, nullable=False)
+    # number of linked actors, see add_link_counts
+    actor_count = db.Column(db.Integer, nullable=False, default=0,
+                            server_default='0')
     actors = db.relationship(
         'Actor',
         secondary=association_table,
+        order_by='Actor.id',
         back_populates="movies")
 
     def __init__(self, title, release_date):
         self.title = title
-        self.release_date = release_date
+        self.release_date = parse_datetime(release_date)
+
+    def stat_keys(self):
+        return movie_stat_keys(self.release_date.year, self.actor_count or 0)
 
     def create(self):
         db.session.add(self)
+        add_stats(Counter(self.stat_keys()))
         db.session.commit()
 
-    def patch(self):
+    """ Validates a JSON object received by the API, returning the
+        column values or raising ValueError with the reason
+        With `partial` only the fields given a value are validated and
+        returned, as for a PATCH.
+    """
+
+    @staticmethod
+    def validate(data, partial=False):
+        if not isinstance(data, dict):
+            raise ValueError('Expected an object')
+        values = {}
+        title = data.get('title')
+        if title or not partial:
+            if not isinstance(title, str) or not title:
+                raise ValueError('title must be a non-empty string')
+            values['title'] = title
+        release_date = data.get('release_date')
+        if release_date or not partial:
+            if not isinstance(release_date, str):
+                raise ValueError('release_date must be a date string')
+            try:
+                values['release_date'] = parse_datetime(release_date)
+            except (ValueError, OverflowError):
+                raise ValueError('release_date must be a date string')
+        return values
+
+    """ Inserts the validated rows in one transaction, returns their ids """
+
+    @classmethod
+    def bulk_create(cls, rows):
+        ids = bulk_insert(cls.__table__, rows)
+        deltas = Counter()
+        for row in rows:
+            deltas.update(movie_stat_keys(row['release_date'].year))
+        add_stats(deltas)
+        bump_versions('movies')
         db.session.commit()
+        return ids
 
-    def delete(self):
-        db.session.delete(self)
+    """ Applies the (id, values) changes in one transaction, returns the
+        changed rows. The instances the session holds for them are
+        reloaded.
+    """
+
+    @classmethod
+    def bulk_patch(cls, changes):
+        rows = update_rows(cls.__table__, ['title', 'release_date'],
+                           changes, ['release_date'])
+        if not rows:
+            db.session.rollback()
+            return []
+        deltas = Counter()
+        for old, row in rows:
+            deltas.update(movie_stat_keys(row['release_date'].year,
+                                          row['actor_count']))
+            deltas.subtract(movie_stat_keys(old['release_date'].year,
+                                            row['actor_count']))
+        add_stats(deltas)
+        bump_versions('actors', 'movies')
         db.session.commit()
+        refresh_instances(cls, [row['id'] for _, row in rows])
+        return [row for _, row in rows]
 
-    """ JSON representation of an object """
+    """ Deletes the movies and their links in one transaction, returns
+        the deleted rows and the (movie_id, actor_id) pairs of the
+        removed links
+    """
 
-    def json(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date.strftime("%Y-%m-%d %H:%M:%S.%f"),
-            'actors': [actor.shortJson() for actor in self.actors]
-        }
+    @classmethod
+    def bulk_delete(cls, ids):
+        rows, unlinked = delete_rows(cls.__table__,
+                                     association_table.c.movie_id, ids)
+        if not rows:
+            db.session.rollback()
+            return [], []
+        deltas = Counter()
+        for row in rows:
+            deltas.subtract(movie_stat_keys(row['release_date'].year,
+                                            row['actor_count']))
+        count_links(unlinked, -1, deltas)
+        add_stats(deltas)
+        forget_instances(cls, [row['id'] for row in rows])
+        commit_links([], unlinked, 'actors', 'movies')
+        return rows, unlinked
+
+    """ Writes the attributes assigned on the instance with bulk_patch """
+
+    def patch(self):
+        values = changed_values(self, ['title', 'release_date'])
+        if 'release_date' in values:
+            values['release_date'] = parse_datetime(values['release_date'])
+        db.session.expire(self, list(values))
+        self.bulk_patch([(self.id, values)])
+
+    def delete(self):
+        self.bulk_delete([self.id])
+
+    """ JSON representation of an object
+        Restricted to `fields` when given, and including the linked
+        actors when `expand` is set
+    """
+
+    def json(self, fields=None, expand=True):
+        data = {}
+        for field in fields or self.FIELDS:
+            data[field] = getattr(self, field)
+        if 'release_date' in data:
+            data['release_date'] = \
+                self.release_date.strftime("%Y-%m-%d %H:%M:%S.%f")
+        if expand:
+            data['actors'] = [actor.shortJson() for actor in self.actors]
+        return data
 
     """ Shorter JSON representation of an object
         Does not include information about the linked actors
@@ -86,13 +798,25 @@ class Movie(db.Model):
 
 
 class Actor(db.Model):
+    __table_args__ = (
+        db.Index('ix_actor_name_id', 'name', 'id'),
+        db.Index('ix_actor_age_id', 'age', 'id'),
+        db.Index('ix_actor_gender_id', 'gender', 'id'),
+    )
+
+    FIELDS = ('id', 'name', 'age', 'gender')
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
     age = db.Column(db.Integer, nullable=True)
     gender = db.Column(db.String, nullable=True)
+    # number of linked movies, see add_link_counts
+    movie_count = db.Column(db.Integer, nullable=False, default=0,
+                            server_default='0')
     movies = db.relationship(
         'Movie',
         secondary=association_table,
+        order_by='Movie.id',
         back_populates="actors")
 
     def __init__(self, name, age, gender):
@@ -100,27 +824,125 @@ class Actor(db.Model):
         self.age = age
         self.gender = gender
 
+    def stat_keys(self):
+        return actor_stat_keys(self.age, self.gender, self.movie_count or 0)
+
     def create(self):
         db.session.add(self)
+        add_stats(Counter(self.stat_keys()))
         db.session.commit()
 
-    def patch(self):
+    """ Validates a JSON object received by the API, returning the
+        column values or raising ValueError with the reason
+        With `partial` only the fields given a value are validated and
+        returned, as for a PATCH.
+    """
+
+    @staticmethod
+    def validate(data, partial=False):
+        if not isinstance(data, dict):
+            raise ValueError('Expected an object')
+        values = {}
+        name = data.get('name')
+        if name or not partial:
+            if not isinstance(name, str) or not name or len(name) > 200:
+                raise ValueError(
+                    'name must be a string of 1 to 200 characters')
+            values['name'] = name
+        age = data.get('age')
+        if age or not partial:
+            if age is not None and (isinstance(age, bool) or
+                                    not isinstance(age, int) or age < 0):
+                raise ValueError('age must be a non-negative integer')
+            values['age'] = age
+        gender = data.get('gender')
+        if gender or not partial:
+            if gender is not None and not isinstance(gender, str):
+                raise ValueError('gender must be a string')
+            values['gender'] = gender
+        return values
+
+    """ Inserts the validated rows in one transaction, returns their ids """
+
+    @classmethod
+    def bulk_create(cls, rows):
+        ids = bulk_insert(cls.__table__, rows)
+        deltas = Counter()
+        for row in rows:
+            deltas.update(actor_stat_keys(row['age'], row['gender']))
+        add_stats(deltas)
+        bump_versions('actors')
         db.session.commit()
+        return ids
 
-    def delete(self):
-        db.session.delete(self)
+    """ Applies the (id, values) changes in one transaction, returns the
+        changed rows. The instances the session holds for them are
+        reloaded.
+    """
+
+    @classmethod
+    def bulk_patch(cls, changes):
+        rows = update_rows(cls.__table__, ['name', 'age', 'gender'],
+                           changes, ['age', 'gender'])
+        if not rows:
+            db.session.rollback()
+            return []
+        deltas = Counter()
+        for old, row in rows:
+            deltas.update(actor_stat_keys(row['age'], row['gender'],
+                                          row['movie_count']))
+            deltas.subtract(actor_stat_keys(old['age'], old['gender'],
+                                            row['movie_count']))
+        add_stats(deltas)
+        bump_versions('actors', 'movies')
         db.session.commit()
+        refresh_instances(cls, [row['id'] for _, row in rows])
+        return [row for _, row in rows]
 
-    """ JSON representation of an object """
+    """ Deletes the actors and their links in one transaction, returns
+        the deleted rows and the (movie_id, actor_id) pairs of the
+        removed links
+    """
 
-    def json(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age,
-            'gender': self.gender,
-            'movies': [movie.shortJson() for movie in self.movies]
-        }
+    @classmethod
+    def bulk_delete(cls, ids):
+        rows, unlinked = delete_rows(cls.__table__,
+                                     association_table.c.actor_id, ids)
+        if not rows:
+            db.session.rollback()
+            return [], []
+        deltas = Counter()
+        for row in rows:
+            deltas.subtract(actor_stat_keys(row['age'], row['gender'],
+                                            row['movie_count']))
+        count_links(unlinked, -1, deltas)
+        add_stats(deltas)
+        forget_instances(cls, [row['id'] for row in rows])
+        commit_links([], unlinked, 'actors', 'movies')
+        return rows, unlinked
+
+    """ Writes the attributes assigned on the instance with bulk_patch """
+
+    def patch(self):
+        values = changed_values(self, ['name', 'age', 'gender'])
+        db.session.expire(self, list(values))
+        self.bulk_patch([(self.id, values)])
+
+    def delete(self):
+        self.bulk_delete([self.id])
+
+    """ JSON representation of an object
+        Restricted to `fields` when given, and including the linked
+        movies when `expand` is set
+    """
+
+    def json(self, fields=None, expand=True):
+        data = {}
+        for field in fields or self.FIELDS:
+            data[field] = getattr(self, field)
+        if expand:
+            data['movies'] = [movie.shortJson() for movie in self.movies]
+        return data
 
     """ Shorter JSON representation of an object
         Does not include information about the linked movies
@@ -136,3 +958,96 @@ class Actor(db.Model):
 
     def __repr__(self):
         return json.dumps(self.json())
+
+
+'''
+ORM writes (db.session.add, movie.actors.append, ...) bump the versions
+of the collections they change in their own flush, and log the links
+they add or remove like link() and unlink() do. A link removed with an
+object whose collection was never loaded is not known one by one: the
+links version is bumped without logging it, and the co-star graphs load
+again (see graph.py). The set-based writes run Core statements, which
+do not flush, and bump the versions themselves.
+'''
+
+LINKS = {Actor: 'movies', Movie: 'actors'}
+
+
+def link_pair(obj, other):
+    return (obj.id, other.id) if isinstance(obj, Movie) else \
+        (other.id, obj.id)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def bump_flushed_versions(session, flush_context):
+    names = set()
+    added = set()
+    removed = set()
+    logged = True
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        key = LINKS.get(type(obj))
+        if key is None:
+            continue
+        history = attributes.get_history(
+            obj, key, passive=attributes.PASSIVE_NO_INITIALIZE)
+        if obj in session.deleted:
+            names.update(('actors', 'movies'))
+            if key not in inspect(obj).dict:
+                logged = False
+            removed.update(link_pair(obj, other) for other in history.sum())
+            continue
+        if obj in session.new:
+            names.add('actors' if isinstance(obj, Actor) else 'movies')
+        elif session.is_modified(obj, include_collections=False):
+            names.update(('actors', 'movies'))
+        added.update(link_pair(obj, other) for other in history.added or ())
+        removed.update(link_pair(obj, other)
+                       for other in history.deleted or ())
+    if added or removed or not logged:
+        names.update(('actors', 'movies'))
+    if not logged:
+        bump_versions('links', *names)
+    elif names:
+        log_links(sorted(added), sorted(removed), *names)
+
+
+'''
+Postgres-only indexes for the name and title searches: a text_pattern_ops
+index on lower() for prefixes, and a trigram index for substrings. The
+trigram indexes are only created when the server provides the pg_trgm
+extension; without them a substring search scans the table.
+'''
+
+search_indexes = {
+    Actor.__table__: [
+        ('CREATE INDEX ix_actor_name_prefix ON actor '
+         '(lower(name) text_pattern_ops)', False),
+        ('CREATE INDEX ix_actor_name_trgm ON actor '
+         'USING gin (name gin_trgm_ops)', True),
+    ],
+    Movie.__table__: [
+        ('CREATE INDEX ix_movie_title_prefix ON movie '
+         '(lower(title) text_pattern_ops)', False),
+        ('CREATE INDEX ix_movie_title_trgm ON movie '
+         'USING gin (title gin_trgm_ops)', True),
+    ],
+}
+
+
+def has_trgm(ddl, target, bind, **kw):
+    return bind.dialect.name == 'postgresql' and bind.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar() is not None
+
+
+event.listen(db.Model.metadata, 'before_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+        callable_=has_trgm))
+for table, statements in search_indexes.items():
+    for statement, trgm in statements:
+        if trgm:
+            ddl = DDL(statement).execute_if(callable_=has_trgm)
+        else:
+            ddl = DDL(statement).execute_if(dialect='postgresql')
+        event.listen(table, 'after_create', ddl)
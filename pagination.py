@@ -0,0 +1,143 @@
+import base64
+import json
+import os
+from datetime import datetime
+from sqlalchemy import DateTime, and_, or_, tuple_
+
+DEFAULT_LIMIT = int(os.getenv('PAGE_SIZE', 100))
+MAX_LIMIT = int(os.getenv('MAX_PAGE_SIZE', 1000))
+
+'''
+PaginationError Exception
+Raised for an invalid limit, sort, order or cursor parameter
+'''
+
+
+class PaginationError(Exception):
+    pass
+
+
+'''
+Cursors are opaque to the client: a url-safe base64 encoding of the sort
+used for the page and the (sort value, id) of its last row
+'''
+
+
+def encode_cursor(sort, order, value, id):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    data = json.dumps([sort, order, value, id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, column):
+    try:
+        sort, order, value, id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if value is not None and isinstance(column.type, DateTime):
+            value = datetime.fromisoformat(value)
+        return sort, order, value, int(id)
+    except (ValueError, TypeError):
+        raise PaginationError('Invalid cursor')
+
+
+""" Parameters of a page request
+
+    `sorts` maps the accepted values of the `sort` argument to the model
+    columns they order by. Each of them must be backed by an index on
+    (column, id).
+"""
+
+
+class Page:
+    def __init__(self, args, id_column, sorts):
+        self.id_column = id_column
+        self.sort = args.get('sort', 'id')
+        self.order = args.get('order', 'asc')
+        if self.sort not in sorts:
+            raise PaginationError('Unknown sort ' + self.sort)
+        if self.order not in ('asc', 'desc'):
+            raise PaginationError('Unknown order ' + self.order)
+        self.column = sorts[self.sort]
+        try:
+            self.limit = int(args.get('limit', DEFAULT_LIMIT))
+        except ValueError:
+            raise PaginationError('Invalid limit')
+        if not 0 < self.limit <= MAX_LIMIT:
+            raise PaginationError('Invalid limit')
+        self.after = None
+        cursor = args.get('cursor')
+        if cursor:
+            sort, order, value, id = decode_cursor(cursor, self.column)
+            if (sort, order) != (self.sort, self.order):
+                raise PaginationError('Cursor does not match the sort')
+            self.after = (value, id)
+
+    @property
+    def nullable(self):
+        return self.column is not self.id_column and self.column.nullable
+
+    def order_by(self):
+        if self.column is self.id_column:
+            if self.order == 'asc':
+                return [self.id_column.asc()]
+            return [self.id_column.desc()]
+        if self.order == 'asc':
+            column = self.column.asc()
+            if self.nullable:
+                column = column.nullslast()
+            return [column, self.id_column.asc()]
+        column = self.column.desc()
+        if self.nullable:
+            column = column.nullsfirst()
+        return [column, self.id_column.desc()]
+
+    """ Rows after the cursor, with nulls sorted after every value on
+        ascending order and before them on descending order
+    """
+
+    def after_cursor(self):
+        value, id = self.after
+        column, id_column = self.column, self.id_column
+        if column is id_column:
+            return id_column > id if self.order == 'asc' else id_column < id
+        if self.order == 'asc':
+            if value is None:
+                return and_(column.is_(None), id_column > id)
+            after = tuple_(column, id_column) > tuple_(value, id)
+            if self.nullable:
+                return or_(after, column.is_(None))
+            return after
+        if value is None:
+            return or_(and_(column.is_(None), id_column < id),
+                       column.isnot(None))
+        return tuple_(column, id_column) < tuple_(value, id)
+
+    def apply(self, query):
+        if self.after is not None:
+            query = query.filter(self.after_cursor())
+        return query.order_by(*self.order_by()).limit(self.limit + 1)
+
+    """ Same as apply(), for a Core select() statement """
+
+    def apply_select(self, select):
+        if self.after is not None:
+            select = select.where(self.after_cursor())
+        return select.order_by(*self.order_by()).limit(self.limit + 1)
+
+    """ Splits the rows fetched by apply() into the page and the cursor
+        for the next one, which is None on the last page
+    """
+
+    def split(self, rows, key=None):
+        rows = list(rows)
+        if len(rows) <= self.limit:
+            return rows, None
+        rows = rows[:self.limit]
+        last = rows[-1]
+        if key is None:
+            value = getattr(last, self.column.key)
+            id = getattr(last, self.id_column.key)
+        else:
+            value, id = key(last)
+        return rows, encode_cursor(self.sort, self.order, value, id)
@@ -0,0 +1,74 @@
+import cProfile
+import glob
+import json
+import os
+import tempfile
+import uuid
+from flask import make_response
+from querycount import request_query_counter
+
+PROFILE_DIR = os.getenv(
+    'PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'capstone-profiles'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 100))
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PERMISSION = os.getenv('PROFILE_PERMISSION', 'profile:api')
+
+'''
+On-demand profiling of a single request
+
+A request sent with the X-Profile header, by a token holding the
+PROFILE_PERMISSION permission, runs under cProfile. The profile is saved
+to PROFILE_DIR as a pstats dump, next to the SQL statements the request
+ran and how long each one took, and its id is returned in the
+X-Profile-Id response header. Only the PROFILE_KEEP newest profiles are
+kept. Requests without the header are not affected.
+'''
+
+
+def profile_path(profile_id, extension):
+    return os.path.join(PROFILE_DIR, '{}.{}'.format(profile_id, extension))
+
+
+def is_profile_id(value):
+    try:
+        return uuid.UUID(value).hex == value
+    except ValueError:
+        return False
+
+
+def prune():
+    paths = sorted(glob.glob(os.path.join(PROFILE_DIR, '*.pstats')),
+                   key=os.path.getmtime)
+    for path in paths[:max(len(paths) - PROFILE_KEEP, 0)]:
+        for extension in ('pstats', 'sql.json'):
+            try:
+                os.remove(path[:-len('pstats')] + extension)
+            except OSError:
+                pass
+
+
+''' Calls the handler `f` under the profiler and saves the profile. A
+    streamed body is read under the profiler too, since its generator is
+    what runs the queries, and is sent from memory.
+'''
+
+
+def profile(f, *args, **kwargs):
+    counter = request_query_counter()
+    counter.statements = []
+    profiler = cProfile.Profile()
+    try:
+        response = make_response(profiler.runcall(f, *args, **kwargs))
+        if response.is_streamed:
+            profiler.runcall(response.make_sequence)
+    finally:
+        statements = counter.statements
+        counter.statements = None
+    profile_id = uuid.uuid4().hex
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(profile_path(profile_id, 'pstats'))
+    with open(profile_path(profile_id, 'sql.json'), 'w') as sql:
+        json.dump(statements, sql, indent=2)
+    prune()
+    response.headers['X-Profile-Id'] = profile_id
+    return response
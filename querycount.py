@@ -0,0 +1,83 @@
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Counts the SQL statements sent to the database
+
+Every statement is added to the counter of the current request, reachable
+through request_query_counter(), and to the counters opened with
+count_queries() on the current thread, which is how the tests assert a
+query budget per endpoint. The counter of the request also adds up the
+time the statements took, and keeps the statements themselves when its
+`statements` list is set (see profiling.py).
+'''
+
+_local = threading.local()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = None
+
+    def __repr__(self):
+        return '<QueryCounter {}>'.format(self.count)
+
+
+def request_query_counter():
+    if 'query_counter' not in g:
+        g.query_counter = QueryCounter()
+    return g.query_counter
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        request_query_counter().count += 1
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+    for counter in getattr(_local, 'counters', ()):
+        counter.count += 1
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _time_query(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context():
+        counter = request_query_counter()
+        counter.seconds += elapsed
+        if counter.statements is not None:
+            counter.statements.append({
+                'statement': statement,
+                'parameters': repr(parameters),
+                'seconds': elapsed,
+            })
+
+
+@event.listens_for(Engine, 'handle_error')
+def _drop_query_start(context):
+    connection = context.connection
+    if connection is not None:
+        starts = connection.info.get('query_start')
+        if starts:
+            starts.pop()
@@ -0,0 +1,204 @@
+import math
+import os
+import uuid
+from flask import g, jsonify, request
+from kvstore import store
+
+'''
+Rate limits and admission control
+
+    RATE_LIMIT_PER_SECOND=20
+    RATE_LIMIT_BURST=200
+
+gives the subject of every token a bucket of RATE_LIMIT_BURST tokens,
+refilled with RATE_LIMIT_PER_SECOND tokens per second. Each request takes
+the cost of its route (ROUTE_COSTS, 1 by default), and a request finding
+too few tokens is answered with 429 and the seconds to wait in
+Retry-After. A page of GET /actors or GET /movies costs more than a
+single write, and reading a whole collection as a stream costs
+STREAM_COST on top of it.
+
+    ADMISSION_MAX_IN_FLIGHT=32
+
+sheds the requests arriving while that many are already running with
+503 and Retry-After, instead of letting them queue behind the busy
+workers. A running request holds its place until it ends, or for at
+most ADMISSION_LEASE_SECONDS if its worker died.
+
+Both are off by default. The buckets and the running requests are kept
+in the key-value store (see kvstore.py): in the memory of the process,
+or shared by every worker with Redis.
+'''
+
+RATE_LIMIT_PER_SECOND = float(os.getenv('RATE_LIMIT_PER_SECOND', 0))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 100))
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 0))
+ADMISSION_LEASE_SECONDS = float(os.getenv('ADMISSION_LEASE_SECONDS', 300))
+ADMISSION_RETRY_AFTER = 1
+
+# cost of a request by endpoint, anything else costs 1
+ROUTE_COSTS = {
+    'get_actors': 5,
+    'get_movies': 5,
+    'get_costar_path': 3,
+    'get_similar_movies': 2,
+    'get_similar_actors': 2,
+    'bulk_create_actors': 20,
+    'bulk_create_movies': 20,
+    'delete_actors': 10,
+    'delete_movies': 10,
+    'link_associations': 5,
+    'unlink_associations': 5,
+}
+STREAM_COST = 100
+# endpoints that can read a whole collection as a stream
+STREAM_ENDPOINTS = ('get_actors', 'get_movies')
+# endpoints never shed, so the service can still be observed
+ADMISSION_EXEMPT = ('static', 'get_metrics', 'get_pool_metrics')
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after, status_code=429):
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+def retry_after_header(seconds):
+    return str(max(int(math.ceil(seconds)), 1))
+
+
+""" Token buckets of the subjects, in `store` """
+
+
+class RateLimiter:
+    def __init__(self, store, rate=RATE_LIMIT_PER_SECOND,
+                 burst=RATE_LIMIT_BURST):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+
+    """ Seconds to wait before `subject` can spend `cost`, 0 when the cost
+        was taken. A cost larger than the bucket takes the whole bucket.
+    """
+
+    def take(self, subject, cost):
+        if self.rate <= 0 or subject is None:
+            return 0
+        return self.store.take('rate:' + subject, min(cost, self.burst),
+                               self.rate, self.burst)
+
+    def charge(self, subject, cost):
+        wait = self.take(subject, cost)
+        if wait:
+            raise RateLimitError(wait)
+
+
+""" Places for the requests running in every worker, in `store` """
+
+
+class Admission:
+    def __init__(self, store, limit=ADMISSION_MAX_IN_FLIGHT,
+                 lease=ADMISSION_LEASE_SECONDS):
+        self.store = store
+        self.limit = limit
+        self.lease = lease
+
+    """ Token to give back to release(), or None when every place is
+        taken
+    """
+
+    def acquire(self):
+        token = uuid.uuid4().hex
+        if not self.store.acquire('in_flight', token, self.limit,
+                                  self.lease):
+            return None
+        return token
+
+    def release(self, token):
+        self.store.release('in_flight', token)
+
+
+limiter = RateLimiter(store)
+admission = Admission(store)
+
+
+_wants_stream = None
+
+
+def route_cost(endpoint):
+    return ROUTE_COSTS.get(endpoint, 1)
+
+
+''' Registers the function telling whether the current request asks for
+    a stream, see request_cost()
+'''
+
+
+def stream_check(f):
+    global _wants_stream
+    _wants_stream = f
+    return f
+
+
+''' Cost of the current request: the cost of its route, plus STREAM_COST
+    for a stream, taken at once so that a stream only needs a full bucket
+'''
+
+
+def request_cost():
+    cost = route_cost(request.endpoint)
+    if request.endpoint in STREAM_ENDPOINTS and _wants_stream is not None \
+            and _wants_stream():
+        cost += STREAM_COST
+    return cost
+
+
+''' Takes the cost of the current request from the bucket of `subject`,
+    called by requires_auth once the token is verified; raises
+    RateLimitError when the bucket is short
+'''
+
+
+def charge(subject, cost=None):
+    if cost is None:
+        cost = request_cost()
+    limiter.charge(subject, cost)
+
+
+def error_body(error):
+    return {
+        'success': False,
+        'error': error.status_code,
+        'message': 'too many requests' if error.status_code == 429
+        else 'service overloaded'
+    }
+
+
+def error_response(error):
+    response = jsonify(error_body(error))
+    response.status_code = error.status_code
+    response.headers['Retry-After'] = retry_after_header(error.retry_after)
+    return response
+
+
+def admit():
+    if admission.limit <= 0 or request.endpoint in ADMISSION_EXEMPT:
+        return None
+    token = admission.acquire()
+    if token is None:
+        return error_response(
+            RateLimitError(ADMISSION_RETRY_AFTER, status_code=503))
+    g.admission_token = token
+    return None
+
+
+def leave(exception=None):
+    token = g.pop('admission_token', None)
+    if token is not None:
+        admission.release(token)
+
+
+def init_app(app):
+    app.before_request(admit)
+    app.teardown_request(leave)
+    app.register_error_handler(RateLimitError, error_response)
@@ -0,0 +1,91 @@
+import itertools
+import os
+import threading
+from functools import wraps
+from flask import _request_ctx_stack, g, request
+from sqlalchemy import create_engine
+from db_pool import engine_options
+from kvstore import store
+
+'''
+Read replicas
+
+    DATABASE_REPLICA_URLS=postgresql://replica-1/capstone,postgresql://...
+
+GET /actors and GET /movies read from the replicas, in turn, while every
+other request uses the primary (DATABASE_URL). A successful write pins
+the subject of its token to the primary for REPLICA_STICKY_SECONDS, so a
+client reads its own writes even though the replicas lag behind. The
+pins are kept in the key-value store (see kvstore.py), which has to be
+Redis when more than one process serves the API.
+'''
+
+REPLICA_URLS = [url.strip() for url in
+                os.getenv('DATABASE_REPLICA_URLS', '').split(',')
+                if url.strip()]
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 5))
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+engines = [create_engine(url, **engine_options(url)) for url in REPLICA_URLS]
+_next_engine = itertools.cycle(engines)
+_next_engine_lock = threading.Lock()
+
+
+def next_engine():
+    with _next_engine_lock:
+        return next(_next_engine)
+
+
+def sticky_key(subject):
+    return 'primary:' + subject
+
+
+def current_subject():
+    payload = getattr(_request_ctx_stack.top, 'current_user', None) or {}
+    return payload.get('sub')
+
+
+def is_pinned(subject):
+    return subject is not None and store.get(sticky_key(subject)) is not None
+
+
+def pin(subject):
+    store.set(sticky_key(subject), '1', REPLICA_STICKY_SECONDS)
+
+
+''' Decorator for the GET handlers served by the replicas, to place after
+    requires_auth: the session of the request reads from a replica unless
+    the subject of the token is pinned to the primary, in which case
+    `g.pinned` is set and the cached collection versions are not used
+    either (see etag.conditional)
+'''
+
+
+def replica_reads(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if engines:
+            if is_pinned(current_subject()):
+                g.pinned = True
+            else:
+                g.read_engine = next_engine()
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def pin_writers(response):
+    if engines and request.method in WRITE_METHODS and \
+            response.status_code < 400:
+        subject = current_subject()
+        if subject is not None:
+            pin(subject)
+    return response
+
+
+def init_app(app):
+    app.after_request(pin_writers)
+
+
+def dispose():
+    for engine in engines:
+        engine.dispose()
@@ -0,0 +1,224 @@
+import csv
+import io
+import random
+import time
+from bisect import bisect_left
+from datetime import datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, text
+from models import db, Actor, Movie, association_table, bump_versions
+from stats import rebuild_stats
+
+'''
+Synthetic catalog for reproducing production-size problems
+
+    flask seed --actors 1000000 --movies 200000 --links 3000000 --seed 7
+
+Actors and movies get plausible names, ages, genders and release dates
+(more movies in recent decades). Cast sizes follow a power law, and so does
+the popularity of the actors: a few movies have huge casts and a few actors
+appear in a large share of the movies. The same seed gives the same catalog
+on an empty database. The link counters and the catalog statistics are
+computed again once everything is written.
+
+Rows are written in chunks with COPY on Postgres and executemany elsewhere,
+with explicit ids following the largest existing one.
+'''
+
+FIRST_NAMES = [
+    'Ana', 'Bruno', 'Carla', 'Diego', 'Elena', 'Fábio', 'Grace', 'Hiro',
+    'Inês', 'James', 'Kenji', 'Laura', 'Marta', 'Nadia', 'Omar', 'Paula',
+    'Rafael', 'Sofia', 'Tomás', 'Uma', 'Victor', 'Wen', 'Yara', 'Zoë']
+LAST_NAMES = [
+    'Almeida', 'Brown', 'Chen', 'Dubois', 'Evans', 'Ferreira', 'García',
+    'Hansen', 'Ito', 'Jones', 'Kowalski', 'Lopez', 'Müller', 'Nakamura',
+    "O'Brien", 'Petrov', 'Rossi', 'Silva', 'Tanaka', 'Walker', 'Yilmaz']
+TITLE_WORDS = [
+    ('The', 'A', 'Last', 'Lost', 'Silent', 'Broken', 'Golden', 'Hidden',
+     'Eternal', 'Midnight', 'Crimson', 'Distant'),
+    ('River', 'City', 'Garden', 'Empire', 'Dream', 'Shadow', 'Summer',
+     'Horizon', 'Mirror', 'Storm', 'Letter', 'Road'),
+]
+
+CAST_EXPONENT = 2.0
+POPULARITY_EXPONENT = 0.75
+MAX_CAST = 500
+FIRST_YEAR = 1920
+LAST_YEAR = 2025
+
+
+def actor_row(rng, id):
+    age = None
+    if rng.random() > 0.02:
+        age = min(max(int(rng.gauss(40, 14)), 5), 95)
+    gender = rng.choice(('F', 'M')) if rng.random() > 0.01 else None
+    return {'id': id,
+            'name': '{} {}'.format(rng.choice(FIRST_NAMES),
+                                   rng.choice(LAST_NAMES)),
+            'age': age,
+            'gender': gender}
+
+
+def movie_row(rng, id):
+    # skewed towards recent years, like the number of releases
+    years = (LAST_YEAR - FIRST_YEAR) * rng.betavariate(3, 1.3)
+    release_date = datetime(FIRST_YEAR, 1, 1) + timedelta(
+        days=int(years * 365.25), seconds=rng.randrange(86400))
+    title = '{} {}'.format(rng.choice(TITLE_WORDS[0]),
+                           rng.choice(TITLE_WORDS[1]))
+    if rng.random() < 0.3:
+        title += ' {}'.format(rng.randint(2, 5))
+    return {'id': id, 'title': title, 'release_date': release_date}
+
+
+''' Cumulative popularity of `count` actors, the k-th most popular having
+    weight k ** -POPULARITY_EXPONENT, in a random order
+'''
+
+
+def popularity(rng, count):
+    weights = [(rank + 1) ** -POPULARITY_EXPONENT for rank in range(count)]
+    rng.shuffle(weights)
+    total = 0.0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+''' Cast size drawn from a Pareto distribution scaled to an average of
+    `mean` actors per movie
+'''
+
+
+def cast_size(rng, mean, limit):
+    pareto_mean = CAST_EXPONENT / (CAST_EXPONENT - 1)
+    size = int(round(mean * rng.paretovariate(CAST_EXPONENT) / pareto_mean))
+    return min(max(size, 1), limit)
+
+
+def link_rows(rng, movie_ids, actor_ids, links):
+    cumulative = popularity(rng, len(actor_ids))
+    total = cumulative[-1]
+    mean = links / len(movie_ids)
+    limit = min(MAX_CAST, len(actor_ids))
+    for movie_id in movie_ids:
+        size = cast_size(rng, mean, limit)
+        cast = set()
+        for _ in range(4 * size):
+            index = bisect_left(cumulative, rng.random() * total)
+            cast.add(actor_ids[min(index, len(actor_ids) - 1)])
+            if len(cast) == size:
+                break
+        for actor_id in sorted(cast):
+            yield {'movie_id': movie_id, 'actor_id': actor_id}
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+''' Writes a chunk of rows, with COPY on Postgres '''
+
+
+def copy_rows(table, columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    preparer = db.engine.dialect.identifier_preparer
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        preparer.format_table(table),
+        ', '.join(preparer.quote(column) for column in columns)), buffer)
+    cursor.close()
+
+
+def insert_rows(table, rows, chunk_size):
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        if postgres:
+            copy_rows(table, list(chunk[0]), chunk)
+        else:
+            db.session.execute(table.insert(), chunk)
+        count += len(chunk)
+    return count
+
+
+def next_id(table):
+    return (db.session.execute(select([func.max(table.c.id)])).scalar()
+            or 0) + 1
+
+
+def reset_sequence(table):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text(
+            "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+            "(SELECT max(id) FROM {}))".format(table.name)),
+            {'table': table.name})
+
+
+''' Adds the synthetic catalog in one transaction and returns the number
+    of rows written to each table
+'''
+
+
+def seed_catalog(actors, movies, links, seed=0, chunk_size=50000,
+                 echo=None):
+    rng = random.Random(seed)
+    actor_table, movie_table = Actor.__table__, Movie.__table__
+    first_actor, first_movie = next_id(actor_table), next_id(movie_table)
+    actor_ids = range(first_actor, first_actor + actors)
+    movie_ids = range(first_movie, first_movie + movies)
+    counts = {}
+    for name, table, rows in (
+            ('actors', actor_table,
+             (actor_row(rng, id) for id in actor_ids)),
+            ('movies', movie_table,
+             (movie_row(rng, id) for id in movie_ids)),
+            ('links', association_table,
+             link_rows(rng, movie_ids, actor_ids, links)
+             if actors and movies and links else ())):
+        start = time.perf_counter()
+        counts[name] = insert_rows(table, rows, chunk_size)
+        if echo is not None:
+            echo('{} {} in {:.1f}s'.format(
+                counts[name], name, time.perf_counter() - start))
+    reset_sequence(actor_table)
+    reset_sequence(movie_table)
+    rebuild_stats()
+    # links are not logged one by one: the co-star graphs are loaded again
+    bump_versions('actors', 'movies', *(['links'] if counts['links'] else []))
+    db.session.commit()
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+    return counts
+
+
+@click.command('seed')
+@click.option('--actors', default=10000, help='Actors to add.')
+@click.option('--movies', default=2000, help='Movies to add.')
+@click.option('--links', default=None, type=int,
+              help='Approximate number of associations, 10 per movie by '
+              'default.')
+@click.option('--seed', default=0, help='Seed of the generator.')
+@click.option('--chunk-size', default=50000,
+              help='Rows written per COPY or executemany.')
+@with_appcontext
+def seed_command(actors, movies, links, seed, chunk_size):
+    """Add a synthetic catalog to the database."""
+    if links is None:
+        links = 10 * movies
+    seed_catalog(actors, movies, links, seed, chunk_size, echo=click.echo)
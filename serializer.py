@@ -0,0 +1,299 @@
+import os
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+from sqlalchemy import DateTime, Integer, and_, select
+from models import db, Actor, Movie, association_table, chunks
+from metrics import serializing
+
+'''
+Fast read path for the list endpoints
+
+Rows are read as column tuples with Core select() statements, without
+building ORM objects, and encoded straight to JSON by encoders prepared
+once per set of fields. The output is byte for byte what jsonify()
+produces for the json() of the same rows: keys sorted, no whitespace and
+non-ASCII characters escaped.
+
+FAST_JSON_BACKEND=orjson encodes strings with orjson when it is
+installed, for the strings where its output is the same as the standard
+library's (printable ASCII).
+'''
+
+FAST_JSON_BACKEND = os.getenv('FAST_JSON_BACKEND', 'stdlib')
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+encode_ascii_string = encode_basestring_ascii
+if FAST_JSON_BACKEND == 'orjson':
+    try:
+        import orjson
+
+        def encode_ascii_string(value):
+            if value.isascii() and value.isprintable():
+                return orjson.dumps(value).decode('ascii')
+            return encode_basestring_ascii(value)
+    except ImportError:
+        pass
+
+
+def encode_string(value):
+    if value is None:
+        return 'null'
+    return encode_ascii_string(value)
+
+
+def encode_integer(value):
+    if value is None:
+        return 'null'
+    return int.__repr__(value)
+
+
+def encode_datetime(value):
+    if value is None:
+        return 'null'
+    if value.year < 1000:
+        return encode_basestring_ascii(value.strftime(DATETIME_FORMAT))
+    return '"%d-%02d-%02d %02d:%02d:%02d.%06d"' % (
+        value.year, value.month, value.day, value.hour, value.minute,
+        value.second, value.microsecond)
+
+
+def json_value(value):
+    if isinstance(value, datetime):
+        return value.strftime(DATETIME_FORMAT)
+    return value
+
+
+def encoder_for(column):
+    if isinstance(column.type, DateTime):
+        return encode_datetime
+    if isinstance(column.type, Integer):
+        return encode_integer
+    return encode_string
+
+
+""" Encodes a row tuple as a JSON object
+
+    `members` lists (key, index, encode) with `index` being the position
+    of the value in the row, or None for the member holding the list of
+    linked objects, which is taken already encoded from `linked`.
+"""
+
+
+class RowEncoder:
+    def __init__(self, members, id_index=0):
+        self.parts = []
+        self.id_index = id_index
+        separator = '{'
+        for key, index, encode in sorted(members, key=lambda m: m[0]):
+            self.parts.append(
+                (separator + encode_basestring_ascii(key) + ':',
+                 index, encode))
+            separator = ','
+
+    def __call__(self, row, linked=None):
+        out = []
+        for prefix, index, encode in self.parts:
+            out.append(prefix)
+            if index is None:
+                out.append('[' + ','.join(
+                    linked.get(row[self.id_index], ())) + ']')
+            else:
+                out.append(encode(row[index]))
+        out.append('}')
+        return ''.join(out)
+
+
+""" Description of a collection for the fast path
+
+    `short` maps the keys of the shortJson() of the related model to its
+    columns, and `link` / `related_link` are the Association columns
+    pointing at this model and at the related one.
+"""
+
+
+class Resource:
+    def __init__(self, name, model, relationship, related, short, link,
+                 related_link):
+        self.name = name
+        self.model = model
+        self.table = model.__table__
+        self.relationship = relationship
+        self.related_table = related.__table__
+        self.link = link
+        self.related_link = related_link
+        columns = self.related_table.c
+        self.short_keys = [key for key, _ in short]
+        self.short_columns = [columns[column] for _, column in short]
+        self.short_encoder = RowEncoder(
+            [(key, index + 1, encoder_for(columns[column]))
+             for index, (key, column) in enumerate(short)])
+        self._encoders = {}
+
+    def columns(self, fieldset, extra=()):
+        names = ['id']
+        for name in list(extra) + list(fieldset.fields or self.model.FIELDS):
+            if name not in names:
+                names.append(name)
+        return names
+
+    """ Encoder of the rows selected with `names`, cached per set of
+        fields and column order (the sort column comes first)
+    """
+
+    def encoder(self, fieldset, names):
+        fields = tuple(fieldset.fields or self.model.FIELDS)
+        key = (fields, fieldset.expand, tuple(names))
+        encoder = self._encoders.get(key)
+        if encoder is None:
+            members = [(name, names.index(name),
+                        encoder_for(self.table.c[name])) for name in fields]
+            if fieldset.expand:
+                members.append((self.relationship, None, None))
+            encoder = self._encoders[key] = RowEncoder(members)
+        return encoder
+
+    """ Encoded shortJson() of the objects linked to each id, ordered by
+        their own id like the ORM relationship
+    """
+
+    def linked(self, ids):
+        if not ids:
+            return {}
+        return self.group_linked(db.session.execute(self.linked_query(ids)))
+
+    def linked_query(self, ids):
+        related_id = self.related_table.c.id
+        return select([self.link] + self.short_columns).select_from(
+            association_table.join(
+                self.related_table, self.related_link == related_id)
+        ).where(self.link.in_(ids)).order_by(self.link, related_id)
+
+    def group_linked(self, rows):
+        linked = {}
+        for row in rows:
+            linked.setdefault(row[0], []).append(self.short_encoder(row))
+        return linked
+
+    """ json() of the rows of a write, as dicts for jsonify(): `rows` map
+        every column to its value and `linked` is the result of
+        linked_json() for their ids, or of unlinked_json() for the links
+        removed by a delete
+    """
+
+    def rows_json(self, rows, linked):
+        items = []
+        for row in rows:
+            item = {name: json_value(row[name]) for name in self.model.FIELDS}
+            item[self.relationship] = linked.get(row['id'], [])
+            items.append(item)
+        return items
+
+    def linked_json(self, ids):
+        linked = {}
+        if ids:
+            for row in db.session.execute(self.linked_query(ids)):
+                linked.setdefault(row[0], []).append(dict(zip(
+                    self.short_keys, map(json_value, row[1:]))))
+        return linked
+
+    """ linked_json() of the objects of the (movie_id, actor_id) `pairs`,
+        such as the links returned by a delete
+    """
+
+    def unlinked_json(self, pairs):
+        own = 0 if self.link.key == 'movie_id' else 1
+        related = {}
+        for pair in pairs:
+            related.setdefault(pair[own], []).append(pair[1 - own])
+        short = {}
+        for chunk in chunks(sorted({pair[1 - own] for pair in pairs})):
+            for row in db.session.execute(select(self.short_columns).where(
+                    self.related_table.c.id.in_(chunk))):
+                item = dict(zip(self.short_keys, map(json_value, row)))
+                short[item['id']] = item
+        return {id: [short[related_id] for related_id in sorted(ids)
+                     if related_id in short]
+                for id, ids in related.items()}
+
+    def select(self, names, filters=()):
+        query = select([self.table.c[name] for name in names])
+        if filters:
+            query = query.where(and_(*filters))
+        return query
+
+    """ Encoded rows; the linked objects are read unless given """
+
+    def encode_rows(self, rows, fieldset, names, linked=None):
+        encoder = self.encoder(fieldset, names)
+        if fieldset.expand and linked is None:
+            linked = self.linked([row[0] for row in rows])
+        with serializing():
+            return [encoder(row, linked) for row in rows]
+
+
+ACTORS = Resource(
+    'actors', Actor, 'movies', Movie,
+    [('id', 'id'), ('release_date', 'release_date'), ('title', 'title')],
+    association_table.c.actor_id, association_table.c.movie_id)
+
+MOVIES = Resource(
+    'movies', Movie, 'actors', Actor,
+    [('age', 'age'), ('gender', 'gender'), ('id', 'id'),
+     ('title', 'name')],
+    association_table.c.movie_id, association_table.c.actor_id)
+
+
+''' Column names and statement reading a page of a collection '''
+
+
+def list_query(resource, fieldset, page, filters):
+    names = resource.columns(fieldset, [page.column.key])
+    return names, page.apply_select(resource.select(names, filters))
+
+
+def split_page(page, names, rows):
+    sort_index = names.index(page.column.key)
+    return page.split(rows, key=lambda row: (row[sort_index], row[0]))
+
+
+def encode_list(resource, items, next_cursor):
+    with serializing():
+        cursor = encode_string(next_cursor)
+        return ('{"' + resource.name + '":[' + ','.join(items) +
+                '],"next_cursor":' + cursor + ',"success":true}\n'
+                ).encode('ascii')
+
+
+''' Body of a GET /actors or GET /movies response, as bytes '''
+
+
+def list_body(resource, fieldset, page, filters):
+    names, query = list_query(resource, fieldset, page, filters)
+    rows, next_cursor = split_page(
+        page, names, db.session.execute(query).fetchall())
+    items = resource.encode_rows(rows, fieldset, names)
+    return encode_list(resource, items, next_cursor)
+
+
+''' Every row of the collection matching the `filters` as NDJSON, in
+    chunks read by keyset on the primary key
+'''
+
+
+def iter_ndjson(resource, fieldset, filters, chunk_size):
+    names = resource.columns(fieldset)
+    id_column = resource.table.c.id
+    last_id = None
+    while True:
+        query = resource.select(names, filters)
+        if last_id is not None:
+            query = query.where(id_column > last_id)
+        rows = db.session.execute(
+            query.order_by(id_column).limit(chunk_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        yield ''.join(item + '\n' for item in
+                      resource.encode_rows(rows, fieldset, names))
+        if len(rows) < chunk_size:
+            break
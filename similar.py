@@ -0,0 +1,183 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+'''
+Similar movies and actors
+
+Two movies are similar when they share actors, and two actors when they
+share movies. The score is the Jaccard index of the two casts (or
+filmographies), shared / (size of one + size of the other - shared), or
+their cosine, shared / sqrt(size of one * size of the other).
+
+The scores are computed with NumPy over the arrays of the co-star graph
+(see graph.py), viewed without copying: the neighbours of the movie or
+actor are gathered in one array, counted with np.unique, divided by the
+sizes read from the offsets, and the best are picked with argpartition.
+Only the links changed since the graph was built (its overlay) are
+looked up one by one.
+
+Results are cached per movie or actor until the next change to the
+graph, whoever made it.
+'''
+
+SIMILAR_CACHE_SIZE = int(os.getenv('SIMILAR_CACHE_SIZE', 4096))
+SIMILAR_MAX_RESULTS = 1000
+METRICS = ('jaccard', 'cosine')
+ACTORS, MOVIES = 0, 1
+
+
+def as_numpy(values):
+    if not len(values):
+        return np.zeros(0, dtype=values.typecode)
+    return np.frombuffer(values, dtype=values.typecode)
+
+
+''' (ids, offsets, neighbours) of a graph.CSR as NumPy arrays sharing its
+    memory
+'''
+
+
+def csr_arrays(csr):
+    return as_numpy(csr.ids), as_numpy(csr.offsets), as_numpy(csr.neighbours)
+
+
+def find(ids, nodes):
+    index = np.searchsorted(ids, nodes)
+    found = index < len(ids)
+    found[found] = ids[index[found]] == nodes[found]
+    return index, found
+
+
+''' Neighbours of all the `nodes` in the CSR arrays, concatenated '''
+
+
+def gather(arrays, nodes):
+    ids, offsets, neighbours = arrays
+    index, found = find(ids, nodes)
+    index = index[found]
+    starts = offsets[index]
+    lengths = offsets[index + 1] - starts
+    ends = np.cumsum(lengths)
+    positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(
+        starts - (ends - lengths), lengths)
+    return neighbours[positions]
+
+
+def degrees(arrays, nodes):
+    ids, offsets, _ = arrays
+    index, found = find(ids, nodes)
+    index = np.where(found, index, 0)
+    return np.where(found, offsets[index + 1] - offsets[index], 0)
+
+
+''' Change of the number of neighbours of the nodes in the overlay of one
+    side of the graph, as sorted ids and deltas
+'''
+
+
+def overlay_degrees(graph, side):
+    added, removed = graph.added[side], graph.removed[side]
+    ids = sorted(set(added) | set(removed))
+    deltas = [len(added.get(id, ())) - len(removed.get(id, ()))
+              for id in ids]
+    return np.array(ids, dtype=np.int64), np.array(deltas, dtype=np.int64)
+
+
+''' Best scores among `candidates`, as (id, shared, score) tuples: highest
+    score first, then most shared, then lowest id
+'''
+
+
+def top(candidates, shared, scores, limit):
+    if len(scores) > limit:
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        candidates, shared, scores = (
+            candidates[best], shared[best], scores[best])
+    order = np.lexsort((candidates, -shared, -scores))
+    return [(int(candidates[i]), int(shared[i]), float(scores[i]))
+            for i in order]
+
+
+''' Movies (side=MOVIES) or actors (side=ACTORS) of the graph most similar
+    to `id`
+'''
+
+
+def similar(graph, side, id, metric='jaccard', limit=SIMILAR_MAX_RESULTS,
+            overlay=None):
+    of = (graph.movies_of, graph.actors_of)
+    hop_side = 1 - side
+    changed = (graph.added[hop_side], graph.removed[hop_side])
+    neighbours = of[side](id)
+    plain, extra = [], []
+    for node in neighbours:
+        if node in changed[0] or node in changed[1]:
+            extra.extend(of[hop_side](node))
+        else:
+            plain.append(node)
+    hop = csr_arrays((graph.actors, graph.movies)[hop_side])
+    candidates = np.concatenate((
+        gather(hop, np.array(plain, dtype=np.int32)),
+        np.array(extra, dtype=np.int32)))
+    candidates, shared = np.unique(candidates, return_counts=True)
+    keep = candidates != id
+    candidates, shared = candidates[keep], shared[keep]
+    if not len(candidates):
+        return []
+
+    sizes = degrees(csr_arrays((graph.actors, graph.movies)[side]),
+                    candidates)
+    overlay_ids, deltas = overlay or overlay_degrees(graph, side)
+    if len(overlay_ids):
+        index, found = find(overlay_ids, candidates)
+        sizes[found] += deltas[index[found]]
+    if metric == 'cosine':
+        scores = shared / np.sqrt(sizes * float(len(neighbours)))
+    else:
+        scores = shared / (sizes + len(neighbours) - shared)
+    return top(candidates, shared, scores, limit)
+
+
+''' LRU of the results of similar(), emptied whenever the graph changes.
+    The overlay sizes are computed once per change as well.
+'''
+
+
+class SimilarCache:
+    def __init__(self, maxsize=SIMILAR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._results = OrderedDict()
+        self._overlays = {}
+        self._graph = None
+        self._changes = None
+        self._lock = threading.Lock()
+
+    def _current(self, graph):
+        return self._graph is graph and self._changes == graph.changes
+
+    def similar(self, graph, side, id, metric='jaccard'):
+        key = (side, id, metric)
+        with self._lock:
+            if not self._current(graph):
+                self._results.clear()
+                self._overlays.clear()
+                self._graph, self._changes = graph, graph.changes
+            results = self._results.get(key)
+            if results is not None:
+                self._results.move_to_end(key)
+                return results
+            overlay = self._overlays.get(side)
+            if overlay is None:
+                overlay = self._overlays[side] = overlay_degrees(graph, side)
+        results = similar(graph, side, id, metric, overlay=overlay)
+        with self._lock:
+            if self._current(graph) and self.maxsize > 0:
+                self._results[key] = results
+                while len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+        return results
+
+
+cache = SimilarCache()
@@ -0,0 +1,148 @@
+from collections import Counter
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, text
+from models import (
+    db, Actor, CatalogStat, Movie, UNKNOWN, actor_stat_keys,
+    association_table, movie_stat_keys
+)
+
+'''
+Catalog statistics
+
+GET /stats/actors and GET /stats/movies read the few CatalogStat rows of
+their collection, whatever the size of the catalog: the counts are kept
+up to date by the writes themselves (see models.add_stats). After a
+change made outside the API, or to check for drift,
+
+    flask rebuild-stats
+
+computes them again from the tables.
+'''
+
+
+def read_stats(*names):
+    table = CatalogStat.__table__
+    stats = {name: {} for name in names}
+    rows = db.session.execute(
+        select([table.c.name, table.c.key, table.c.value]).where(
+            table.c.name.in_(names)))
+    for name, key, value in rows:
+        if value:
+            stats[name][key] = value
+    return stats
+
+
+''' [[key, count], ...] pairs of a stat, in the order of its keys: integers,
+    or ranges such as 30-39 followed by unknown
+'''
+
+
+def numeric_histogram(counts):
+    return sorted([int(key), count] for key, count in counts.items())
+
+
+def bucket_histogram(counts):
+    def start(key):
+        return (key == UNKNOWN, int(key.split('-')[0]) if
+                key != UNKNOWN else 0)
+    return [[key, counts[key]] for key in sorted(counts, key=start)]
+
+
+def link_stats(total, links, histogram):
+    return {
+        'mean': round(links / total, 3) if total else 0,
+        'histogram': numeric_histogram(histogram),
+    }
+
+
+def actor_stats():
+    stats = read_stats('actors', 'links', 'actor_age', 'actor_gender',
+                       'actor_movies')
+    total = stats['actors'].get('total', 0)
+    links = stats['links'].get('total', 0)
+    return {
+        'count': total,
+        'links': links,
+        'movies_per_actor': link_stats(total, links, stats['actor_movies']),
+        'age': bucket_histogram(stats['actor_age']),
+        'gender': stats['actor_gender'],
+    }
+
+
+def movie_stats():
+    stats = read_stats('movies', 'links', 'movie_year', 'movie_actors')
+    total = stats['movies'].get('total', 0)
+    links = stats['links'].get('total', 0)
+    return {
+        'count': total,
+        'links': links,
+        'actors_per_movie': link_stats(total, links, stats['movie_actors']),
+        'release_year': numeric_histogram(stats['movie_year']),
+    }
+
+
+def recount_links(column, link):
+    table = column.table
+    count = select([func.count()]).select_from(association_table).where(
+        link == table.c.id).as_scalar()
+    result = db.session.execute(table.update().where(
+        column != count).values({column.key: count}))
+    return result.rowcount
+
+
+''' Recomputes the link counters of the actors and the movies and every
+    CatalogStat row in the current transaction, and returns the number
+    of rows that were wrong. On Postgres the CatalogStat table is locked
+    first, so the writes running meanwhile add their changes after the
+    rebuild.
+'''
+
+
+def rebuild_stats():
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text(
+            'LOCK TABLE catalog_stat IN EXCLUSIVE MODE'))
+    actor, movie = Actor.__table__, Movie.__table__
+    fixed = recount_links(actor.c.movie_count, association_table.c.actor_id)
+    fixed += recount_links(movie.c.actor_count,
+                           association_table.c.movie_id)
+
+    stats = Counter()
+    rows = db.session.execute(select(
+        [actor.c.age, actor.c.gender, actor.c.movie_count, func.count()]
+    ).group_by(actor.c.age, actor.c.gender, actor.c.movie_count))
+    for age, gender, movie_count, count in rows:
+        for key in actor_stat_keys(age, gender, movie_count):
+            stats[key] += count
+    year = func.extract('year', movie.c.release_date)
+    rows = db.session.execute(select(
+        [year, movie.c.actor_count, func.count()]
+    ).group_by(year, movie.c.actor_count))
+    for release_year, actor_count, count in rows:
+        for key in movie_stat_keys(int(release_year), actor_count):
+            stats[key] += count
+    stats[('links', 'total')] = db.session.execute(
+        select([func.count()]).select_from(association_table)).scalar()
+
+    table = CatalogStat.__table__
+    previous = {(name, key): value for name, key, value in db.session.execute(
+        select([table.c.name, table.c.key, table.c.value])) if value}
+    current = {key: value for key, value in stats.items() if value}
+    fixed += sum(previous.get(key) != current.get(key)
+                 for key in set(previous) | set(current))
+    db.session.execute(table.delete())
+    if current:
+        db.session.execute(table.insert(), [
+            {'name': name, 'key': key, 'value': value}
+            for (name, key), value in sorted(current.items())])
+    return fixed
+
+
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command():
+    """Recompute the catalog statistics from the tables."""
+    fixed = rebuild_stats()
+    db.session.commit()
+    click.echo('{} counters corrected'.format(fixed))
@@ -1,12 +1,45 @@
-from flask import url_for
+from flask import Flask, abort, jsonify, request, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import upgrade, downgrade
+from sqlalchemy import create_engine
 import json
 import os
+import threading
+import time
 import unittest
+import app
 from app import create_app, APP
-from models import setup_db, Actor, Movie, db
+import auth
+import etag
+import graph
+import idempotency
+import kvstore
+from models import setup_db, Actor, Movie, db, association_table
+from models import LinkChange, bump_versions, get_versions, link
+from models import link_listeners, unlink, version_listeners
 from datetime import datetime
+from jwks import JWKSStore, JWKSError
+from token_cache import TokenCache
+from auth import AuthError
+from querycount import count_queries
+from db_pool import TimedQueuePool, pool_status
+import metrics
+from metrics import Histogram, render_histogram
+from seed import link_rows, seed_catalog
+from kvstore import MemoryStore, RedisStore
+from stats import rebuild_stats
+from graph import Graph
+import similar
+import ratelimit
+import profiling
+import pstats
+import random
+import tempfile
+from benchmarks.tokens import ALL_PERMISSIONS, issuer
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 
 sample_actor = dict(name="A", age=12, gender="M")
@@ -147,6 +180,174 @@ class TestCapstone(unittest.TestCase):
         movies = Movie.query.all()
         self.assertEqual(len(data['movies']), len(movies))
 
+    def test_actors_are_paginated(self):
+        for age in range(5):
+            Actor(name="Paged", age=age, gender="F").create()
+        ids = []
+        cursor = None
+        while True:
+            url = '/actors?limit=2&sort=age&order=desc'
+            if cursor:
+                url += '&cursor=' + cursor
+            res = self.client().get(
+                url,
+                headers={
+                    "Authorization": "Bearer {}".format(
+                        self.assistant_token)})
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertLessEqual(len(data['actors']), 2)
+            ids += [actor['id'] for actor in data['actors']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        actors = Actor.query.order_by(
+            Actor.age.desc(), Actor.id.desc()).all()
+        self.assertEqual(ids, [actor.id for actor in actors])
+
+    def test_invalid_cursor(self):
+        res = self.client().get(
+            '/movies?cursor=invalid',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        self.assertEqual(res.status_code, 400)
+
+    def assert_query_budget(self, url, budget):
+        counts = []
+        for _ in range(2):
+            for i in range(3):
+                actor = Actor(name="Cast", age=i, gender="F")
+                actor.movies.append(Movie(
+                    title="Cast", release_date="2020-01-01 00:00:00"))
+                db.session.add(actor)
+            db.session.commit()
+            with count_queries() as counter:
+                res = self.client().get(
+                    url,
+                    headers={
+                        "Authorization": "Bearer {}".format(
+                            self.assistant_token)})
+            self.assertEqual(res.status_code, 200)
+            counts.append(counter.count)
+        self.assertEqual(counts[0], counts[1])
+        self.assertLessEqual(counts[0], budget)
+
+    def test_get_actors_query_budget(self):
+        self.assert_query_budget('/actors', 2)
+
+    def test_get_movies_query_budget(self):
+        self.assert_query_budget('/movies', 2)
+
+    def test_filter_actors(self):
+        Actor(name="Bradley", age=30, gender="M").create()
+        Actor(name="Abrad", age=50, gender="M").create()
+        res = self.client().get(
+            '/actors?name=brad&age_min=40',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ["Brad"])
+
+    def test_filter_movies(self):
+        Movie(title="Once Again",
+              release_date="2010-01-01 00:00:00").create()
+        res = self.client().get(
+            '/movies?title_contains=ONCE&released_before=2015-01-01',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ["Once Again"])
+
+    def test_invalid_filter(self):
+        res = self.client().get(
+            '/actors?age_min=old',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        self.assertEqual(res.status_code, 400)
+
+    def test_conditional_get_actors(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.assistant_token)}
+        res = self.client().get('/actors', headers=headers)
+        etag = res.headers['ETag']
+        with count_queries() as counter:
+            res = self.client().get(
+                '/actors', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(counter.count, 0)
+
+        Actor(name="New", age=1, gender="F").create()
+        res = self.client().get(
+            '/actors', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_sparse_fieldset(self):
+        res = self.client().get(
+            '/actors?fields=id,name',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for actor in data['actors']:
+            self.assertEqual(set(actor), {'id', 'name'})
+
+    def test_expand_movie_actors(self):
+        movie = Movie.query.filter_by(title="Once Upon").first()
+        movie.actors.append(Actor.query.filter_by(name="Brad").first())
+        db.session.commit()
+        res = self.client().get(
+            '/movies?fields=title&expand=actors',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['movies'][0]), {'title', 'actors'})
+        self.assertEqual(len(data['movies'][0]['actors']), 1)
+
+    def test_fast_serializer_matches_orm(self):
+        movie = Movie.query.filter_by(title="Once Upon").first()
+        movie.actors.append(Actor(name="Zoë \"Q\"", age=None, gender=None))
+        db.session.commit()
+        headers = {
+            "Authorization": "Bearer {}".format(self.assistant_token)}
+        for url in ('/actors', '/movies', '/actors?fields=name&sort=age',
+                    '/actors?sort=name', '/movies?sort=release_date'):
+            fast = self.client().get(url, headers=headers).data
+            app.FAST_SERIALIZER = False
+            try:
+                orm = self.client().get(url + '&orm=1' if '?' in url
+                                        else url + '?orm=1',
+                                        headers=headers).data
+            finally:
+                app.FAST_SERIALIZER = True
+            self.assertEqual(fast, orm)
+
+    def test_stream_all_movies(self):
+        for i in range(3):
+            Movie(title="Streamed",
+                  release_date="2012-04-23 18:25:43.511").create()
+        res = self.client().get(
+            '/movies',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token),
+                "Accept": "application/x-ndjson"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        movies = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual(len(movies), Movie.query.count())
+
     def test_assistant_cant_create_actor(self):
         res = self.client().post(
             '/actors',
@@ -195,6 +396,41 @@ class TestCapstone(unittest.TestCase):
         data = json.loads(res.data)
         self.assertFalse(data['success'])
 
+    def test_director_should_bulk_create_actors(self):
+        res = self.client().post(
+            '/actors/bulk',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.director_token)},
+            json=[sample_actor, dict(age=3), dict(name="B", age=4)])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertTrue(data['success'])
+        self.assertEqual(len(data['created']), 2)
+        self.assertEqual(data['errors'][0]['index'], 1)
+        self.assertEqual(Actor.query.get(data['created'][1]).name, "B")
+
+    def test_assistant_cant_bulk_create_movies(self):
+        res = self.client().post(
+            '/movies/bulk',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)},
+            json=[sample_movie])
+        self.assertEqual(res.status_code, 401)
+
+    def test_executive_should_bulk_create_movies(self):
+        res = self.client().post(
+            '/movies/bulk',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.executive_token)},
+            json={'movies': [sample_movie] * 3})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(data['created']), 3)
+        self.assertEqual(data['created'], sorted(data['created']))
+
     def test_assistant_cant_create_movie(self):
         res = self.client().post(
             '/movies',
@@ -243,6 +479,146 @@ class TestCapstone(unittest.TestCase):
         data = json.loads(res.data)
         self.assertFalse(data['success'])
 
+    def test_director_should_link_actors(self):
+        movie_id = Movie.query.filter_by(title="Once Upon").first().id
+        actor_id = Actor.query.filter_by(name="Brad").first().id
+        for _ in range(2):
+            res = self.client().post(
+                '/movies/{}/actors'.format(movie_id),
+                headers={
+                    "Authorization": "Bearer {}".format(
+                        self.director_token)},
+                json=[actor_id, actor_id])
+            self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual(data['linked'], 0)
+        links = db.session.query(association_table).count()
+        self.assertEqual(links, 1)
+        movie = Movie.query.get(movie_id)
+        self.assertEqual([actor.id for actor in movie.actors], [actor_id])
+
+    def test_director_should_unlink_associations(self):
+        movie = Movie.query.filter_by(title="Once Upon").first()
+        actor = Actor.query.filter_by(name="Brad").first()
+        movie.actors.append(actor)
+        db.session.commit()
+        res = self.client().delete(
+            '/associations',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.director_token)},
+            json={'associations': [
+                {'movie_id': movie.id, 'actor_id': actor.id}]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['unlinked'], 1)
+
+    def test_links_removed_with_movie(self):
+        movie = Movie.query.filter_by(title="Once Upon").first()
+        actor = Actor.query.filter_by(name="Brad").first()
+        movie.actors.append(actor)
+        db.session.commit()
+        db.session.execute(
+            Movie.__table__.delete().where(Movie.id == movie.id))
+        db.session.commit()
+        links = db.session.query(association_table).filter_by(
+            actor_id=actor.id).count()
+        self.assertEqual(links, 0)
+
+    def test_assistant_cant_link_actors(self):
+        res = self.client().post(
+            '/associations',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)},
+            json=[[1, 1]])
+        self.assertEqual(res.status_code, 401)
+
+    def test_stats_follow_writes(self):
+        movie = Movie.query.filter_by(title="Once Upon").first()
+        actor = Actor.query.filter_by(name="Brad").first()
+        Actor(name="Anna", age=31, gender="F").create()
+        res = self.client().post(
+            '/movies/{}/actors'.format(movie.id),
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.director_token)},
+            json=[actor.id])
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get(
+            '/stats/actors',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        self.assertEqual(res.status_code, 200)
+        stats = json.loads(res.data)['actors']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['links'], 1)
+        self.assertEqual(stats['movies_per_actor']['histogram'],
+                         [[0, 1], [1, 1]])
+        self.assertEqual(stats['age'], [['30-39', 1], ['40-49', 1]])
+        self.assertEqual(stats['gender'], {'F': 1, 'M': 1})
+        res = self.client().get(
+            '/stats/movies',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        stats = json.loads(res.data)['movies']
+        self.assertEqual(stats['actors_per_movie']['histogram'], [[1, 1]])
+        self.assertEqual(stats['release_year'], [[2019, 1]])
+        self.assertEqual(rebuild_stats(), 0)
+
+    def test_costars_follow_cast_changes(self):
+        movie_id = Movie.query.filter_by(title="Once Upon").first().id
+        actor_id = Actor.query.filter_by(name="Brad").first().id
+        anna = Actor(name="Anna", age=31, gender="F")
+        anna.create()
+        anna_id = anna.id
+        # the graph loads at a version the link_change rows follow on from
+        bump_versions('links')
+        db.session.commit()
+        headers = {
+            "Authorization": "Bearer {}".format(self.assistant_token)}
+        costars_url = '/actors/{}/costars'.format(actor_id)
+        res = self.client().get(costars_url, headers=headers)
+        self.assertEqual(json.loads(res.data)['costars'], [])
+        res = self.client().post(
+            '/movies/{}/actors'.format(movie_id),
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.director_token)},
+            json=[actor_id, anna_id])
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get(costars_url, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['costars'],
+                         [{'id': anna_id, 'name': 'Anna', 'movies': 1}])
+        res = self.client().get(
+            '/actors/{}/path/{}'.format(actor_id, anna_id),
+            headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['degrees'], 1)
+        self.assertEqual(data['path'][1], {'id': movie_id,
+                                           'title': 'Once Upon'})
+        res = self.client().get(
+            '/actors/{}/path/{}?max_depth=11'.format(actor_id, anna_id),
+            headers=headers)
+        self.assertEqual(res.status_code, 400)
+        # a change made by another process reaches the graph through the
+        # link_change rows only
+        link_listeners.remove(graph.index.links_changed)
+        try:
+            unlink([(movie_id, anna_id)])
+        finally:
+            link_listeners.append(graph.index.links_changed)
+        graph.index._checked_at -= graph.index.check_interval
+        res = self.client().get(costars_url, headers=headers)
+        self.assertEqual(json.loads(res.data)['costars'], [])
+        self.assertFalse(graph.index._loading)
+        self.assertEqual(graph.index.version,
+                         get_versions('links')['links'])
+
     def test_assistant_cant_patch_actor(self):
         actor = Actor.query.filter_by(name="Brad", age=45, gender="M").first()
         res = self.client().patch(
@@ -365,6 +741,92 @@ class TestCapstone(unittest.TestCase):
         self.assertEqual(newMovie.release_date.strftime(
             "%Y-%m-%d %H:%M:%S.%f"), new_release_date)
 
+    def test_retry_with_idempotency_key_replayed(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.director_token),
+            "Idempotency-Key": "create-anna"}
+        body = {'name': 'Anna', 'age': 31, 'gender': 'F'}
+        first = self.client().post('/actors', headers=headers, json=body)
+        retry = self.client().post('/actors', headers=headers, json=body)
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(Actor.query.filter_by(name='Anna').count(), 1)
+        res = self.client().post('/actors', headers=headers,
+                                 json=dict(body, age=32))
+        self.assertEqual(res.status_code, 422)
+
+    def test_rate_limit_and_load_shedding(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.assistant_token)}
+        ratelimit.limiter.store = MemoryStore()
+        ratelimit.limiter.rate, ratelimit.limiter.burst = 1, 12
+        try:
+            for _ in range(2):
+                res = self.client().get('/actors', headers=headers)
+                self.assertEqual(res.status_code, 200)
+            res = self.client().get('/actors', headers=headers)
+            self.assertEqual(res.status_code, 429)
+            self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+
+            ratelimit.limiter.rate = 0
+            ratelimit.admission.limit = 1
+            token = ratelimit.admission.acquire()
+            res = self.client().get('/actors', headers=headers)
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers['Retry-After'], '1')
+            ratelimit.admission.release(token)
+            res = self.client().get('/actors', headers=headers)
+            self.assertEqual(res.status_code, 200)
+        finally:
+            ratelimit.limiter.store = ratelimit.store
+            ratelimit.limiter.rate = ratelimit.RATE_LIMIT_PER_SECOND
+            ratelimit.limiter.burst = ratelimit.RATE_LIMIT_BURST
+            ratelimit.admission.limit = ratelimit.ADMISSION_MAX_IN_FLIGHT
+
+    def test_versions_bumped_in_name_order(self):
+        actor = Actor.query.filter_by(name="Brad").first()
+        movie = Movie.query.filter_by(title="Once Upon").first()
+        bumped = []
+        version_listeners.append(bumped.append)
+        try:
+            link([(movie.id, actor.id)])
+            Movie.bulk_delete([movie.id])
+        finally:
+            version_listeners.remove(bumped.append)
+        self.assertEqual([list(versions) for versions in bumped],
+                         [['actors', 'links', 'movies']] * 2)
+
+    def test_batch_patch_and_delete_actors(self):
+        actor_id = Actor.query.filter_by(name="Brad").first().id
+        anna = Actor(name="Anna", age=31, gender="F")
+        anna.create()
+        anna_id = anna.id
+        res = self.client().patch(
+            '/actors',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.executive_token)},
+            json=[{'id': anna_id, 'age': 32}, {'id': actor_id, 'age': -1},
+                  {'id': actor_id + anna_id, 'name': 'Nobody'}])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(p['id'], p['age']) for p in data['patched']],
+                         [(anna_id, 32)])
+        self.assertEqual([e['index'] for e in data['errors']], [1, 2])
+        res = self.client().delete(
+            '/actors?ids={},{}'.format(anna_id, actor_id),
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.executive_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['id'] for a in data['deleted']],
+                         [anna_id, actor_id])
+        self.assertEqual(Actor.query.count(), 0)
+        self.assertEqual(rebuild_stats(), 0)
+
     def test_assistant_cant_delete_actor(self):
         actor = Actor.query.filter_by(name="Brad", age=45, gender="M").first()
         self.assertIsNotNone(actor)
@@ -431,11 +893,948 @@ class TestCapstone(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['deleted']['id'], movie.id)
 
+    def test_assistant_cant_read_pool_metrics(self):
+        res = self.client().get(
+            '/metrics/pool',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        self.assertEqual(res.status_code, 401)
+
+    def test_assistant_cant_read_metrics(self):
+        res = self.client().get(
+            '/metrics',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token)})
+        self.assertEqual(res.status_code, 401)
+
+    def test_assistant_cant_profile_requests(self):
+        res = self.client().get(
+            '/actors',
+            headers={
+                "Authorization": "Bearer {}".format(
+                    self.assistant_token),
+                "X-Profile": "1"})
+        self.assertEqual(res.status_code, 401)
+        self.assertNotIn('X-Profile-Id', res.headers)
+
     def test_nonexisting_route(self):
         res = self.client().get('/nonexisting')
         self.assertEqual(res.status_code, 404)
 
 
+""" Runs the app on a temporary SQLite database, with tokens minted by
+    the local issuer of benchmarks/tokens.py instead of Auth0, so the
+    tests need neither Postgres nor the network
+"""
+
+
+class LocalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = APP
+        self.client = self.app.test_client
+        handle, self.database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        setup_db(self.app, 'sqlite:///' + self.database_file)
+        with self.app.app_context():
+            db.create_all()
+        self.saved_auth = (auth.AUTH0_DOMAIN, auth.API_AUDIENCE,
+                           auth.jwks_store)
+        auth.AUTH0_DOMAIN = issuer.domain
+        auth.API_AUDIENCE = issuer.audience
+        auth.jwks_store = JWKSStore(issuer.jwks_url)
+        auth.token_cache.clear()
+        etag.versions.invalidate(['actors', 'movies', 'links'])
+        etag.response_cache.clear()
+        graph.index.graph = None
+        for store in (kvstore.store, idempotency.store):
+            if isinstance(store, MemoryStore):
+                store.clear()
+        self.headers = self.token_headers()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        auth.AUTH0_DOMAIN, auth.API_AUDIENCE, auth.jwks_store = \
+            self.saved_auth
+        auth.token_cache.clear()
+        os.remove(self.database_file)
+
+    def token_headers(self, permissions=ALL_PERMISSIONS):
+        return {"Authorization": "Bearer {}".format(
+            issuer.mint(permissions))}
+
+    def seed(self, actors=40, movies=20, links=120):
+        with self.app.app_context():
+            seed_catalog(actors, movies, links, seed=1)
+
+
+class TestListSerialization(LocalTestCase):
+    def test_columns_follow_the_sort_order(self):
+        self.seed()
+        with self.app.app_context():
+            expected = {actor.id: actor.json(['id', 'name', 'age'], False)
+                        for actor in Actor.query}
+        for sort in ('id', 'age', 'name', 'id'):
+            res = self.client().get(
+                '/actors?fields=id,name,age&limit=100&sort=' + sort,
+                headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+            actors = json.loads(res.data)['actors']
+            self.assertEqual(len(actors), len(expected))
+            for actor in actors:
+                self.assertEqual(actor, expected[actor['id']])
+
+    def test_stream_filtered(self):
+        self.seed()
+        with self.app.app_context():
+            expected = [actor.id for actor in Actor.query.filter(
+                Actor.age >= 40).order_by(Actor.id)]
+        self.assertTrue(0 < len(expected) < 40)
+        res = self.client().get('/actors?stream=1&fields=id&age_min=40',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([json.loads(line)['id']
+                          for line in res.data.splitlines()], expected)
+        res = self.client().get('/actors?stream=1&age_min=old',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class TestSetBasedWrites(LocalTestCase):
+    def test_batch_patch(self):
+        self.seed()
+        res = self.client().patch(
+            '/movies', headers=self.headers,
+            json=[{'id': 2, 'title': 'Second'}, {'id': 999, 'title': 'x'},
+                  {'id': 1, 'release_date': '2001-02-03 04:05:06.000000'},
+                  {'id': 2, 'title': 'Again'}])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            expected = [Movie.query.get(id).json() for id in (2, 1)]
+        self.assertEqual(data['patched'], expected)
+        self.assertEqual(expected[0]['title'], 'Second')
+        self.assertEqual(expected[1]['release_date'],
+                         '2001-02-03 04:05:06.000000')
+        self.assertEqual([(e['index'], e['message']) for e in data['errors']],
+                         [(1, 'not found'), (3, 'duplicate id')])
+        with self.app.app_context():
+            self.assertEqual(rebuild_stats(), 0)
+
+    def test_patch_reloads_held_instances(self):
+        # no app context: the session is shared with the request, which
+        # removes it, like in TestCapstone
+        self.seed()
+        actor = Actor.query.get(1)
+        res = self.client().patch('/actors', headers=self.headers,
+                                  json={'id': 1, 'name': 'Renamed'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['patched']['name'], 'Renamed')
+        self.assertEqual(actor.name, 'Renamed')
+
+    def test_instance_patch_and_delete(self):
+        self.seed()
+        with self.app.app_context():
+            movie = Movie.query.get(1)
+            movie.title = 'Renamed'
+            movie.release_date = '2001-02-03 04:05:06'
+            movie.patch()
+            self.assertEqual(movie.title, 'Renamed')
+            self.assertEqual(movie.release_date.year, 2001)
+            actor = movie.actors[0]
+            actor.delete()
+            self.assertIsNone(Actor.query.get(actor.id))
+            self.assertNotIn(actor, movie.actors)
+            self.assertEqual(rebuild_stats(), 0)
+
+    def test_links_reflected_by_held_relationships(self):
+        self.seed(actors=3, movies=2, links=0)
+        with self.app.app_context():
+            movie = Movie.query.get(1)
+            actor = Actor.query.get(2)
+            self.assertEqual((movie.actors, actor.movies), ([], []))
+            link([(1, 2), (1, 3)])
+            self.assertEqual([actor.id for actor in movie.actors], [2, 3])
+            self.assertEqual([movie.id for movie in actor.movies], [1])
+            unlink([(1, 2)])
+            self.assertEqual([actor.id for actor in movie.actors], [3])
+            self.assertEqual(actor.movies, [])
+
+    def test_batch_delete_reports_missing_ids(self):
+        self.seed()
+        with self.app.app_context():
+            ids = [actor.id for actor in Actor.query.filter(
+                Actor.movies.any()).order_by(Actor.id.desc()).limit(2)]
+            expected = [Actor.query.get(id).json() for id in ids]
+        res = self.client().delete(
+            '/actors?ids={},999,{}'.format(*ids), headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], expected)
+        self.assertTrue(all(actor['movies'] for actor in data['deleted']))
+        self.assertEqual(data['errors'],
+                         [{'index': 1, 'message': 'not found'}])
+        with self.app.app_context():
+            self.assertEqual(Actor.query.filter(Actor.id.in_(ids)).count(), 0)
+            self.assertEqual(rebuild_stats(), 0)
+        res = self.client().delete('/actors?ids=999', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(json.loads(res.data)['errors'],
+                         [{'index': 0, 'message': 'not found'}])
+
+
+class TestKeyRotation(LocalTestCase):
+    def setUp(self):
+        super().setUp()
+        handle, self.jwks_file = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.write_keys('old')
+        auth.jwks_store = JWKSStore('file://' + self.jwks_file,
+                                    min_refresh_interval=0)
+
+    def tearDown(self):
+        os.remove(self.jwks_file)
+        super().tearDown()
+
+    def write_keys(self, kid):
+        with open(self.jwks_file, 'w') as jwks:
+            json.dump({'keys': [dict(issuer.jwks['keys'][0], kid=kid)]},
+                      jwks)
+
+    def test_new_key_accepted_after_refresh(self):
+        saved_kid, issuer.kid = issuer.kid, 'new'
+        try:
+            headers = self.token_headers()
+        finally:
+            issuer.kid = saved_kid
+        res = self.client().get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 400)
+        self.write_keys('new')
+        res = self.client().get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+
+class TestCollectionVersions(LocalTestCase):
+    def get(self, url, etag=None):
+        headers = dict(self.headers)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        with count_queries() as counter:
+            res = self.client().get(url, headers=headers)
+        return res, counter.count
+
+    def test_orm_writes_bump_versions(self):
+        self.seed(actors=3, movies=2, links=0)
+        res, _ = self.get('/actors')
+        etag = res.headers['ETag']
+        with self.app.app_context():
+            db.session.add(Actor(name='Orm', age=30, gender='F'))
+            db.session.commit()
+        res, count = self.get('/actors', etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertIn('Orm', [actor['name']
+                              for actor in json.loads(res.data)['actors']])
+        self.assertEqual(count, 2)
+        res, _ = self.get('/movies')
+        etag = res.headers['ETag']
+        with self.app.app_context():
+            movie = Movie.query.get(1)
+            movie.actors.append(Actor.query.get(2))
+            db.session.commit()
+            changes = [(change.movie_id, change.actor_id, change.added)
+                       for change in LinkChange.query]
+        self.assertEqual(changes, [(1, 2, True)])
+        res, count = self.get('/movies', etag)
+        self.assertEqual(res.status_code, 200)
+        movie = json.loads(res.data)['movies'][0]
+        self.assertEqual([actor['id'] for actor in movie['actors']], [2])
+        self.assertEqual(count, 2)
+
+
+class TestPoolMetrics(LocalTestCase):
+    def test_pool_metrics(self):
+        res = self.client().get('/metrics/pool', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['pool']['pool'], 'NullPool')
+        for key in ('checkouts', 'checkout_wait_seconds_total',
+                    'checkout_wait_seconds_max', 'overflow_checkouts',
+                    'timeouts'):
+            self.assertGreaterEqual(data['pool'][key], 0)
+        self.assertNotIn('size', data['pool'])
+
+    def test_queue_pool_status(self):
+        engine = create_engine('sqlite:///' + self.database_file,
+                               poolclass=TimedQueuePool, pool_size=2,
+                               max_overflow=1)
+        checkouts = pool_status(engine)['checkouts']
+        connections = [engine.connect() for _ in range(3)]
+        status = pool_status(engine)
+        self.assertEqual(status['pool'], 'TimedQueuePool')
+        self.assertEqual(status['checkouts'], checkouts + 3)
+        self.assertGreater(status['overflow_checkouts'], 0)
+        self.assertEqual((status['size'], status['checked_out'],
+                          status['checked_in'], status['overflow']),
+                         (2, 3, 0, 1))
+        for connection in connections:
+            connection.close()
+        status = pool_status(engine)
+        self.assertEqual((status['checked_out'], status['checked_in']),
+                         (0, 2))
+        engine.dispose()
+
+
+class TestMetricsExposition(LocalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.saved_metrics = (metrics.METRICS_DIR, metrics._last_flush[0])
+        self.metrics_dir = tempfile.mkdtemp()
+        for histogram in metrics.HISTOGRAMS:
+            histogram.clear()
+
+    def tearDown(self):
+        metrics.METRICS_DIR, metrics._last_flush[0] = self.saved_metrics
+        for path in os.listdir(self.metrics_dir):
+            os.remove(os.path.join(self.metrics_dir, path))
+        os.rmdir(self.metrics_dir)
+        super().tearDown()
+
+    def exposition(self):
+        res = self.client().get('/metrics', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        return res.data.decode().splitlines()
+
+    def test_request_histograms(self):
+        self.seed()
+        res = self.client().get('/actors?limit=5', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        lines = self.exposition()
+        name = 'capstone_http_request_duration_seconds'
+        labels = 'method="GET",route="/actors",status="200"'
+        self.assertIn('# TYPE {} histogram'.format(name), lines)
+        buckets = [line for line in lines
+                   if line.startswith(name + '_bucket{' + labels)]
+        self.assertEqual(len(buckets), len(metrics.LATENCY_BUCKETS) + 1)
+        self.assertEqual(buckets[-1],
+                         '{}_bucket{{{},le="+Inf"}} 1'.format(name, labels))
+        self.assertIn('{}_count{{{}}} 1'.format(name, labels), lines)
+        self.assertTrue(any(line.startswith(
+            '{}_sum{{{}}} '.format(name, labels)) for line in lines))
+        self.assertIn('capstone_http_response_size_bytes_count'
+                      '{method="GET",route="/actors"} 1', lines)
+        self.assertIn('capstone_db_queries_per_request_bucket'
+                      '{method="GET",route="/actors",le="+Inf"} 1', lines)
+        self.assertIn('# TYPE capstone_db_pool_checkouts_total counter',
+                      lines)
+
+    def test_snapshots_of_other_workers_merged(self):
+        metrics.METRICS_DIR = self.metrics_dir
+        metrics._last_flush[0] = 0.0
+        labels = ('GET', '/actors', '200')
+        other = metrics.Histogram(
+            metrics.request_seconds.name, '', metrics.LATENCY_BUCKETS,
+            metrics.ROUTE_LABELS + ('status',))
+        other.observe(0.001, labels)
+        other.observe(0.001, labels)
+        with open(os.path.join(self.metrics_dir,
+                               'metrics-{}.json'.format(os.getpid() + 1)),
+                  'w') as snapshot:
+            json.dump({other.name: other.snapshot()}, snapshot)
+        res = self.client().get('/actors', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(os.path.exists(metrics.snapshot_path()))
+        lines = self.exposition()
+        self.assertIn('capstone_http_request_duration_seconds_count'
+                      '{method="GET",route="/actors",status="200"} 3', lines)
+        pool_series = 'capstone_db_pool_checkouts_total{{pid="{}"}} '.format(
+            os.getpid())
+        self.assertTrue(any(line.startswith(pool_series) for line in lines))
+
+
+class TestProfiling(LocalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.saved_profile_dir = profiling.PROFILE_DIR
+        profiling.PROFILE_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for path in os.listdir(profiling.PROFILE_DIR):
+            os.remove(os.path.join(profiling.PROFILE_DIR, path))
+        os.rmdir(profiling.PROFILE_DIR)
+        profiling.PROFILE_DIR = self.saved_profile_dir
+        super().tearDown()
+
+    def profiled(self, url):
+        res = self.client().get(url, headers=dict(self.headers, **{
+            profiling.PROFILE_HEADER: '1'}))
+        self.assertEqual(res.status_code, 200)
+        return res, res.headers['X-Profile-Id']
+
+    def assert_profile_saved(self, profile_id, table):
+        res = self.client().get('/profiles/' + profile_id,
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        path = os.path.join(profiling.PROFILE_DIR, 'downloaded.pstats')
+        with open(path, 'wb') as downloaded:
+            downloaded.write(res.data)
+        self.assertTrue(pstats.Stats(path).total_calls > 0)
+        res = self.client().get('/profiles/{}/sql'.format(profile_id),
+                                headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertTrue(any(table in statement['statement']
+                            for statement in data['statements']))
+        for statement in data['statements']:
+            self.assertEqual(set(statement),
+                             {'statement', 'parameters', 'seconds'})
+
+    def test_profiled_request(self):
+        self.seed()
+        res, profile_id = self.profiled('/actors?limit=5')
+        self.assertEqual(len(json.loads(res.data)['actors']), 5)
+        self.assertTrue(profiling.is_profile_id(profile_id))
+        self.assert_profile_saved(profile_id, 'FROM actor ')
+
+    def test_streamed_body_profiled(self):
+        self.seed()
+        res, profile_id = self.profiled('/movies?stream=1')
+        self.assertEqual(len(res.data.splitlines()), 20)
+        self.assert_profile_saved(profile_id, 'FROM movie ')
+
+    def test_unknown_profile(self):
+        res = self.client().get('/profiles/' + '0' * 32,
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().get('/profiles/../metrics/sql',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestJWKSStore(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.jwks_file = tempfile.NamedTemporaryFile(
+            'w', suffix='.json', delete=False)
+        self.jwks_file.close()
+        self.write_keys('first')
+        self.store = JWKSStore(
+            'file://' + self.jwks_file.name,
+            ttl=60,
+            min_refresh_interval=10,
+            stale_if_error=100,
+            refresh_ahead=1,
+            clock=self.clock)
+
+    def tearDown(self):
+        if os.path.exists(self.jwks_file.name):
+            os.remove(self.jwks_file.name)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file.name, 'w') as jwks_file:
+            json.dump({'keys': [dict(kid=kid, kty='RSA', use='sig',
+                                     n='n', e='AQAB') for kid in kids]},
+                      jwks_file)
+
+    def test_keys_are_cached_until_ttl(self):
+        self.assertEqual(self.store.get_key('first')['kid'], 'first')
+        self.write_keys('second')
+        self.clock.now = 59
+        self.assertIsNotNone(self.store.get_key('first'))
+        self.clock.now = 61
+        self.assertIsNone(self.store.get_key('first'))
+        self.assertIsNotNone(self.store.get_key('second'))
+
+    def test_unknown_kid_forces_rate_limited_refresh(self):
+        self.store.get_key('first')
+        self.write_keys('first', 'rotated')
+        self.clock.now = 5
+        self.assertIsNone(self.store.get_key('rotated'))
+        self.clock.now = 11
+        self.assertIsNotNone(self.store.get_key('rotated'))
+
+    def test_stale_keys_served_when_refresh_fails(self):
+        self.store.get_key('first')
+        os.remove(self.jwks_file.name)
+        self.clock.now = 120
+        self.assertIsNotNone(self.store.get_key('first'))
+        self.clock.now = 200
+        with self.assertRaises(JWKSError):
+            self.store.get_key('first')
+
+    def test_missing_document_raises(self):
+        os.remove(self.jwks_file.name)
+        with self.assertRaises(JWKSError):
+            self.store.get_key('first')
+
+    def test_document_downloaded_by_the_caller(self):
+        self.assertTrue(self.store.needs_refresh('first'))
+        self.store.load({'keys': [{'kid': 'first', 'kty': 'RSA'}]})
+        self.assertFalse(self.store.needs_refresh('first'))
+        self.clock.now = 5
+        self.assertFalse(self.store.needs_refresh('rotated'))
+        self.clock.now = 11
+        self.assertTrue(self.store.needs_refresh('rotated'))
+        self.store.failed(OSError('unreachable'))
+        self.assertIsNotNone(self.store.get_key('first'))
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TokenCache(maxsize=2, negative_ttl=10, clock=self.clock)
+        self.calls = 0
+
+    def verify(self, token):
+        self.calls += 1
+        if token == 'garbage':
+            raise AuthError({'code': 'invalid_header'}, 400)
+        if token == 'unknown-kid':
+            raise AuthError({'code': 'invalid_header'}, 400, cacheable=False)
+        return {'sub': token, 'exp': 100, 'permissions': ['read:actor']}
+
+    def test_valid_token_verified_once(self):
+        payload, permissions = self.cache.verify('a', self.verify)
+        self.cache.verify('a', self.verify)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(payload['sub'], 'a')
+        self.assertIn('read:actor', permissions)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_token_dropped_after_exp(self):
+        self.cache.verify('a', self.verify)
+        self.clock.now = 100
+        self.cache.verify('a', self.verify)
+        self.assertEqual(self.calls, 2)
+
+    def test_cache_is_bounded(self):
+        for token in ('a', 'b', 'c'):
+            self.cache.verify(token, self.verify)
+        self.cache.verify('a', self.verify)
+        self.assertEqual(self.calls, 4)
+        self.assertEqual(self.cache.stats()['size'], 2)
+
+    def test_rejected_token_cached(self):
+        for _ in range(2):
+            with self.assertRaises(AuthError):
+                self.cache.verify('garbage', self.verify)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats()['negative_hits'], 1)
+        self.clock.now = 11
+        with self.assertRaises(AuthError):
+            self.cache.verify('garbage', self.verify)
+        self.assertEqual(self.calls, 2)
+
+    def test_uncacheable_rejection_not_cached(self):
+        for _ in range(2):
+            with self.assertRaises(AuthError):
+                self.cache.verify('unknown-kid', self.verify)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.cache.stats()['negative_size'], 0)
+
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        self.histogram = Histogram(
+            'test_seconds', 'Test', (0.1, 1), ('route',))
+
+    def test_values_counted_in_their_bucket(self):
+        for value in (0.05, 0.1, 0.5, 2):
+            self.histogram.observe(value, ('/actors',))
+        self.assertEqual(self.histogram.series[('/actors',)],
+                         [2, 1, 1, 2.65])
+
+    def test_rendered_buckets_are_cumulative(self):
+        self.histogram.observe(0.5, ('/actors',))
+        self.histogram.observe(2, ('/actors',))
+        series = {tuple(values): counts
+                  for values, counts in self.histogram.snapshot()}
+        lines = render_histogram(self.histogram, series)
+        self.assertIn('test_seconds_bucket{route="/actors",le="0.1"} 0',
+                      lines)
+        self.assertIn('test_seconds_bucket{route="/actors",le="1"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="/actors",le="+Inf"} 2',
+                      lines)
+        self.assertIn('test_seconds_sum{route="/actors"} 2.5', lines)
+        self.assertIn('test_seconds_count{route="/actors"} 2', lines)
+
+
+class TestSeedLinks(unittest.TestCase):
+    def links(self, seed):
+        return list(link_rows(random.Random(seed), range(1, 201),
+                              range(1, 1001), 2000))
+
+    def test_same_seed_same_links(self):
+        self.assertEqual(self.links(3), self.links(3))
+        self.assertNotEqual(self.links(3), self.links(4))
+
+    def test_casts_are_unique_and_near_the_target(self):
+        links = self.links(3)
+        pairs = {(link['movie_id'], link['actor_id']) for link in links}
+        self.assertEqual(len(pairs), len(links))
+        self.assertEqual({link['movie_id'] for link in links},
+                         set(range(1, 201)))
+        self.assertTrue(1500 < len(links) < 2500)
+
+
+class TestMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = MemoryStore(clock=self.clock)
+
+    def test_keys_expire(self):
+        self.store.set('key', 'value', 5)
+        self.clock.now = 4
+        self.assertEqual(self.store.get('key'), 'value')
+        self.clock.now = 5
+        self.assertIsNone(self.store.get('key'))
+
+    def test_add_keeps_the_live_value(self):
+        self.assertTrue(self.store.add('key', 'first', 5))
+        self.assertFalse(self.store.add('key', 'second', 5))
+        self.assertEqual(self.store.get('key'), 'first')
+        self.clock.now = 6
+        self.assertTrue(self.store.add('key', 'second', 5))
+        self.assertEqual(self.store.get('key'), 'second')
+
+    def test_least_recently_set_keys_dropped(self):
+        store = MemoryStore(clock=self.clock, maxsize=2)
+        store.set('a', '1', 5)
+        store.set('b', '2', 5)
+        store.set('a', '3', 5)
+        store.set('c', '4', 5)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual((store.get('a'), store.get('c')), ('3', '4'))
+
+    def test_limits_not_pushed_out_by_other_keys(self):
+        store = MemoryStore(clock=self.clock, maxsize=2)
+        self.assertTrue(store.acquire('running', 'a', 1, 5))
+        self.assertEqual(store.take('bucket', 10, 1, 10), 0)
+        for key in range(10):
+            store.set(str(key), 'value', 5)
+        self.assertFalse(store.acquire('running', 'b', 1, 5))
+        self.assertEqual(store.take('bucket', 1, 1, 10), 1)
+
+    def test_byte_budget_drops_oldest_but_not_unevictable_keys(self):
+        store = MemoryStore(clock=self.clock, max_bytes=10)
+        store.add('claim', 'pending', 5, evictable=False)
+        store.set('a', 'xx', 5)
+        store.set('b', 'yy', 5)
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(store.get('claim'), 'pending')
+        self.assertEqual(store.get('b'), 'yy')
+        self.assertEqual(store.nbytes, 9)
+        self.clock.now = 5
+        store.set('c', 'z' * 10, 5)
+        self.assertIsNone(store.get('claim'))
+        self.assertEqual((store.get('c'), store.nbytes), ('z' * 10, 10))
+
+    def test_token_bucket_refills(self):
+        self.assertEqual(self.store.take('bucket', 8, 2, 10), 0)
+        self.assertEqual(self.store.take('bucket', 5, 2, 10), 1.5)
+        self.clock.now = 1.5
+        self.assertEqual(self.store.take('bucket', 5, 2, 10), 0)
+        self.clock.now = 100
+        self.assertEqual(self.store.take('bucket', 10, 2, 10), 0)
+
+    def test_leases_limit_and_expire(self):
+        self.assertTrue(self.store.acquire('running', 'a', 2, 5))
+        self.assertTrue(self.store.acquire('running', 'b', 2, 5))
+        self.assertFalse(self.store.acquire('running', 'c', 2, 5))
+        self.store.release('running', 'a')
+        self.assertTrue(self.store.acquire('running', 'c', 2, 5))
+        self.clock.now = 5
+        self.assertTrue(self.store.acquire('running', 'd', 2, 5))
+        self.assertTrue(self.store.acquire('running', 'e', 2, 5))
+
+
+""" The behaviour every key-value store must have, run against the
+    MemoryStore and, with fakeredis, against the RedisStore and its Lua
+    scripts. The stores use real clocks here.
+"""
+
+
+class StoreContract:
+    def test_set_get_delete(self):
+        self.assertIsNone(self.store.get('key'))
+        self.store.set('key', 'value', 5)
+        self.assertEqual(self.store.get('key'), 'value')
+        self.store.set('key', 'other', 5)
+        self.assertEqual(self.store.get('key'), 'other')
+        self.store.delete('key')
+        self.assertIsNone(self.store.get('key'))
+
+    def test_keys_expire(self):
+        self.store.set('key', 'value', 0.05)
+        self.assertTrue(self.store.add('claim', 'pending', 0.05,
+                                       evictable=False))
+        time.sleep(0.1)
+        self.assertIsNone(self.store.get('key'))
+        self.assertTrue(self.store.add('claim', 'done', 5))
+        self.assertEqual(self.store.get('claim'), 'done')
+
+    def test_add_keeps_the_live_value(self):
+        self.assertTrue(self.store.add('key', 'first', 5))
+        self.assertFalse(self.store.add('key', 'second', 5))
+        self.assertEqual(self.store.get('key'), 'first')
+
+    def test_take_waits_for_tokens(self):
+        self.assertEqual(self.store.take('bucket', 8, 2, 10), 0)
+        self.assertAlmostEqual(self.store.take('bucket', 5, 2, 10), 1.5,
+                               places=1)
+        self.assertEqual(self.store.take('other', 10, 2, 10), 0)
+        time.sleep(0.1)
+        self.assertAlmostEqual(self.store.take('bucket', 5, 2, 10), 1.4,
+                               places=1)
+
+    def test_acquire_limits_and_releases(self):
+        self.assertTrue(self.store.acquire('running', 'a', 2, 5))
+        self.assertTrue(self.store.acquire('running', 'b', 2, 5))
+        self.assertFalse(self.store.acquire('running', 'c', 2, 5))
+        self.store.release('running', 'a')
+        self.assertTrue(self.store.acquire('running', 'c', 2, 5))
+        self.assertFalse(self.store.acquire('running', 'd', 2, 5))
+
+    def test_leases_expire(self):
+        self.assertTrue(self.store.acquire('running', 'a', 1, 0.05))
+        self.assertFalse(self.store.acquire('running', 'b', 1, 5))
+        time.sleep(0.1)
+        self.assertTrue(self.store.acquire('running', 'b', 1, 5))
+
+
+class TestMemoryStoreContract(StoreContract, unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+
+
+def fake_redis_store():
+    return RedisStore(prefix='test:', client=fakeredis.FakeRedis(
+        server=fakeredis.FakeServer(), decode_responses=True))
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisStoreContract(StoreContract, unittest.TestCase):
+    def setUp(self):
+        self.store = fake_redis_store()
+
+    def test_keys_kept_under_the_prefix(self):
+        self.store.set('key', 'value', 5)
+        self.assertEqual(self.store.client.keys(), ['test:key'])
+
+
+class TestVersionCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.versions = etag.VersionCache(ttl=1, clock=self.clock)
+
+    def test_versions_kept_per_database(self):
+        self.versions.put('actors', 7, 'replica-1')
+        self.versions.put('actors', 5, 'replica-2')
+        self.assertEqual(self.versions.cached('actors', 'replica-1'), 7)
+        self.assertEqual(self.versions.cached('actors', 'replica-2'), 5)
+        self.assertIsNone(self.versions.cached('actors'))
+        self.versions.invalidate(['actors'])
+        self.assertIsNone(self.versions.cached('actors', 'replica-1'))
+        self.assertIsNone(self.versions.cached('actors', 'replica-2'))
+
+    def test_versions_expire(self):
+        self.versions.put('movies', 3)
+        self.clock.now = 1
+        self.assertIsNone(self.versions.cached('movies'))
+
+    def test_bumped_versions_taken_unless_older(self):
+        self.versions.put('actors', 5, 'replica-1')
+        self.versions.bumped({'actors': 8})
+        self.assertIsNone(self.versions.cached('actors', 'replica-1'))
+        self.assertEqual(self.versions.cached('actors'), 8)
+        self.versions.bumped({'actors': 7})
+        self.assertEqual(self.versions.cached('actors'), 8)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = ratelimit.RateLimiter(
+            MemoryStore(clock=self.clock), rate=20,
+            burst=ratelimit.RATE_LIMIT_BURST)
+
+    def test_stream_charged_once_with_default_burst(self):
+        with APP.test_request_context('/actors?stream=1'):
+            cost = ratelimit.request_cost()
+        self.assertEqual(cost, ratelimit.route_cost('get_actors') +
+                         ratelimit.STREAM_COST)
+        self.assertEqual(self.limiter.take('reader', cost), 0)
+        wait = self.limiter.take('reader', cost)
+        self.assertGreater(wait, 0)
+        self.clock.now = wait
+        self.assertEqual(self.limiter.take('reader', cost), 0)
+
+    def test_page_costs_route_cost(self):
+        with APP.test_request_context('/actors?limit=5'):
+            self.assertEqual(ratelimit.request_cost(),
+                             ratelimit.route_cost('get_actors'))
+
+
+class TestIdempotency(unittest.TestCase):
+    def setUp(self):
+        self.saved = (idempotency.store, idempotency.IDEMPOTENCY_WAIT)
+        idempotency.store = self.make_store()
+        self.calls = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.app = Flask(__name__)
+
+        @self.app.route('/things', methods=['POST'])
+        @idempotency.idempotent
+        def create_thing():
+            self.calls.append(request.get_json())
+            self.entered.set()
+            self.release.wait(5)
+            if request.get_json().get('fail'):
+                abort(422)
+            return jsonify({'created': len(self.calls)}), 201
+
+    def tearDown(self):
+        idempotency.store, idempotency.IDEMPOTENCY_WAIT = self.saved
+
+    def make_store(self):
+        return MemoryStore()
+
+    def post(self, body, key='retry-me'):
+        return self.app.test_client().post(
+            '/things', json=body, headers={'Idempotency-Key': key})
+
+    def test_retry_replayed(self):
+        first = self.post({'name': 'a'})
+        retry = self.post({'name': 'a'})
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.post({'name': 'a'}, 'other').status_code, 201)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_other_body_rejected(self):
+        self.post({'name': 'a'})
+        self.assertEqual(self.post({'name': 'b'}).status_code, 422)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_failed_request_released(self):
+        self.assertEqual(self.post({'fail': True}).status_code, 422)
+        self.assertEqual(self.post({'fail': True}).status_code, 422)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_concurrent_retries_coalesced(self):
+        self.release.clear()
+        responses = []
+        threads = [threading.Thread(
+            target=lambda: responses.append(self.post({'name': 'a'})))
+            for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        self.entered.wait(5)
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual([res.status_code for res in responses], [201] * 3)
+        self.assertEqual(len({res.data for res in responses}), 1)
+
+    def test_retry_gets_409_while_running(self):
+        idempotency.IDEMPOTENCY_WAIT = 0.1
+        self.release.clear()
+        first = threading.Thread(target=self.post, args=({'name': 'a'},))
+        first.start()
+        self.entered.wait(5)
+        retry = self.post({'name': 'a'})
+        self.release.set()
+        first.join()
+        self.assertEqual(retry.status_code, 409)
+        self.assertIn('Retry-After', retry.headers)
+        self.assertEqual(len(self.calls), 1)
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisIdempotency(TestIdempotency):
+    def make_store(self):
+        return fake_redis_store()
+
+
+class TestGraph(unittest.TestCase):
+    def setUp(self):
+        # movie 10: actors 1, 2 / movie 11: 2, 3 / movie 12: 3, 4, 1
+        # movie 13: 4, 5
+        self.graph = Graph.from_links([
+            (10, 1), (10, 2), (11, 2), (11, 3), (12, 3), (12, 4),
+            (12, 1), (13, 4), (13, 5)])
+
+    def test_costars_ranked_by_shared_movies(self):
+        self.graph.apply(11, 1, True)
+        self.assertEqual(self.graph.costars(1), [(2, 2), (3, 2), (4, 1)])
+
+    def test_shortest_path(self):
+        self.assertEqual(self.graph.path(2, 5), [2, 10, 1, 12, 4, 13, 5])
+        self.assertIsNone(self.graph.path(2, 5, max_depth=2))
+        self.assertIsNone(self.graph.path(2, 6))
+
+    def test_changes_applied_once(self):
+        for _ in range(2):
+            self.graph.apply(12, 1, False)
+            self.graph.apply(14, 2, True)
+            self.graph.apply(14, 5, True)
+        self.assertEqual(self.graph.pending, 3)
+        self.assertEqual(list(self.graph.movies_of(1)), [10])
+        self.assertEqual(self.graph.path(2, 5), [2, 14, 5])
+        self.graph.apply(12, 1, True)
+        self.graph.apply(14, 5, False)
+        self.assertEqual(self.graph.pending, 1)
+        self.assertEqual(self.graph.path(1, 4), [1, 12, 4])
+
+
+class TestSimilar(unittest.TestCase):
+    def setUp(self):
+        # movie 10: actors 1, 2, 3 / movie 11: 1, 2 / movie 12: 3, 4
+        # movie 13: 1, 2, 3, 4
+        self.graph = Graph.from_links([
+            (10, 1), (10, 2), (10, 3), (11, 1), (11, 2), (12, 3), (12, 4),
+            (13, 1), (13, 2), (13, 3), (13, 4)])
+
+    def test_movies_ranked_by_jaccard(self):
+        results = similar.similar(self.graph, similar.MOVIES, 10)
+        self.assertEqual(results, [(13, 3, 3 / 4), (11, 2, 2 / 3),
+                                   (12, 1, 1 / 4)])
+
+    def test_cosine(self):
+        results = similar.similar(self.graph, similar.ACTORS, 4,
+                                  metric='cosine', limit=1)
+        self.assertEqual(results[0][:2], (3, 2))
+
+    def test_cache_follows_changes(self):
+        cache = similar.SimilarCache()
+        self.assertEqual(cache.similar(self.graph, similar.MOVIES, 12)[0][0],
+                         13)
+        self.graph.apply(14, 3, True)
+        self.graph.apply(14, 4, True)
+        self.assertEqual(cache.similar(self.graph, similar.MOVIES, 12)[0][0],
+                         14)
+
+
 def checkTokens():
     err = False
     if os.getenv("EXECUTIVE_TOKEN") is None:
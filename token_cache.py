@@ -0,0 +1,106 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+'''
+TokenCache
+Remembers the outcome of verifying a bearer token, keyed on its SHA-256
+digest, so a client reusing the same token does not pay for the RS256
+signature check on every request.
+
+Valid tokens are kept, together with their permission set, until their
+"exp" claim. Rejected tokens are kept in a smaller negative cache for
+`negative_ttl` seconds, unless the error says it is not cacheable: a token
+signed with a key missing from the JWKS may be valid once the keys are
+refreshed, during a key rotation. Both caches are bounded LRUs.
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=4096, negative_maxsize=256, negative_ttl=30,
+                 clock=time.time):
+        self.maxsize = maxsize
+        self.negative_maxsize = negative_maxsize
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self._entries = OrderedDict()
+        self._rejected = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def _lookup(self, cache, key, now):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return entry
+
+    def _insert(self, cache, maxsize, key, entry):
+        if maxsize <= 0:
+            return
+        with self._lock:
+            cache[key] = entry
+            cache.move_to_end(key)
+            while len(cache) > maxsize:
+                cache.popitem(last=False)
+
+    """ Returns the (payload, permissions) pair for the token, calling
+        `verify` only when the token is not cached. Errors raised by
+        `verify` with one of the `cached_errors` status codes are
+        remembered and raised again for the same token, unless their
+        `cacheable` attribute is false.
+    """
+
+    def verify(self, token, verify, cached_errors=(400, 401)):
+        key = self.digest(token)
+        now = self.clock()
+        with self._lock:
+            entry = self._lookup(self._entries, key, now)
+            if entry is not None:
+                self.hits += 1
+                return entry[1], entry[2]
+            rejected = self._lookup(self._rejected, key, now)
+            if rejected is not None:
+                self.negative_hits += 1
+        if rejected is not None:
+            error = rejected[1]
+            raise type(error)(error.error, error.status_code)
+        self.misses += 1
+        try:
+            payload = verify(token)
+        except Exception as error:
+            if getattr(error, 'status_code', None) in cached_errors and \
+                    getattr(error, 'cacheable', True):
+                self._insert(self._rejected, self.negative_maxsize, key,
+                             (now + self.negative_ttl, error))
+            raise
+        permissions = frozenset(payload.get('permissions', []))
+        expires_at = payload.get('exp')
+        if isinstance(expires_at, (int, float)):
+            self._insert(self._entries, self.maxsize, key,
+                         (expires_at, payload, permissions))
+        return payload, permissions
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rejected.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'size': len(self._entries),
+            'negative_size': len(self._rejected),
+        }